@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import queue
+import argparse
+import resource
+import multiprocessing as mp
+import config
+
+
+
+# ============================
+def _trial(cfg, steps, nwarmup, result):
+    """Trains steps batches in a fresh process (the thread pools can only be
+    set once per process) and reports images/s and the peak RSS"""
+
+    config.applyThreads(cfg)
+
+    import tensorflow as tf
+    from model import createModel, createLoss
+    from datapipe import Datapipe
+
+    model = createModel(**config.modelKwargs(cfg))
+    model.compile(
+        loss=createLoss(model, len(cfg["classNames"]), cfg["classAgnostic"]),
+        optimizer=tf.keras.optimizers.Adam(cfg["learnrate"]),
+    )
+
+    g = Datapipe(cfg["datapath"], cfg["classNames"]).create(**config.createKwargs(cfg), nrepeat=-1)
+
+    times = []
+    timer = tf.keras.callbacks.LambdaCallback(on_train_batch_end=lambda batch, logs: times.append(time.perf_counter()))
+    model.fit(g, epochs=1, steps_per_epoch=nwarmup+steps, callbacks=[timer], verbose=0)
+
+    result.put({
+        "images_per_second": steps*cfg["batchSize"] / (times[-1] - times[nwarmup-1]),
+        "peak_rss_bytes": 1024*resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def runTrial(cfg, steps=30, nwarmup=5, timeout=900):
+    """images/s and peak memory of cfg, None if the trial failed or was killed (e.g. out of memory)"""
+
+    ctx = mp.get_context("spawn")
+    result = ctx.Queue()
+    proc = ctx.Process(target=_trial, args=(cfg, steps, nwarmup, result))
+    proc.start()
+    proc.join(timeout)
+
+    if proc.is_alive():
+        proc.kill()
+        proc.join()
+
+    try:
+        row = result.get(timeout=5) if proc.exitcode == 0 else None
+    except queue.Empty:
+        row = None
+    print({k: cfg.get(k) for k in ("batchSize", "numParallelCalls", "intraOpThreads", "interOpThreads")}, row)
+
+    return row
+
+
+def totalMemory():
+    return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+
+
+# ============================
+def autotune(cfg, memoryLimit=None, maxBatchSize=256, steps=30):
+    """Doubles the batch size while the peak memory stays below memoryLimit
+    and throughput improves, then sweeps the pipeline parallelism and the
+    intra/inter-op threads one after the other at that batch size.
+    Returns the best config and all trial rows"""
+
+    memoryLimit = memoryLimit or 0.8*totalMemory()
+    ncores = len(os.sched_getaffinity(0))
+    cfg = dict(cfg, numParallelCalls=-1, intraOpThreads=None, interOpThreads=None)
+
+    rows = []
+    def measure(**changes):
+        trial = dict(cfg, **changes)
+        row = runTrial(trial, steps)
+        if row is not None:
+            row = dict(row, **{k: trial[k] for k in ("batchSize", "numParallelCalls", "intraOpThreads", "interOpThreads")})
+            rows.append(row)
+        return row
+
+    # Batch size
+    best, b = None, 1
+    while b <= maxBatchSize:
+        row = measure(batchSize=b)
+        if row is None or row["peak_rss_bytes"] > memoryLimit:
+            break
+        if best is not None and row["images_per_second"] < 1.05*best["images_per_second"]:
+            best = max(best, row, key=lambda r: r["images_per_second"])
+            break
+        best, b = row, 2*b
+
+    if best is None:
+        raise RuntimeError("Not even batch size 1 could be trained")
+    cfg["batchSize"] = best["batchSize"]
+
+    # Input pipeline parallelism (-1 is tf.data.AUTOTUNE)
+    for p in sorted({1, 2, 4, max(1, ncores//2), -1}):
+        row = measure(numParallelCalls=p)
+        if row is not None and row["images_per_second"] > best["images_per_second"]:
+            best = row
+    cfg["numParallelCalls"] = best["numParallelCalls"]
+
+    # Thread pools
+    for intra in sorted({ncores, max(1, ncores//2), max(1, ncores//4)}):
+        for inter in (1, 2):
+            row = measure(intraOpThreads=intra, interOpThreads=inter)
+            if row is not None and row["images_per_second"] > best["images_per_second"]:
+                best = row
+
+    tuned = {k: best[k] for k in ("batchSize", "numParallelCalls", "intraOpThreads", "interOpThreads")}
+    return tuned, best, rows
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Tunes batch size, pipeline parallelism and thread pools for this machine")
+    config.addArguments(parser)
+    parser.add_argument("--memoryLimitGb", type=float, default=None, help="default 80%% of the RAM")
+    parser.add_argument("--maxBatchSize", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=30, help="timed training steps per trial")
+    parser.add_argument("--out", default="autotune.json")
+    args = parser.parse_args()
+
+    cfg = vars(args)
+    memoryLimit = args.memoryLimitGb*2**30 if args.memoryLimitGb else None
+
+    tuned, best, rows = autotune(cfg, memoryLimit, args.maxBatchSize, args.steps)
+    print(f"Best: {tuned}, {best['images_per_second']:.1f} images/s, {best['peak_rss_bytes']/2**30:.1f} GB")
+
+    with open(args.out, 'w') as f:
+        json.dump(tuned, f, indent=2)
+
+    with open(os.path.splitext(args.out)[0] + "_trials.json", 'w') as f:
+        json.dump({"host": os.uname().nodename, "best": best, "trials": rows}, f, indent=2)
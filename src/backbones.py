@@ -0,0 +1,122 @@
+import os
+import time
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+from model import createModel
+
+
+
+# Backbone configurations compared in the latency table
+CONFIGS = [
+    {"name": "baseline",         "block": "residual",   "nfilters": 32, "ndepths": 4},
+    {"name": "dw",               "block": "dwresidual", "nfilters": 32, "ndepths": 4},
+    {"name": "inverted",         "block": "inverted",   "nfilters": 32, "ndepths": 4},
+    {"name": "dw-x0.5",          "block": "dwresidual", "nfilters": 32, "ndepths": 4, "widthMultiplier": 0.5},
+    {"name": "dw-x0.5-cap128",   "block": "dwresidual", "nfilters": 32, "ndepths": 4, "widthMultiplier": 0.5, "maxFilters": 128},
+    {"name": "inverted-cap128",  "block": "inverted",   "nfilters": 16, "ndepths": 4, "maxFilters": 128},
+    {"name": "dw-d3-cap64",      "block": "dwresidual", "nfilters": 16, "ndepths": 3, "maxFilters": 64},
+]
+
+
+# ============================
+def countFlops(model, batchSize=1):
+    """Floating point operations of one forward pass"""
+
+    spec = tf.TensorSpec([batchSize] + model.inputs[0].shape[1:], tf.float32)
+    func = tf.function(lambda x: model(x, training=False)).get_concrete_function(spec)
+    frozen = convert_variables_to_constants_v2(func)
+
+    opts = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    opts["output"] = "none"
+    info = tf.compat.v1.profiler.profile(
+        graph=frozen.graph, run_meta=tf.compat.v1.RunMetadata(), cmd="op", options=opts
+    )
+    return info.total_float_ops
+
+
+# ============================
+def measureLatency(model, batchSize=1, nwarmup=5, nruns=30):
+    """Median and p90 CPU latency in ms of one forward pass"""
+
+    x = tf.random.uniform([batchSize] + model.inputs[0].shape[1:])
+    forward = tf.function(lambda x: model(x, training=False))
+
+    for _ in range(nwarmup):
+        forward(x).numpy()
+
+    times = []
+    for _ in range(nruns):
+        t0 = time.perf_counter()
+        forward(x).numpy()
+        times.append(1e3*(time.perf_counter() - t0))
+
+    return float(np.median(times)), float(np.percentile(times, 90))
+
+
+# ============================
+def latencyTable(configs, nc=3, ih=256, iw=256, ic=3, nfeat=32, batchSize=1, nruns=30):
+    """Builds every config and returns a list of result rows"""
+
+    rows = []
+    for config in configs:
+        kwargs = {k:v for k,v in config.items() if k != "name"}
+
+        tf.keras.backend.clear_session()
+        model = createModel(nc, ih, iw, ic, nfeat=nfeat, **kwargs)
+
+        p50, p90 = measureLatency(model, batchSize=batchSize, nruns=nruns)
+
+        rows.append({
+            "name": config["name"],
+            "config": kwargs,
+            "params": int(model.count_params()),
+            "gflops": countFlops(model, batchSize=batchSize) / 1e9,
+            "latency_p50_ms": p50,
+            "latency_p90_ms": p90,
+        })
+        print(rows[-1])
+
+    return rows
+
+
+# ============================
+def toMarkdown(rows):
+    lines = [
+        "| config | block | params | GFLOPs | p50 [ms] | p90 [ms] |",
+        "|---|---|---:|---:|---:|---:|",
+    ]
+    for r in rows:
+        lines.append(
+            f"| {r['name']} | {r['config']['block']} | {r['params']:,} | {r['gflops']:.2f} "
+            f"| {r['latency_p50_ms']:.1f} | {r['latency_p90_ms']:.1f} |"
+        )
+    return "\n".join(lines)
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="FLOPs, parameters and CPU latency per backbone config")
+    parser.add_argument("--threads", type=int, default=4, help="intra-op threads")
+    parser.add_argument("--batchSize", type=int, default=1)
+    parser.add_argument("--nruns", type=int, default=30)
+    parser.add_argument("--out", default="backbones")
+    args = parser.parse_args()
+
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    rows = latencyTable(CONFIGS, batchSize=args.batchSize, nruns=args.nruns)
+
+    table = toMarkdown(rows)
+    print(table)
+
+    with open(args.out + ".md", "w") as f:
+        f.write(f"Batch size {args.batchSize}, {args.threads} intra-op threads, host {os.uname().nodename}\n\n")
+        f.write(table + "\n")
+
+    with open(args.out + ".json", "w") as f:
+        json.dump(rows, f, indent=2)
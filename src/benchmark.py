@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import numpy as np
+import tensorflow as tf
+from datapipe import Datapipe, readJsonAnnotation, postprocess
+from decode import decodePredictions
+from model import createModel, centerNetLoss
+from synthdata import generate
+
+
+
+# ============================
+def timeit(fn, nwarmup=2, nruns=10):
+    """Median wall time in seconds of fn()"""
+
+    for _ in range(nwarmup):
+        fn()
+
+    times = []
+    for _ in range(nruns):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    return float(np.median(times))
+
+
+def result(name, value, unit, **params):
+    row = {"name": name, "value": value, "unit": unit, "params": params}
+    print(row)
+    return row
+
+
+# ============================
+def benchReadJson(datapath, classNames):
+    dp = Datapipe(datapath, classNames)
+    t = timeit(lambda: [readJsonAnnotation(f, datapath, classNames) for f in dp.filenames], nruns=3)
+    return [result("readJsonAnnotation", dp.nd/t, "files/s", nfiles=dp.nd)]
+
+
+def benchDatapipe(datapath, classNames, batchSize=16, nx=128, ny=128, ih=256, iw=256):
+    dp = Datapipe(datapath, classNames)
+    g = dp.create(nx, ny, iw, ih, ic=3, batchSize=batchSize)
+
+    def run():
+        for _ in g:
+            pass
+
+    t = timeit(run, nwarmup=1, nruns=3)
+    return [result("Datapipe.create", dp.nd/t, "images/s", nfiles=dp.nd, batchSize=batchSize)]
+
+
+def benchGaussianLabel(datapath, classNames, counts=(1, 10, 50, 200), nx=128, ny=128):
+    dp = Datapipe(datapath, classNames)
+    dp.create(nx, ny, 256, 256, 3, 1)
+
+    img = tf.zeros((256, 256, 3))
+    label = tf.function(lambda boxes, labels: dp._gaussianLabel(img, boxes, labels, ""))
+
+    rows = []
+    for n in counts:
+        xy = tf.random.uniform((n, 2), 0, 0.8)
+        boxes = tf.concat([xy, xy + 0.1], axis=-1)
+        labels = tf.random.uniform((n,), 0, dp.nc, dtype=tf.int32)
+
+        t = timeit(lambda: label(boxes, labels)[1].numpy(), nruns=20)
+        rows.append(result("_gaussianLabel", 1e3*t, "ms", nobjects=n, nx=nx, ny=ny))
+
+    return rows
+
+
+def benchHourglass(configs, nc=3, batchSize=4, ih=256, iw=256):
+    rows = []
+    for cfg in configs:
+        tf.keras.backend.clear_session()
+        model = createModel(nc, ih, iw, **cfg)
+        lossFn = centerNetLoss(nc)
+
+        x = tf.random.uniform((batchSize, ih, iw, 3))
+        y = tf.random.uniform((batchSize, ih//2, iw//2, nc+5))
+
+        forward = tf.function(lambda x: model(x, training=False))
+
+        @tf.function
+        def backward(x, y):
+            with tf.GradientTape() as tape:
+                loss = tf.reduce_mean(lossFn(y, model(x, training=True)))
+            return tape.gradient(loss, model.trainable_variables)
+
+        tf_ = timeit(lambda: forward(x).numpy())
+        tb = timeit(lambda: [g.numpy() for g in backward(x, y)])
+
+        rows.append(result("HourglassModule.forward", 1e3*tf_, "ms", batchSize=batchSize, **cfg))
+        rows.append(result("HourglassModule.forward_backward", 1e3*tb, "ms", batchSize=batchSize, **cfg))
+
+    return rows
+
+
+def benchDecode(nc=3, batchSize=16, H=128, W=128, K=50):
+    ylabel = tf.random.uniform((1, H, W, nc+5))
+    ypred = tf.random.uniform((batchSize, H, W, 2*nc+4))
+
+    decode = tf.function(lambda y: decodePredictions(y, nc, K))
+
+    t0 = timeit(lambda: postprocess(ylabel, K=K)[0].numpy(), nruns=5)
+    t1 = timeit(lambda: decode(ypred)[0].numpy(), nruns=20)
+
+    return [
+        result("postprocess", 1e3*t0, "ms", batchSize=1, H=H, W=W, K=K),
+        result("decodePredictions", 1e3*t1/batchSize, "ms/image", batchSize=batchSize, H=H, W=W, K=K),
+    ]
+
+
+# ============================
+def compare(rows, baseline, tolerance=0.2):
+    """Names of results that are more than tolerance worse than baseline"""
+
+    key = lambda r: (r["name"], json.dumps(r["params"], sort_keys=True))
+    old = {key(r): r for r in baseline}
+
+    regressions = []
+    for r in rows:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        # Throughputs should not drop, times should not grow
+        higherIsBetter = r["unit"].endswith("/s")
+        ratio = b["value"]/r["value"] if higherIsBetter else r["value"]/b["value"]
+        if ratio > 1.0 + tolerance:
+            regressions.append(f"{r['name']} {r['params']}: {b['value']:.3g} -> {r['value']:.3g} {r['unit']}")
+
+    return regressions
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks of Datapipe, target encoding, model and decoding")
+    parser.add_argument("--datapath", default=None, help="labelme dataset, synthetic if not given")
+    parser.add_argument("-n", type=int, default=500, help="synthetic samples")
+    parser.add_argument("--classNames", nargs="+", default=["face", "mask", "dummy"])
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--baseline", default=None, help="results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    datapath = args.datapath
+    if datapath is None:
+        datapath = os.path.join(tempfile.gettempdir(), f"centernet_synth_{args.n}")
+        if not os.path.isdir(datapath):
+            generate(datapath, args.n, classNames=args.classNames)
+
+    hourglassConfigs = [
+        {"nfilters": 32, "ndepths": 4},
+        {"nfilters": 32, "ndepths": 2},
+        {"nfilters": 32, "ndepths": 4, "block": "dwresidual", "widthMultiplier": 0.5},
+    ]
+
+    rows = []
+    rows += benchReadJson(datapath, args.classNames)
+    rows += benchDatapipe(datapath, args.classNames)
+    rows += benchGaussianLabel(datapath, args.classNames)
+    rows += benchHourglass(hourglassConfigs, nc=len(args.classNames))
+    rows += benchDecode(nc=len(args.classNames))
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+            "tensorflow": tf.__version__,
+            "results": rows,
+        }, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(rows, json.load(f)["results"], args.tolerance)
+        for r in regressions:
+            print("REGRESSION", r)
+        sys.exit(1 if regressions else 0)
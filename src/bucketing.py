@@ -0,0 +1,126 @@
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from datapipe import BUCKETS, Datapipe, chooseBucket, letterboxImage, readJsonAnnotation
+from decode import decodePredictions, decodeAgnosticPredictions
+from model import createModel
+import config
+
+
+
+# ============================
+def paddingFraction(sizes, buckets=BUCKETS):
+    """Share of padded pixels when letterboxing images of (width, height)
+    sizes to their buckets, overall and per bucket"""
+
+    padded, total = np.zeros(len(buckets)), np.zeros(len(buckets))
+    for w, h in sizes:
+        b = chooseBucket(w, h, buckets)
+        bh, bw = buckets[b]
+        s = min(bh/h, bw/w)
+        padded[b] += bh*bw - (h*s)*(w*s)
+        total[b] += bh*bw
+
+    return padded.sum()/max(total.sum(), 1), padded/np.maximum(total, 1)
+
+
+class BucketPredictor:
+    """Letterboxes every image to the bucket closest to its aspect ratio,
+    runs each bucket as one batch and maps the boxes back to the original
+    image. The model must be built without a fixed input size
+    (createModel(ih=None, iw=None)); one graph per bucket is traced and reused"""
+
+    def __init__(self, model, nc, K=50, head=None, buckets=BUCKETS):
+        self.model = model
+        self.nc = nc
+        self.K = K
+        self.head = head
+        self.buckets = buckets
+        self.ic = model.inputs[0].shape[-1]
+        self.predictors = {}
+
+    def _predictor(self, b):
+        if b not in self.predictors:
+            ih, iw = self.buckets[b]
+
+            @tf.function(input_signature=[tf.TensorSpec([None, ih, iw, self.ic], tf.float32)])
+            def predict(img):
+                ypred = self.model(img, training=False)
+                if self.head is not None:
+                    return decodeAgnosticPredictions(ypred, self.head, self.K)
+                return decodePredictions(ypred, self.nc, self.K)
+
+            self.predictors[b] = predict
+        return self.predictors[b]
+
+    def warmup(self):
+        for b, (ih, iw) in enumerate(self.buckets):
+            self._predictor(b)(tf.zeros((1, ih, iw, self.ic)))
+
+    # ============================
+    def predict(self, images):
+        """images: decoded uint8 arrays [H,W,C] of any size. Returns boxes
+        [n,K,4] (Y1,X1,Y2,X2 in [0,1] of each original image), scores [n,K]
+        and classes [n,K]"""
+
+        assigned = [chooseBucket(img.shape[1], img.shape[0], self.buckets) for img in images]
+
+        boxes = np.zeros((len(images), self.K, 4), np.float32)
+        scores = np.zeros((len(images), self.K), np.float32)
+        classes = np.zeros((len(images), self.K), np.int32)
+
+        for b in sorted(set(assigned)):
+            ih, iw = self.buckets[b]
+            members = [k for k, a in enumerate(assigned) if a == b]
+
+            boxed = [letterboxImage(tf.convert_to_tensor(images[k]), ih, iw) for k in members]
+            img = tf.stack([x[0] for x in boxed])
+            scale = np.stack([np.tile(x[1].numpy(), 2) for x in boxed])[:, None, :]
+            offset = np.stack([np.tile(x[2].numpy(), 2) for x in boxed])[:, None, :]
+
+            bx, sc, cl = [t.numpy() for t in self._predictor(b)(img)]
+
+            boxes[members] = (bx - offset) / scale
+            scores[members] = sc
+            classes[members] = cl
+
+        return boxes, scores, classes
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Aspect ratio buckets of a dataset: padding and bucketed inference speed")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default=None, help="also time bucketed inference with these weights")
+    parser.add_argument("-K", type=int, default=50)
+    parser.add_argument("--nimages", type=int, default=256)
+    args = parser.parse_args()
+
+    dp = Datapipe(args.datapath, args.classNames)
+    sizes = dp._imageSizes(dp.filenames)
+
+    overall, perBucket = paddingFraction(sizes)
+    counts = np.bincount([chooseBucket(w, h) for w, h in sizes], minlength=len(BUCKETS))
+    for (bh, bw), n, p in zip(BUCKETS, counts, perBucket):
+        print(f"{bh}x{bw}: {n} images, {p:.1%} padding")
+    print(f"{overall:.1%} of the pixels are padding")
+
+    if args.weights:
+        model = createModel(**dict(config.modelKwargs(args), ih=None, iw=None))
+        model.load_weights(args.weights)
+        head = model.get_layer("agnostichead") if args.classAgnostic else None
+
+        predictor = BucketPredictor(model, len(args.classNames), args.K, head)
+        predictor.warmup()
+
+        files = dp.filenames[:args.nimages]
+        images = [tf.image.decode_jpeg(tf.io.read_file(readJsonAnnotation(f, args.datapath, args.classNames)[0]), channels=args.ic).numpy() for f in files]
+
+        t0 = time.perf_counter()
+        for k in range(0, len(images), args.batchSize):
+            predictor.predict(images[k:k+args.batchSize])
+        dt = time.perf_counter() - t0
+
+        print(f"{len(images)/dt:.1f} images/s bucketed")
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+from datapipe import findFiles, decodeImage
+from model import loadPredictor, weightsIdentity
+import config
+
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".JPG", ".JPEG")
+
+
+class BulkInference:
+    """Runs the detector over all images below a directory and writes the
+    detections to shards of shardSize images in outdir:
+
+        files.txt               image paths, line i is image id i
+        manifest.json           job parameters and weights, checked when resuming
+        shard-00000.npz         ids [n], boxes [n,K,4] (Y1,X1,Y2,X2 in [0,1]),
+                                scores [n,K], classes [n,K]
+        progress.jsonl          one line per finished shard
+
+    Shards are written to a temporary file and renamed, so an existing shard
+    is always complete and is skipped when the job is restarted. Images that
+    fail to decode are left out of their shard's ids."""
+
+    def __init__(self, imagepath, outdir, shardSize=10000):
+
+        self.imagepath = os.path.abspath(imagepath)
+        self.outdir = outdir
+        self.shardSize = shardSize
+        os.makedirs(outdir, exist_ok=True)
+
+        listfile = os.path.join(outdir, "files.txt")
+        if os.path.exists(listfile):
+            # Resumed jobs keep the image ids of the first run
+            with open(listfile, 'r') as f:
+                self.files = f.read().splitlines()
+        else:
+            self.files = sorted(findFiles(imagepath, IMAGE_EXTENSIONS))
+            with open(listfile + ".tmp", 'w') as f:
+                f.write("\n".join(self.files))
+            os.replace(listfile + ".tmp", listfile)
+
+    @property
+    def nshards(self):
+        return (len(self.files) + self.shardSize - 1) // self.shardSize
+
+    def shardPath(self, shard):
+        return os.path.join(self.outdir, f"shard-{shard:05d}.npz")
+
+    def pending(self):
+        return [s for s in range(self.nshards) if not os.path.exists(self.shardPath(s))]
+
+    # ============================
+    def _checkManifest(self, manifest):
+
+        path = os.path.join(self.outdir, "manifest.json")
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                previous = json.load(f)
+            if previous != manifest:
+                raise ValueError(f"{self.outdir} holds results of a different job: {previous}")
+        else:
+            with open(path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+
+    def _dataset(self, shards, ih, iw, ic, batchSize):
+
+        ids = np.concatenate([
+            np.arange(s*self.shardSize, min((s+1)*self.shardSize, len(self.files))) for s in shards
+        ]).astype(np.int64)
+        files = [self.files[i] for i in ids]
+
+        def load(index, path):
+            return index, decodeImage(tf.io.read_file(path), ih, iw, ic)
+
+        dataset = tf.data.Dataset.from_tensor_slices((ids, files))
+        dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        dataset = dataset.apply(tf.data.experimental.ignore_errors())
+        dataset = dataset.batch(batchSize)
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+        return dataset
+
+    def _write(self, shard, chunks, t0, K):
+
+        if chunks:
+            ids, boxes, scores, classes = [np.concatenate(c) for c in zip(*chunks)]
+        else:
+            # Not a single image of the shard could be decoded
+            ids, boxes, scores, classes = np.zeros(0, np.int64), np.zeros((0, K, 4), np.float32), \
+                np.zeros((0, K), np.float32), np.zeros((0, K), np.int32)
+
+        tmp = self.shardPath(shard) + ".tmp.npz"
+        np.savez(tmp, ids=ids, boxes=boxes, scores=scores, classes=classes.astype(np.int16))
+        os.replace(tmp, self.shardPath(shard))
+
+        with open(os.path.join(self.outdir, "progress.jsonl"), 'a') as f:
+            f.write(json.dumps({"shard": int(shard), "images": len(ids), "seconds": time.time() - t0}) + "\n")
+
+    # ============================
+    def run(self, predict, ih, iw, ic, K, batchSize=32, weights=None):
+        """predict maps a float batch [B,ih,iw,ic] to (boxes, scores, classes)
+        as returned by model.loadPredictor, weights is the file it was loaded
+        from (recorded in the manifest). Returns the number of images processed"""
+
+        self._checkManifest({
+            "imagepath": self.imagepath, "nfiles": len(self.files), "shardSize": self.shardSize, "K": K, "shape": [ih, iw, ic],
+            "weights": weightsIdentity(weights) if weights is not None else None,
+        })
+
+        shards = self.pending()
+        if not shards:
+            return 0
+
+        # Shards are saved by a background thread while the next batches run
+        writer = ThreadPoolExecutor(max_workers=1)
+        writes = []
+
+        current, chunks, t0, n = None, [], time.time(), 0
+
+        for index, img in self._dataset(shards, ih, iw, ic, batchSize):
+            index = index.numpy()
+            boxes, scores, classes = [t.numpy() for t in predict(img)]
+            n += len(index)
+
+            shard = index // self.shardSize
+            for s in np.unique(shard):
+                if current is not None and s != current:
+                    writes.append(writer.submit(self._write, current, chunks, t0, K))
+                    chunks, t0 = [], time.time()
+                current = s
+
+                sel = shard == s
+                chunks.append((index[sel], boxes[sel], scores[sel], classes[sel]))
+
+        if current is not None:
+            writes.append(writer.submit(self._write, current, chunks, t0, K))
+
+        for w in writes:
+            w.result()
+
+        for s in self.pending():
+            writes.append(writer.submit(self._write, s, [], time.time(), K))
+
+        for w in writes:
+            w.result()
+        writer.shutdown()
+
+        return n
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Resumable batch inference over an image directory")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--images", required=True)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--shardSize", type=int, default=10000)
+    parser.add_argument("-K", type=int, default=50)
+    args = parser.parse_args()
+
+    _, predict = loadPredictor(args.weights, K=args.K, **config.modelKwargs(args))
+
+    job = BulkInference(args.images, args.out, args.shardSize)
+    print(f"{len(job.files)} images, {len(job.pending())} of {job.nshards} shards pending")
+
+    t0 = time.perf_counter()
+    n = job.run(predict, args.ih, args.iw, args.ic, args.K, args.batchSize, weights=args.weights)
+    dt = time.perf_counter() - t0
+
+    print(f"{n} images in {dt:.1f} s, {n/max(dt,1e-9):.1f} images/s")
@@ -1,135 +1,194 @@
 import os
 import sys
-from matplotlib.pyplot import axis
 os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'
 import tensorflow as tf
 from tensorflow.keras.layers import Dropout, BatchNormalization, Conv2D, Lambda, MaxPool2D, Reshape
-from layers import Residual, Downsample, Upsample, HourglassModule, CenterNetPostprocessingLayer
+from model import createModel, createLoss
 from datapipe import Datapipe
+from checkpointing import StepCheckpoint
+from telemetry import Telemetry, PipelineProbe
+from evaluation import MAPCallback
+from dedup import ClusterSubsampler
+import config
 
 
 
-nfeat = 32
-learnrate = 1e-5
+# Model and input settings are the ones of config.DEFAULTS, shared with
+# autotune.py, sweep.py and the other scripts. Batch size, input pipeline
+# parallelism and thread pools tuned for them on this machine by
+# autotune.py override the defaults, if present
+autotuneFile = "autotune.json"
+cfg = config.loadConfig(autotuneFile if os.path.isfile(autotuneFile) else None)
+config.applyThreads(cfg)
 
-classNames = ["face", "mask", "dummy"]
-datapath = "/data/projects/datasets/hands/train"
+if os.path.isfile(autotuneFile):
+    print(f"Using {autotuneFile}: batchSize {cfg['batchSize']}, numParallelCalls {cfg['numParallelCalls']}, "
+          f"threads {cfg['intraOpThreads']}/{cfg['interOpThreads']}")
 
-ih, iw, ic = 256,256,3
-nx, ny = 128,128
-nc = len(classNames)
-batchSize = 10
-
-
-
-# ========= Datapipe =================
-dp = Datapipe(datapath, classNames)
-g = dp.create(nx, ny, iw, ih, ic, batchSize, shuffle_buffer_size=5000, nrepeat=1, minBoxSize=6, sigma=0.02)
-
-
-# ====================================================
-i = tf.keras.layers.Input((ih,iw,ic), name="rgb")
+classNames = cfg["classNames"]
+datapath = cfg["datapath"]
+valpath = "/data/projects/datasets/hands/test"
 
-# ========= Entry Layers =================
-x0 = Conv2D(nfeat, (7,7), name="entry01", padding="same", activation="relu")(i)
-x0 = Residual(nfeat, name="entry02")(x0)
-
-# ========= First Hourglas =================
-x1 = HourglassModule(nfilters=32, ndepths=4, name="hourglass1")(x0)
-#[x1, y1] = ImmediateSupvervision(nheatmaps, name="imsuper1")([x0, x1])
-
-# ========= Second Hourglas =================
-#x2 = HourglassModule(nfilters=32, ndepths=2, name="hourglass2")(x1)
-#[x2, y2] = ImmediateSupvervision(nheatmaps, name="imsuper2")([x1, x2])
-
-# ========= Final prediction =================
-x = Conv2D(nfeat, (3,3), strides=2, name="strider", padding="same", activation="relu")(x1)
+ih, iw, ic = cfg["ih"], cfg["iw"], cfg["ic"]
+nx, ny = cfg["nx"], cfg["ny"]
+nc = len(classNames)
+sigma, minBoxSize = cfg["sigma"], cfg["minBoxSize"]
+learnrate = cfg["learnrate"]
 
-x = Conv2D(nc+4, (1,1), name="postprocess", padding="same", activation="relu")(x)
-y = CenterNetPostprocessingLayer(nc=nc)(x)
+# Per replica. With several workers (TF_CONFIG set, see multiworker.py) the
+# global batch is batchSize*replicas and the learning rate is scaled alike
+batchSize = cfg["batchSize"]
+numParallelCalls = cfg["numParallelCalls"]
 
+# One objectness heatmap instead of one per class
+classAgnostic = cfg["classAgnostic"]
 
-# ========= The model =================
-model = tf.keras.Model(inputs=[i], outputs=[y])
+# Step checkpoints and reproducible input order for resuming
+checkpointDir = "./checkpoints"
+checkpointEvery = 500
+seed = 42
 
-print(model.summary())
-print(model.outputs)
+# tf.data service dispatcher doing the preprocessing (see dataservice.py),
+# e.g. "grpc://preproc01:5050". None preprocesses on the training host
+dataService = None
 
+# Four images per sample (Datapipe._processMosaic)
+mosaic = False
 
-# ========= The loss =================
+# Letterbox to aspect ratio buckets instead of stretching to ih x iw,
+# e.g. datapipe.BUCKETS. The model is then built without a fixed input size
+buckets = None
 
+# Near-duplicate clusters written by dedup.py, e.g. "dedup.npz". Every
+# epoch then draws one image per cluster
+dedupFile = None
 
-def centerNetLoss(ytrue, ypred):
 
-   # K = tf.shape(ytrue)[-1]
-   # C = K - 5
-    
-    C = nc 
 
-    hmTrue, whTrue, pdeltaTrue, indsTrue = tf.split(ytrue, [C, 2, 2, 1], axis=-1)
-    hmPred, whPred, pdeltaPred, indsPred = tf.split(ypred, [C, 2, 2, 3], axis=-1)
+# ========= Distribution =================
+strategy = tf.distribute.MultiWorkerMirroredStrategy() if "TF_CONFIG" in os.environ else tf.distribute.get_strategy()
+nreplicas = strategy.num_replicas_in_sync
+globalBatchSize = batchSize*nreplicas
 
-    print("----")
-    print(hmTrue.shape, hmPred.shape)
-    print(whTrue.shape, whTrue.shape)
-    print(pdeltaTrue.shape, pdeltaPred.shape)
-    print(indsTrue.shape, indsPred.shape)
+resolver = getattr(strategy, "cluster_resolver", None)
+taskType, taskId = (resolver.task_type, resolver.task_id) if resolver is not None else (None, 0)
+isChief = taskType in (None, "chief") or (taskType == "worker" and taskId == 0)
 
+# Files written by every worker get a suffix on all but the chief
+suffix = "" if isChief else f"_worker{taskId}"
 
 
-    lossHm = tf.keras.losses.binary_focal_crossentropy(hmTrue, hmPred, from_logits=False, gamma=2)
+with strategy.scope():
 
-    lossPdelta = tf.reduce_sum(indsTrue*(tf.math.abs(pdeltaTrue-pdeltaPred)), axis=[1,2,3])
-    lossWh = tf.reduce_sum(indsTrue*(tf.math.abs(whTrue-whPred)), axis=[1,2,3])
+    # ========= The model =================
+    # Backbone from config (see backbones.py for the latency table), any
+    # input size with buckets
+    mh, mw = (ih, iw) if buckets is None else (None, None)
+    model = createModel(**dict(config.modelKwargs(cfg), ih=mh, iw=mw))
 
+    if isChief:
+        print(model.summary())
+        print(model.outputs)
 
-    # loss0 = tf.reduce_mean(loss0,axis=[1,2])
-    # loss1 = tf.reduce_mean(loss1,axis=[1,2])
-    
-    # c = tf.cast(tf.math.greater(loss0, loss1), tf.float32)
-    # loss = (1-c)*loss0 + c*loss1
 
+    # ========= The loss =================
+    lossFn = createLoss(model, nc, classAgnostic)
 
-    return lossHm  #+ 0.5*(lossPdelta+ lossWh)
+    # Linear learning rate scaling with the global batch size
+    model.compile(
+        loss=lossFn,
+        optimizer=tf.keras.optimizers.Adam(learnrate*nreplicas)
+    )
 
 # ============================================
 # Training
 # ============================================
 
 tfbcb = tf.keras.callbacks.TensorBoard(
-    log_dir="./tblogs", histogram_freq=0, write_graph=True,
-    write_images=True, update_freq='batch',
-    profile_batch=2, embeddings_freq=0, embeddings_metadata=None
+    log_dir="./tblogs" + suffix, histogram_freq=0, write_graph=True,
+    write_images=False, update_freq='epoch',
+    profile_batch=0, embeddings_freq=0, embeddings_metadata=None
 )
 
+# Step timing, queue depth and memory. Profile with `touch PROFILE` or SIGUSR1
+probe = PipelineProbe()
+telcb = Telemetry(f"telemetry{suffix}.jsonl", batchSize, probe=probe, profileDir="./tblogs" + suffix)
+
+# Detection metric on the cached validation set
+dsval = Datapipe(valpath, classNames).create_eval(nx, ny, iw, ih, ic, batchSize, minBoxSize=minBoxSize, sigma=sigma, classAgnostic=classAgnostic)
+mapcb = MAPCallback(dsval, nc, head=model.get_layer("agnostichead") if classAgnostic else None)
+
 estcb = tf.keras.callbacks.EarlyStopping(
-    monitor='val_loss', min_delta=0, patience=10, verbose=0,
-    mode='auto', baseline=None, restore_best_weights=True
+    monitor='val_mAP', min_delta=0, patience=10, verbose=0,
+    mode='max', baseline=None, restore_best_weights=True
 )
 
+# Model, optimizer and input position every checkpointEvery steps
+ckpcb = StepCheckpoint(model, checkpointDir + suffix, everySteps=checkpointEvery, maxToKeep=3)
+
 mcpcb = tf.keras.callbacks.ModelCheckpoint(
-    os.path.join('weights_cpk.h5'), monitor='val_loss', verbose=0, save_best_only=True,
-    save_weights_only=True, mode='auto', save_freq='epoch',
+    os.path.join('weights_cpk.h5'), monitor='val_mAP', verbose=0, save_best_only=True,
+    save_weights_only=True, mode='max', save_freq='epoch',
 )
 
-
-if os.path.isfile('weights_cpk.h5'): 
+step = ckpcb.restore()
+if step == 0 and os.path.isfile('weights_cpk.h5'):
     model.load_weights('weights_cpk.h5')
     print("weights loaded")
 
 
-model.compile(
-    loss=centerNetLoss,
-    optimizer=tf.keras.optimizers.Adam(learnrate)
-)
+# ========= Datapipe =================
+dp = Datapipe(datapath, classNames)
+
+def createDataset(context):
+    # One input pipeline per worker, reading its own shard of the files
+    perReplica = context.get_per_replica_batch_size(globalBatchSize)
+    perPipeline = globalBatchSize // context.num_input_pipelines
+
+    kwargs = dict(
+        nx=nx, ny=ny, iw=iw, ih=ih, ic=ic, batchSize=perReplica, nrepeat=-1, minBoxSize=minBoxSize, sigma=sigma,
+        classAgnostic=classAgnostic, probe=probe, numParallelCalls=numParallelCalls,
+        numShards=context.num_input_pipelines, shardIndex=context.input_pipeline_id,
+    )
+
+    if buckets is not None:
+        return dp.create_bucketed(**kwargs, buckets=buckets, seed=seed)
+
+    if dataService is not None:
+        return dp.create_service(
+            **kwargs, service=dataService, serviceJob=f"centernet_shard{context.input_pipeline_id}", mosaic=mosaic
+        )
+
+    if dedupFile is not None:
+        n, k = context.num_input_pipelines, context.input_pipeline_id
+        files = sorted(dp.filenames)[k::n] if n > 1 else dp.filenames
+        return dp.create_subsampled(**kwargs, subsample=ClusterSubsampler.load(dedupFile, files, seed=seed))
+
+    return dp.create(**kwargs, seed=seed, skip=step*perPipeline*(4 if mosaic else 1), mosaic=mosaic)
+
+g = tf.keras.utils.experimental.DatasetCreator(createDataset)
+nepoch = ClusterSubsampler.load(dedupFile, dp.filenames).epochSize if dedupFile is not None else dp.nd
+stepsPerEpoch = nepoch // (globalBatchSize*(4 if mosaic else 1))
+
+
+callbacks = [tfbcb, telcb, ckpcb, mapcb, mcpcb, estcb]
+
+# A mid-epoch resume first finishes the partial epoch, so epoch ends (and the
+# per-epoch callbacks and the input order of seed+e) stay on the boundaries
+epoch0, done = divmod(step, stepsPerEpoch)
+if done > 0:
+    model.fit(g, epochs=epoch0+1, steps_per_epoch=stepsPerEpoch-done, initial_epoch=epoch0, callbacks=callbacks)
+
+    # createDataset reads the step, the next pipeline starts at the boundary
+    epoch0, step = epoch0+1, (epoch0+1)*stepsPerEpoch
 
 model.fit(
-    g, epochs=300,
-    callbacks = [tfbcb, mcpcb, estcb],
+    g, epochs=300, steps_per_epoch=stepsPerEpoch, initial_epoch=epoch0,
+    callbacks = callbacks,
   #  validation_data=dste
 )
 
-model.save_weights("weights.h5")
+model.save_weights("weights.h5" if isChief else f"/tmp/weights{suffix}.h5")
 
 
 
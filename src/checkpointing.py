@@ -0,0 +1,51 @@
+import tensorflow as tf
+
+
+
+class StepCheckpoint(tf.keras.callbacks.Callback):
+    """Saves model, optimizer and the global step every everySteps batches
+    with a tf.train.CheckpointManager, keeping the last maxToKeep checkpoints.
+
+    Keras fit owns its dataset iterator, so the input position is stored as
+    the global step: a Datapipe created with a seed and skip=step*batchSize
+    continues with exactly the samples that were not yet seen.
+
+    Serialization runs on a background thread (async checkpointing, TF>=2.12);
+    only the copy of the variables to host memory blocks the training step."""
+
+    def __init__(self, model, directory, everySteps=500, maxToKeep=3, async_=True):
+        super(StepCheckpoint, self).__init__()
+
+        self.everySteps = everySteps
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False, name="global_step")
+
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer, step=self.step)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep=maxToKeep)
+        self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=async_)
+
+    # ============================
+    def restore(self):
+        """Restores the latest checkpoint and returns the global step (0 if none)"""
+
+        if self.manager.latest_checkpoint is None:
+            return 0
+
+        # Optimizer slots are restored once they are created by the first step
+        self.checkpoint.restore(self.manager.latest_checkpoint)
+        print(f"Restored {self.manager.latest_checkpoint}")
+
+        return int(self.step.numpy())
+
+    def save(self):
+        self.manager.save(checkpoint_number=self.step, options=self.options)
+
+    # ============================
+    def on_train_batch_end(self, batch, logs=None):
+        self.step.assign_add(1)
+
+        if int(self.step.numpy()) % self.everySteps == 0:
+            self.save()
+
+    def on_train_end(self, logs=None):
+        self.save()
+        self.checkpoint.sync()
@@ -0,0 +1,99 @@
+import json
+
+
+
+# Defaults of the training script centernet.py
+DEFAULTS = {
+    "classNames": ["face", "mask", "dummy"],
+    "datapath": "/data/projects/datasets/hands/train",
+    "ih": 256, "iw": 256, "ic": 3,
+    "nx": 128, "ny": 128,
+    "nfeat": 32,
+    "nfilters": 32,
+    "ndepths": 4,
+    "nstacks": 1,
+    "block": "residual",
+    "widthMultiplier": 1.0,
+    "maxFilters": None,
+    "classAgnostic": False,
+    "batchSize": 10,
+    "learnrate": 1e-5,
+    "sigma": 0.02,
+    "minBoxSize": 6,
+    # Machine specific, written by autotune.py (None keeps the TF defaults)
+    "numParallelCalls": None,
+    "intraOpThreads": None,
+    "interOpThreads": None,
+}
+
+
+# ============================
+def addArguments(parser):
+    """Adds the model and datapipe options to an argparse parser"""
+
+    for key, value in DEFAULTS.items():
+        if isinstance(value, bool):
+            parser.add_argument(f"--{key}", action="store_true", default=value)
+        elif isinstance(value, list):
+            parser.add_argument(f"--{key}", nargs="+", default=value)
+        elif value is None:
+            parser.add_argument(f"--{key}", type=int, default=value)
+        else:
+            parser.add_argument(f"--{key}", type=type(value), default=value)
+
+    return parser
+
+
+# ============================
+def loadConfig(path=None, **overrides):
+    """DEFAULTS updated by a json file and keyword overrides"""
+
+    cfg = dict(DEFAULTS)
+    if path is not None:
+        with open(path, 'r') as f:
+            cfg.update(json.load(f))
+    cfg.update(overrides)
+
+    return cfg
+
+
+# ============================
+def applyThreads(cfg):
+    """Sets the intra/inter-op thread pools of a config. Must run before
+    TensorFlow executes any op"""
+
+    cfg = cfg if isinstance(cfg, dict) else vars(cfg)
+
+    import tensorflow as tf
+    if cfg.get("intraOpThreads"):
+        tf.config.threading.set_intra_op_parallelism_threads(cfg["intraOpThreads"])
+    if cfg.get("interOpThreads"):
+        tf.config.threading.set_inter_op_parallelism_threads(cfg["interOpThreads"])
+
+
+# ============================
+def modelKwargs(cfg):
+    """createModel keyword arguments of a config dict or argparse namespace"""
+
+    cfg = cfg if isinstance(cfg, dict) else vars(cfg)
+
+    return dict(
+        nc=len(cfg["classNames"]), ih=cfg["ih"], iw=cfg["iw"], ic=cfg["ic"],
+        nfeat=cfg["nfeat"], nfilters=cfg["nfilters"], ndepths=cfg["ndepths"],
+        classAgnostic=cfg["classAgnostic"], block=cfg["block"],
+        widthMultiplier=cfg["widthMultiplier"], maxFilters=cfg["maxFilters"],
+        nstacks=cfg["nstacks"],
+    )
+
+
+# ============================
+def createKwargs(cfg):
+    """Datapipe.create keyword arguments of a config dict or argparse namespace"""
+
+    cfg = cfg if isinstance(cfg, dict) else vars(cfg)
+
+    return dict(
+        nx=cfg["nx"], ny=cfg["ny"], iw=cfg["iw"], ih=cfg["ih"], ic=cfg["ic"],
+        batchSize=cfg["batchSize"], sigma=cfg["sigma"], minBoxSize=cfg["minBoxSize"],
+        classAgnostic=cfg["classAgnostic"], numParallelCalls=cfg.get("numParallelCalls"),
+    )
@@ -1,17 +1,20 @@
 import os
 import json
-from matplotlib.pyplot import imshow
 import numpy as np
 import tensorflow as tf
+from storage import LocalStorage, openStorage
 
 
 
-def readJsonAnnotation(jsonfile, datapath, classNames, minLength=10):
-    """Read JSON Annotation (PASCAL VOC)"""
-    with open(jsonfile, 'r') as f1:
-        data = json.load(f1)
-
-    imgpath = os.path.join(datapath, data["imagePath"])
+def readJsonAnnotation(jsonfile, datapath, classNames, minLength=10, storage=None):
+    """Read JSON Annotation (PASCAL VOC), through storage if given"""
+    if storage is None:
+        with open(jsonfile, 'r') as f1:
+            data = json.load(f1)
+        imgpath = os.path.join(datapath, data["imagePath"])
+    else:
+        data = json.loads(storage.read(jsonfile))
+        imgpath = storage.join(datapath, data["imagePath"])
 
     size = [data["imageWidth"], data["imageHeight"]]
 
@@ -42,28 +45,77 @@ def readJsonAnnotation(jsonfile, datapath, classNames, minLength=10):
     return imgpath, boxes, labels, size
 
 
+def normalizeImage(img, ih, iw):
+    """Converts a decoded uint8 image to [0,1] and resizes it to the network input"""
+
+    img = tf.image.convert_image_dtype(img, tf.float32)
+    img = tf.image.resize(img, (ih, iw))
+
+    return img
+
+
+def decodeImage(content, ih, iw, ic=3):
+    """Decodes an encoded image and resizes it to the network input [ih,iw,ic] in [0,1]"""
+
+    return normalizeImage(tf.image.decode_jpeg(content, channels=ic), ih, iw)
+
+
+def letterboxImage(img, ih, iw):
+    """Resizes a decoded image to fit [ih,iw] keeping its aspect ratio and
+    pads it centered. Returns the image in [0,1] and the (y,x) scale and
+    offset mapping normalized coordinates into it: p' = p*scale + offset"""
+
+    img = tf.image.convert_image_dtype(img, tf.float32)
+
+    shape = tf.cast(tf.shape(img)[:2], tf.float32)
+    target = tf.constant([ih, iw], dtype=tf.float32)
+
+    size = tf.minimum(tf.round(shape*tf.reduce_min(target/shape)), target)
+    pad = tf.floor(0.5*(target - size))
+
+    img = tf.image.resize(img, tf.cast(size, tf.int32))
+    img = tf.image.pad_to_bounding_box(img, tf.cast(pad[0], tf.int32), tf.cast(pad[1], tf.int32), ih, iw)
+
+    return img, size/target, pad/target
+
+
+# Aspect ratio buckets (H,W) of about 256x256 pixels, multiples of 32
+BUCKETS = [(256, 256), (224, 288), (192, 352), (288, 224), (352, 192)]
+
+
+def chooseBucket(w, h, buckets=BUCKETS):
+    """Index of the bucket closest in log aspect ratio to a w x h image"""
+    return int(np.argmin([abs(np.log(w/h) - np.log(bw/bh)) for bh, bw in buckets]))
+
+
+def findFiles(datapath, extensions=(".json",)):
+    """All files below datapath ending with one of extensions, in os.walk order"""
+    filenames = []
+    for root, dirs, files in os.walk(datapath):
+        for file in files:
+            if file.endswith(extensions):
+                filenames.append(os.path.join(root, file))
+    return filenames
+
+
 
 
 class Datapipe:
-    def __init__(self, datapath, classNames=[]):
+    def __init__(self, datapath, classNames=[], storage=None):
 
 
-        # Path where annotation jsons reside
+        # Path where annotation jsons reside, a local path or an s3:// URL
         self.datapath = datapath
         self.classNames = classNames
+        self.storage = storage if storage is not None else openStorage(datapath)
 
-        # Find all json files in datapath
-        self.filenames = self.getFileNames(datapath)
+        # Find all json files in datapath (None for pipelines over arrays)
+        self.filenames = self.getFileNames(datapath) if datapath is not None else []
 
   
     # ============================
     def getFileNames(self, datapath):
-        filenames = []
-        for root, dirs, files in os.walk(datapath):
-            for file in files:
-                if file.endswith(".json"):
-                     filenames.append(os.path.join(root, file))
-        return filenames
+        return self.storage.list(datapath, (".json",))
 
 
     # ============================
@@ -83,32 +135,48 @@ class Datapipe:
 
     # ============================
     def create(self, nx, ny, iw, ih, ic, batchSize, sigma=0.02,
-               shuffle_buffer_size=5000, nrepeat=1, minBoxSize=6):
+               shuffle_buffer_size=5000, nrepeat=1, minBoxSize=6, classAgnostic=False, returnKeys=False, seed=None, skip=0, probe=None,
+               numShards=1, shardIndex=0, mosaic=False, numParallelCalls=None):
 
-        """Creates the datapipe"""
+        """Creates the datapipe. With a seed the sample order is reproducible
+        and the first skip samples are dropped before any decoding (resuming,
+        nrepeat<0 repeats forever). returnKeys passes the annotation file
+        along as sample key, mosaic tiles four images per sample (see
+        _processMosaic). See _shardFiles for numShards and _finish for probe"""
 
-        self.nx = nx
-        self.ny = ny
-        self.iw = iw
-        self.ih = ih
-        self.ic = ic
-        self.minBoxSize = minBoxSize
-        self.sigma = sigma 
+        filenames = self._shardFiles(nx, ny, iw, ih, ic, minBoxSize, sigma, numShards, shardIndex)
+        nd = len(filenames)
 
         # Let's build the pipeline
-        dataset = tf.data.Dataset.from_tensor_slices(self.filenames)
-
-        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
-        dataset = dataset.repeat(nrepeat)
+        dataset = tf.data.Dataset.from_tensor_slices(filenames)
+
+        if seed is None:
+            dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+            dataset = dataset.repeat(nrepeat)
+        else:
+            # Epoch e is shuffled with seed+e
+            files = dataset
+            epoch0 = skip // nd
+            epochs = tf.data.Dataset.range(epoch0, epoch0+nrepeat if nrepeat > 0 else 2**62)
+            dataset = epochs.flat_map(
+                lambda e: files.shuffle(buffer_size=shuffle_buffer_size, seed=seed+e, reshuffle_each_iteration=False)
+            )
+            dataset = dataset.skip(skip % nd)
 
         # Load the Json
-        dataset = dataset.map(self._loadJson)
+        dataset = self._prefetchFiles(dataset)
+        dataset = dataset.map(self._loadJson, num_parallel_calls=numParallelCalls)
 
         # Load the image
         # dataset = dataset.map(self._processLoadImagePatchWise)
-        dataset = dataset.map(self._processLoadImage)
-
-        dataset = dataset.map(self._gaussianLabel)
+        dataset = self._loadImages(dataset, mosaic, numParallelCalls)
+
+        label = self._gaussianLabelAgnostic if classAgnostic else self._gaussianLabel
+        if returnKeys:
+            dataset = dataset.map(lambda img, boxes, labels, jsonfile: (*label(img, boxes, labels, jsonfile), jsonfile),
+                                  num_parallel_calls=numParallelCalls)
+        else:
+            dataset = dataset.map(label, num_parallel_calls=numParallelCalls)
         # Augment the image
         # if True:
         #     dataset = dataset.map(self._processAddNoise)
@@ -133,11 +201,376 @@ class Datapipe:
         # Apply batching
         dataset = dataset.batch(batchSize)
 
+        return self._finish(dataset, probe, numShards)
+
+    # ============================
+    def create_service(self, nx, ny, iw, ih, ic, batchSize, service, serviceJob=None, sigma=0.02,
+                       shuffle_buffer_size=5000, nrepeat=1, minBoxSize=6, classAgnostic=False, probe=None,
+                       numShards=1, shardIndex=0, mosaic=False, numParallelCalls=None):
+
+        """create with the decoding, labelling and batching on the workers of
+        a tf.data service dispatcher ("grpc://host:port"), which are handed
+        the files dynamically. The order is not reproducible. Trainers passing
+        the same serviceJob share one stream of batches"""
+
+        if not isinstance(self.storage, LocalStorage):
+            raise ValueError("A data service can only read from local storage")
+
+        filenames = self._shardFiles(nx, ny, iw, ih, ic, minBoxSize, sigma, numShards, shardIndex)
+
+        # Service workers cannot run the py_function of _loadJson, so the
+        # annotations are read up front
+        dataset = tf.data.Dataset.from_tensor_slices(self._readAnnotations(filenames))
+        dataset = dataset.shuffle(buffer_size=shuffle_buffer_size)
+        dataset = dataset.repeat(nrepeat)
+
+        dataset = self._loadImages(dataset, mosaic, numParallelCalls)
+        dataset = dataset.map(self._gaussianLabelAgnostic if classAgnostic else self._gaussianLabel,
+                              num_parallel_calls=numParallelCalls)
+        dataset = dataset.batch(batchSize)
+
+        dataset = dataset.apply(tf.data.experimental.service.distribute(
+            processing_mode=tf.data.experimental.service.ShardingPolicy.DYNAMIC,
+            service=service, job_name=serviceJob,
+        ))
+
+        return self._finish(dataset, probe, numShards)
+
+    # ============================
+    def create_sampled(self, nx, ny, iw, ih, ic, batchSize, sampler, sigma=0.02, nrepeat=1, minBoxSize=6,
+                       classAgnostic=False, probe=None, numShards=1, shardIndex=0, numParallelCalls=None):
+
+        """create with the epochs drawn by a sampler.PrioritySampler over the
+        files instead of the shuffle. Samples are (img, y, index, weight)"""
+
+        filenames = self._shardFiles(nx, ny, iw, ih, ic, minBoxSize, sigma, numShards, shardIndex)
+
+        indices = tf.data.Dataset.from_generator(
+            lambda: sampler.stream(nrepeat),
+            output_signature=(tf.TensorSpec([], tf.int64), tf.TensorSpec([], tf.float32))
+        )
+        dataset = indices.map(lambda index, weight: (tf.gather(tf.constant(filenames), index), index, weight))
+
+        # (index, weight) are carried past the per-file stages
+        def stage(fn):
+            def carry(sample, index, weight):
+                return (fn(*sample) if isinstance(sample, tuple) else fn(sample)), index, weight
+            return carry
+
+        dataset = self._prefetchFiles(dataset, stage)
+        dataset = dataset.map(stage(self._loadJson), num_parallel_calls=numParallelCalls)
+        dataset = dataset.map(stage(self._processLoadImage), num_parallel_calls=numParallelCalls)
+
+        label = self._gaussianLabelAgnostic if classAgnostic else self._gaussianLabel
+        dataset = dataset.map(lambda sample, index, weight: (*label(*sample), index, weight),
+                              num_parallel_calls=numParallelCalls)
+        dataset = dataset.batch(batchSize)
+
+        return self._finish(dataset, probe, numShards)
+
+    # ============================
+    def create_subsampled(self, nx, ny, iw, ih, ic, batchSize, subsample, sigma=0.02, nrepeat=1, minBoxSize=6,
+                          classAgnostic=False, probe=None, numShards=1, shardIndex=0, numParallelCalls=None):
+
+        """create with the epochs drawn from the near-duplicate clusters of a
+        dedup.ClusterSubsampler (subsample.epochSize samples per epoch)"""
+
+        filenames = self._shardFiles(nx, ny, iw, ih, ic, minBoxSize, sigma, numShards, shardIndex)
+
+        indices = tf.data.Dataset.from_generator(
+            lambda: subsample.stream(nrepeat), output_signature=tf.TensorSpec([], tf.int64)
+        )
+        dataset = indices.map(lambda index: tf.gather(tf.constant(filenames), index))
+
+        dataset = self._prefetchFiles(dataset)
+        dataset = dataset.map(self._loadJson, num_parallel_calls=numParallelCalls)
+        dataset = dataset.map(self._processLoadImage, num_parallel_calls=numParallelCalls)
+        dataset = dataset.map(self._gaussianLabelAgnostic if classAgnostic else self._gaussianLabel,
+                              num_parallel_calls=numParallelCalls)
+        dataset = dataset.batch(batchSize)
+
+        return self._finish(dataset, probe, numShards)
+
+    # ============================
+    def create_bucketed(self, nx, ny, iw, ih, ic, batchSize, buckets, sigma=0.02, shuffle_buffer_size=5000,
+                        nrepeat=1, minBoxSize=6, classAgnostic=False, seed=None, probe=None,
+                        numShards=1, shardIndex=0, numParallelCalls=None):
+
+        """create with every image letterboxed to the (H,W) bucket closest to
+        its aspect ratio (e.g. BUCKETS) instead of being stretched to ih x iw.
+        One pipeline per bucket with static shapes, so the model traces one
+        graph per bucket. The target grid of a bucket keeps the ny/ih and
+        nx/iw ratio. Batches are drawn from the buckets in proportion to
+        their number of images"""
+
+        filenames = self._shardFiles(nx, ny, iw, ih, ic, minBoxSize, sigma, numShards, shardIndex)
+
+        sizes = self._imageSizes(filenames)
+        assigned = np.asarray([chooseBucket(w, h, buckets) for w, h in sizes], dtype=np.int64)
+
+        label = self._gaussianLabelAgnostic if classAgnostic else self._gaussianLabel
+
+        datasets, counts = [], []
+        for b, (hb, wb) in enumerate(buckets):
+            files = [f for f, a in zip(filenames, assigned) if a == b]
+            if not files:
+                continue
+
+            grid = (hb*self.ny//self.ih, wb*self.nx//self.iw)
+
+            dataset = tf.data.Dataset.from_tensor_slices(files)
+            dataset = dataset.shuffle(buffer_size=min(len(files), shuffle_buffer_size), seed=seed)
+            dataset = dataset.repeat(nrepeat)
+            dataset = self._prefetchFiles(dataset)
+            dataset = dataset.map(self._loadJson, num_parallel_calls=numParallelCalls)
+            dataset = dataset.map(
+                lambda imgpath, boxes, labels, jsonfile, hb=hb, wb=wb: self._processLoadLetterbox(imgpath, boxes, labels, jsonfile, hb, wb),
+                num_parallel_calls=numParallelCalls
+            )
+            dataset = dataset.map(
+                lambda img, boxes, labels, jsonfile, grid=grid: label(img, boxes, labels, jsonfile, grid=grid),
+                num_parallel_calls=numParallelCalls
+            )
+            dataset = dataset.batch(batchSize, drop_remainder=True)
+
+            datasets.append(dataset)
+            counts.append(len(files))
+
+        dataset = tf.data.Dataset.sample_from_datasets(
+            datasets, weights=[c/sum(counts) for c in counts], seed=seed, stop_on_empty_dataset=False
+        )
+
+        return self._finish(dataset, probe, numShards)
+
+    # ============================
+    def _shardFiles(self, nx, ny, iw, ih, ic, minBoxSize, sigma, numShards, shardIndex):
+        """Sets the shapes of the training builders and returns the files of
+        this worker. With numShards > 1 only every numShards-th file of the
+        sorted file list (starting at shardIndex) is read, so data parallel
+        workers see disjoint samples. Files are listed and read through
+        self.storage"""
+
+        self.nx = nx
+        self.ny = ny
+        self.iw = iw
+        self.ih = ih
+        self.ic = ic
+        self.minBoxSize = minBoxSize
+        self.sigma = sigma
+
+        # Split before any decoding
+        filenames = sorted(self.filenames)[shardIndex::numShards] if numShards > 1 else self.filenames
+        if len(filenames) == 0:
+            raise ValueError(f"No annotation files for shard {shardIndex} of {numShards} in {self.datapath}")
+
+        return filenames
+
+    def _loadImages(self, dataset, mosaic, numParallelCalls):
+        """Decodes the images, tiled by four with mosaic"""
+
+        dataset = dataset.map(self._processLoadImage, num_parallel_calls=numParallelCalls)
+
+        if mosaic:
+            dataset = dataset.map(lambda img, boxes, labels, jsonfile: (
+                img, tf.reshape(boxes, (-1, 4)), tf.reshape(labels, (-1,)), jsonfile
+            ))
+            dataset = dataset.padded_batch(
+                4, drop_remainder=True,
+                padding_values=(tf.constant(0.0), tf.constant(0.0), tf.constant(-1, tf.int32), tf.constant(""))
+            )
+            dataset = dataset.map(self._processMosaic, num_parallel_calls=numParallelCalls)
+
+        return dataset
+
+    def _finish(self, dataset, probe, numShards):
+        """A telemetry.PipelineProbe marks every batch leaving the pipeline"""
+
+        if probe is not None:
+            dataset = dataset.map(probe.mark)
+
         # Prefetching
-      #  dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        if numShards > 1:
+            # Already sharded, tf.distribute must not shard again
+            options = tf.data.Options()
+            options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+            dataset = dataset.with_options(options)
+
+        return dataset
+
+
+    # ============================
+    def create_eval(self, nx, ny, iw, ih, ic, batchSize, sigma=0.02, minBoxSize=6,
+                    maxBoxes=100, classAgnostic=False, cache=True):
+
+        """Creates the deterministic, non-augmented validation datapipe yielding
+        (img, y, boxes, labels) with the raw boxes [maxBoxes,4] (X1,Y1,X2,Y2)
+        and labels [maxBoxes] padded with -1. It is cached in RAM after the
+        first pass"""
+
+        self.nx = nx
+        self.ny = ny
+        self.iw = iw
+        self.ih = ih
+        self.ic = ic
+        self.minBoxSize = minBoxSize
+        self.sigma = sigma
+
+        label = self._gaussianLabelAgnostic if classAgnostic else self._gaussianLabel
+
+        def labelAndPad(img, boxes, labels, jsonfile):
+            img, y = label(img, boxes, labels, jsonfile)
+            return (img, y, *self._padBoxes(boxes, labels, maxBoxes))
+
+        dataset = tf.data.Dataset.from_tensor_slices(sorted(self.filenames))
+        dataset = dataset.map(self._loadJson, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        dataset = dataset.map(self._processLoadImage, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        dataset = dataset.map(labelAndPad, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+        if cache:
+            dataset = dataset.cache()
+
+        dataset = dataset.batch(batchSize)
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+        return dataset
+
+    # ============================
+    def create_raw(self, iw, ih, ic, batchSize, minBoxSize=6, maxBoxes=100):
+
+        """Decoded and resized images as uint8 with their boxes [maxBoxes,4]
+        and labels [maxBoxes] (padded with -1), in sorted file order. Used to
+        decode a dataset once into arrays for create_from_arrays"""
+
+        self.iw = iw
+        self.ih = ih
+        self.ic = ic
+        self.minBoxSize = minBoxSize
+
+        def toArrays(img, boxes, labels, jsonfile):
+            img = tf.image.convert_image_dtype(img, tf.uint8, saturate=True)
+            return (img, *self._padBoxes(boxes, labels, maxBoxes))
+
+        dataset = tf.data.Dataset.from_tensor_slices(sorted(self.filenames))
+        dataset = dataset.map(self._loadJson, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        dataset = dataset.map(self._processLoadImage, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        dataset = dataset.map(toArrays, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        dataset = dataset.batch(batchSize)
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+        return dataset
+
+    # ============================
+    def create_from_arrays(self, images, boxes, labels, nx, ny, batchSize, sigma=0.02, minBoxSize=6,
+                           classAgnostic=False, shuffle_buffer_size=5000, nrepeat=-1, seed=None, evaluation=False):
+
+        """Training datapipe over arrays written from create_raw: images
+        [N,ih,iw,ic] uint8, boxes [N,maxBoxes,4] and labels [N,maxBoxes].
+        They may be memory maps shared by several processes; only the
+        sampled rows are read. With evaluation the order is fixed and samples
+        are (img, y, boxes, labels) as in create_eval"""
+
+        N, ih, iw, ic = images.shape
+        maxBoxes = boxes.shape[1]
+
+        self.nx = nx
+        self.ny = ny
+        self.iw = iw
+        self.ih = ih
+        self.ic = ic
+        self.minBoxSize = minBoxSize
+        self.sigma = sigma
+
+        def read(k):
+            return images[k], boxes[k], labels[k]
+
+        def load(k):
+            img, b, l = tf.numpy_function(read, [k], [tf.as_dtype(images.dtype), tf.float32, tf.int32])
+            img = tf.image.convert_image_dtype(tf.ensure_shape(img, (ih, iw, ic)), tf.float32)
+            b = tf.ensure_shape(b, (maxBoxes, 4))
+            l = tf.ensure_shape(l, (maxBoxes,))
+            keep = l >= 0
+            return img, tf.boolean_mask(b, keep), tf.boolean_mask(l, keep), tf.strings.as_string(k)
+
+        label = self._gaussianLabelAgnostic if classAgnostic else self._gaussianLabel
+
+        dataset = tf.data.Dataset.range(N)
+        if evaluation:
+            dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+            dataset = dataset.map(
+                lambda img, b, l, key: (*label(img, b, l, key), *self._padBoxes(b, l, maxBoxes)),
+                num_parallel_calls=tf.data.AUTOTUNE, deterministic=True
+            )
+        else:
+            dataset = dataset.shuffle(buffer_size=min(N, shuffle_buffer_size), seed=seed)
+            dataset = dataset.repeat(nrepeat)
+            dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE)
+            dataset = dataset.map(label, num_parallel_calls=tf.data.AUTOTUNE)
+
+        dataset = dataset.batch(batchSize)
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
 
         return dataset
 
+    # ============================
+    def _padBoxes(self, boxes, labels, maxBoxes):
+
+        boxes = tf.reshape(boxes, (-1, 4))[:maxBoxes]
+        labels = tf.reshape(labels, (-1,))[:maxBoxes]
+        n = tf.shape(boxes)[0]
+
+        boxes = tf.pad(boxes, [[0, maxBoxes-n], [0, 0]])
+        labels = tf.pad(labels, [[0, maxBoxes-n]], constant_values=-1)
+
+        return tf.ensure_shape(boxes, (maxBoxes, 4)), tf.ensure_shape(labels, (maxBoxes,))
+
+
+    # ============================
+    def _imageSizes(self, filenames):
+        """(width, height) of the images of annotation files"""
+
+        # Keep prefetchDepth files in flight ahead of the reads
+        depth = self.storage.prefetchDepth
+        for jsonfile in filenames[:depth]:
+            self.storage.prefetch(jsonfile)
+
+        sizes = []
+        for k, jsonfile in enumerate(filenames):
+            if k + depth < len(filenames):
+                self.storage.prefetch(filenames[k + depth])
+            data = json.loads(self.storage.read(jsonfile))
+            sizes.append((data["imageWidth"], data["imageHeight"]))
+
+        return sizes
+
+    # ============================
+    def _processLoadLetterbox(self, imgpath, boxes, labels, jsonfile, ih, iw):
+
+        img, scale, offset = letterboxImage(tf.image.decode_jpeg(self.storage.readOp(imgpath), channels=self.ic), ih, iw)
+
+        # Boxes are (X1,Y1,X2,Y2), scale and offset (y,x)
+        boxes = boxes*tf.tile(scale[::-1], [2]) + tf.tile(offset[::-1], [2])
+
+        return img, boxes, labels, jsonfile
+
+    # ============================
+    def _readAnnotations(self, filenames):
+        """Image paths, boxes [n,None,4] and labels [n,None] (ragged) of all
+        annotation files, for pipelines without py_function"""
+
+        imgpaths, boxes, labels = [], [], []
+        for jsonfile in filenames:
+            imgpath, b, l, _ = readJsonAnnotation(jsonfile, self.datapath, self.classNames, self.minBoxSize, self.storage)
+            imgpaths.append(imgpath)
+            boxes.append(np.asarray(b, dtype=np.float32).reshape(-1, 4))
+            labels.append(np.asarray(l, dtype=np.int32))
+
+        lengths = [len(l) for l in labels]
+        boxes = tf.RaggedTensor.from_row_lengths(np.concatenate(boxes) if boxes else np.zeros((0, 4), np.float32), lengths)
+        labels = tf.RaggedTensor.from_row_lengths(np.concatenate(labels) if labels else np.zeros(0, np.int32), lengths)
+
+        return tf.constant(imgpaths), boxes, labels, tf.constant(filenames)
 
     # ============================
     def _loadJson(self, jsonfile):
@@ -147,7 +580,8 @@ class Datapipe:
                 jsonfile=content.numpy().decode("utf-8"),
                 datapath=self.datapath,
                 classNames=self.classNames,
-                minLength=self.minBoxSize
+                minLength=self.minBoxSize,
+                storage=self.storage
             )
             return imgpath, boxes, labels, size
 
@@ -157,16 +591,36 @@ class Datapipe:
 
         return imgpath, boxes, labels, jsonfile
 
+    # ============================
+    def _prefetchFiles(self, dataset, stage=lambda fn: fn):
+        """Hands the annotation files (and then their images) to the storage
+        while they are still ahead of the load stages. The prefetch buffer
+        bounds how far ahead, the storage's pool how many are in flight"""
+
+        if not self.storage.prefetchDepth:
+            return dataset
+
+        imageKeys = lambda content: [self.storage.join(self.datapath, json.loads(content)["imagePath"])]
+
+        def hint(jsonfile):
+            self.storage.prefetch(jsonfile.decode("utf-8"), then=imageKeys)
+            return np.bool_(True)
+
+        def prefetch(jsonfile):
+            done = tf.numpy_function(hint, [jsonfile], tf.bool)
+            with tf.control_dependencies([done]):
+                return tf.identity(jsonfile)
+
+        # Every file brings its image along
+        return dataset.map(stage(prefetch)).prefetch(max(1, self.storage.prefetchDepth // 2))
+
     # ============================
     def _processLoadImage(self, imgpath, boxes, labels, jsonfile):
 
         ih, iw = self.ih, self.iw
         ic = self.ic
 
-        img = tf.io.read_file(imgpath)
-        img = tf.image.decode_jpeg(img, channels=ic)
-        img = tf.image.convert_image_dtype(img, tf.float32)
-        img = tf.image.resize(img, (ih, iw))
+        img = decodeImage(self.storage.readOp(imgpath), ih, iw, ic)
 
         return img, boxes, labels, jsonfile
 
@@ -180,7 +634,7 @@ class Datapipe:
         ic = self.ic
 
         # Load original image
-        img = tf.io.read_file(imgpath)
+        img = self.storage.readOp(imgpath)
         img = tf.image.decode_jpeg(img, channels=ic)
         img = tf.image.convert_image_dtype(img, tf.float32)
         img = tf.image.resize(img, (py * ih, px * iw))
@@ -420,21 +874,52 @@ class Datapipe:
 
 
     # ============================
-    def _gaussianLabel(self, img, boxes, labels, jsonfile):
-        """Returns Gaussian Heatmap
-        """
+    def _processMosaic(self, imgs, boxes, labels, jsonfiles):
+        """Tiles four images [4,ih,iw,ic] into one 2x2 mosaic of the input
+        size. boxes [4,M,4] and labels [4,M] are padded with label -1. The
+        boxes are moved into their quadrant and dropped when smaller than
+        minBoxSize pixels of the network input"""
 
-        N = tf.shape(boxes)[0]
+        ih, iw = self.ih, self.iw
 
-        # ===========================
-        # Calculate class score [N,C]
-        classScore = tf.one_hot(labels, depth=self.nc)
+        # Quadrants: top left, top right, bottom left, bottom right
+        tiles = tf.image.resize(imgs, (ih//2, iw//2))
+        img = tf.concat([
+            tf.concat([tiles[0], tiles[1]], axis=1),
+            tf.concat([tiles[2], tiles[3]], axis=1),
+        ], axis=0)
+
+        if ih % 2 or iw % 2:
+            img = tf.image.resize(img, (ih, iw))
+
+        # (X1,Y1,X2,Y2) offset of each quadrant
+        offset = tf.constant([
+            [0.0, 0.0, 0.0, 0.0],
+            [0.5, 0.0, 0.5, 0.0],
+            [0.0, 0.5, 0.0, 0.5],
+            [0.5, 0.5, 0.5, 0.5],
+        ])
+        boxes = 0.5*boxes + offset[:, None, :]
+
+        wh = tf.maximum(boxes[..., 2:] - boxes[..., :2], 0.0)
+        size = tf.sqrt(iw*ih*wh[..., 0]*wh[..., 1])
+        keep = (labels >= 0) & (size >= self.minBoxSize)
+
+        return img, tf.boolean_mask(boxes, keep), tf.boolean_mask(labels, keep), tf.strings.reduce_join(jsonfiles, separator="|")
+
+    # ============================
+    def _encodeCenters(self, boxes, grid=None):
+        """Returns per object Gaussian kernels [H,W,N] and the box size,
+        position correction and index maps. grid is (H,W), default (ny,nx)"""
+
+        N = tf.shape(boxes)[0]
+        H, W = grid if grid is not None else (self.ny, self.nx)
 
         # ===========================
         # KEYPOINTS
         # ===========================
         # Grid dimensions
-        G = tf.expand_dims(tf.constant([self.ny-1, self.nx-1], dtype=tf.float32),0)
+        G = tf.expand_dims(tf.constant([H-1, W-1], dtype=tf.float32),0)
 
         # Calculate box centroids and best matching cell (ixyc) [N,2]
         p = tf.transpose(tf.stack((
@@ -450,7 +935,7 @@ class Datapipe:
         # HEATMAP
         # ===========================
         # Calculate mesh  [H,W,1,2]
-        axx, ayy = tf.meshgrid( tf.linspace(0,1,self.ny), tf.linspace(0,1,self.nx))
+        axx, ayy = tf.meshgrid( tf.linspace(0,1,W), tf.linspace(0,1,H))
         ax = tf.stack([ayy,axx], axis=-1)
         ax = tf.expand_dims(tf.cast(ax, tf.float32),-2)
 
@@ -462,9 +947,6 @@ class Datapipe:
                 2)/tf.pow(self.sigma, 2)), axis=-1)
         )
 
-        # Class correction [H,W,N] x [N,C] = [H,W,C]
-        hm = tf.matmul(hm, classScore)
-
         # ===========================
         # OBJECTSIZE & Correct position
         # ===========================
@@ -477,7 +959,7 @@ class Datapipe:
         wh = tf.scatter_nd(
           indices=inds,
           updates=wh,
-          shape=(self.nx,self.ny,2)
+          shape=(H,W,2)
         )
    
         # position correction [N,2]
@@ -486,29 +968,68 @@ class Datapipe:
         pdelta = tf.scatter_nd(
           indices=inds,
           updates=pdelta,
-          shape=(self.nx,self.ny,2)
+          shape=(H,W,2)
         )
 
         # Index heatmap
         idx = tf.scatter_nd(
           indices=inds,
           updates=tf.ones(shape=(N,1)),
-          shape=(self.nx,self.ny,1)
+          shape=(H,W,1)
         )
 
+        return hm, wh, pdelta, idx, inds
+
+    # ============================
+    def _gaussianLabel(self, img, boxes, labels, jsonfile, grid=None):
+        """Returns Gaussian Heatmap
+        """
+
+        # ===========================
+        # Calculate class score [N,C]
+        classScore = tf.one_hot(labels, depth=self.nc)
+
+        hm, wh, pdelta, idx, _ = self._encodeCenters(boxes, grid)
+
+        # Class correction [H,W,N] x [N,C] = [H,W,C]
+        hm = tf.matmul(hm, classScore)
+
         # Concat results
         y = tf.concat((hm, wh, pdelta, idx), axis=-1)
    
         return img, y
 
     # ============================
+    def _gaussianLabelAgnostic(self, img, boxes, labels, jsonfile, grid=None):
+        """Returns a single objectness heatmap and the class index map,
+        independent of the number of classes
+        """
 
+        hm, wh, pdelta, idx, inds = self._encodeCenters(boxes, grid)
 
-def postprocess(ylabel, pool_size=3, K=50):
+        # Objectness [H,W,N] -> [H,W,1]. Padding keeps it defined for N=0
+        hm = tf.reduce_max(tf.pad(hm, [[0,0],[0,0],[1,0]]), axis=-1, keepdims=True)
+
+        # Class index at the center cells [H,W,1]. Colliding centers keep one label
+        cls = tf.tensor_scatter_nd_max(
+          tf.zeros_like(idx),
+          indices=inds,
+          updates=tf.expand_dims(tf.cast(labels, tf.float32), -1),
+        )
+
+        # Concat results
+        y = tf.concat((hm, wh, pdelta, idx, cls), axis=-1)
+
+        return img, y
+
+    # ============================
 
 
-    B, H, W, K = ylabel.shape
-    C = K - 5
+def postprocess(ylabel, pool_size=3, K=50):
+    """Top K boxes [B,K,4] (Y1,X1,Y2,X2) of a target ylabel and its peak heatmap"""
+
+    B, H, W, nchannels = ylabel.shape
+    C = nchannels - 5
 
     # [B,H,W,C], [B,H,W,2], [B,H,W,2], [B,H,W,1]
     hm, wh, pdelta, inds = tf.split(ylabel, [C, 2, 2, 1], axis=-1)
@@ -523,7 +1044,7 @@ def postprocess(ylabel, pool_size=3, K=50):
 
     # All boxcoordinates
     # Grid [1,H,W,2]
-    axx, ayy = tf.meshgrid( tf.linspace(0,1,H), tf.linspace(0,1,W))
+    axx, ayy = tf.meshgrid( tf.linspace(0,1,W), tf.linspace(0,1,H))
     ax = tf.stack([ayy,axx], axis=-1)
     ax = tf.expand_dims(tf.cast(ax, tf.float32),0)
 
@@ -552,26 +1073,10 @@ def postprocess(ylabel, pool_size=3, K=50):
     score = tf.reshape(hm, shape=(B, -1))
 
     inds = tf.argsort(score, axis=1, direction='DESCENDING')
-    inds = tf.slice(inds, [0, 0], [1, K]) 
-
-    wh_ = tf.tile(tf.expand_dims(wh, -2), [1,1,1,C,1] )
-    wh_ = tf.reshape(wh_, shape=(B, -1, 2))
-    wh_ = tf.gather(params=wh_, indices=inds, batch_dims=1)
-
-    pdelta_ = tf.tile(tf.expand_dims(pdelta, -2), [1,1,1,C,1] )
-    pdelta_ = tf.reshape(pdelta_, shape=(B, -1, 2))
-    pdelta_ = tf.gather(params=pdelta_, indices=inds, batch_dims=1)
+    inds = inds[:, :K]
 
-
-    score = tf.gather(params=score, indices=inds, batch_dims=1)
     byxc = tf.gather(params=byxc, indices=inds, batch_dims=1)
 
-    print("SCORE:", score)
-    print(wh_)
-    print(pdelta_)
-
-    print(byxc)
-
 
     return byxc, hm
 
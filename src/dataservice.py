@@ -0,0 +1,86 @@
+import sys
+import time
+import argparse
+import subprocess
+import tensorflow as tf
+
+
+
+# ============================
+def runDispatcher(port=5050, workDir=None):
+    """Blocks serving a tf.data service dispatcher. With workDir the
+    dispatcher journals its state and survives restarts"""
+
+    server = tf.data.experimental.service.DispatchServer(
+        tf.data.experimental.service.DispatcherConfig(
+            port=port, work_dir=workDir, fault_tolerant_mode=workDir is not None
+        )
+    )
+    print(f"Dispatcher on {server.target}")
+    server.join()
+
+
+def runWorker(dispatcher, port=0, threads=None):
+    """Blocks serving a tf.data service worker registered at dispatcher
+    (host:port). threads limits the intra-op threads of its pipelines"""
+
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+
+    server = tf.data.experimental.service.WorkerServer(
+        tf.data.experimental.service.WorkerConfig(dispatcher_address=dispatcher, worker_port=port)
+    )
+    print(f"Worker registered at {dispatcher}")
+    server.join()
+
+
+def launchLocal(nworkers, port=5050, threads=None):
+    """Starts a dispatcher and nworkers worker processes on this host and
+    returns the processes. Datapipe.create_service(..., service=f"grpc://localhost:{port}")"""
+
+    procs = [subprocess.Popen([sys.executable, __file__, "dispatcher", "--port", str(port)])]
+    time.sleep(2.0)
+
+    for _ in range(nworkers):
+        command = [sys.executable, __file__, "worker", "--dispatcher", f"localhost:{port}"]
+        if threads:
+            command += ["--threads", str(threads)]
+        procs.append(subprocess.Popen(command))
+
+    return procs
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="tf.data service processes for Datapipe.create_service")
+    sub = parser.add_subparsers(dest="role", required=True)
+
+    p = sub.add_parser("dispatcher")
+    p.add_argument("--port", type=int, default=5050)
+    p.add_argument("--workDir", default=None)
+
+    p = sub.add_parser("worker")
+    p.add_argument("--dispatcher", required=True, help="host:port of the dispatcher")
+    p.add_argument("--port", type=int, default=0)
+    p.add_argument("--threads", type=int, default=None)
+
+    p = sub.add_parser("local")
+    p.add_argument("--nworkers", type=int, default=2)
+    p.add_argument("--port", type=int, default=5050)
+    p.add_argument("--threads", type=int, default=None)
+
+    args = parser.parse_args()
+
+    if args.role == "dispatcher":
+        runDispatcher(args.port, args.workDir)
+    elif args.role == "worker":
+        runWorker(args.dispatcher, args.port, args.threads)
+    else:
+        procs = launchLocal(args.nworkers, args.port, args.threads)
+        try:
+            for p in procs:
+                p.wait()
+        except KeyboardInterrupt:
+            for p in procs:
+                p.terminate()
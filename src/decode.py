@@ -0,0 +1,87 @@
+import tensorflow as tf
+
+
+
+# ============================
+def _boxesFromPixels(wh, pdelta, pix):
+    """Boxes [B,K,4] (Y1,X1,Y2,X2) at flat pixel indices pix [B,K]"""
+
+    B, H, W = tf.shape(wh)[0], tf.shape(wh)[1], tf.shape(wh)[2]
+
+    # [B,K,2]
+    wh = tf.gather(tf.reshape(wh, (B, -1, 2)), pix, batch_dims=1)
+    pdelta = tf.gather(tf.reshape(pdelta, (B, -1, 2)), pix, batch_dims=1)
+
+    # Cell centers on the [0,1] grid [B,K,2]
+    G = tf.cast(tf.stack([H-1, W-1]), tf.float32)
+    yx = tf.cast(tf.stack([pix // W, pix % W], axis=-1), tf.float32) / G
+
+    return tf.concat([
+            (yx + pdelta) - 0.5*wh,
+            (yx + pdelta) + 0.5*wh,
+        ],
+        axis=-1
+    )
+
+
+# ============================
+def decodePredictions(ypred, nc, K=50):
+    """Top-K detections from the output of CenterNetPostprocessingLayer.
+    Returns boxes [B,K,4], scores [B,K] and classes [B,K]"""
+
+    B = tf.shape(ypred)[0]
+
+    # [B,H,W,C], [B,H,W,2], [B,H,W,2], [B,H,W,C]
+    hm, wh, pdelta, mask = tf.split(ypred, [nc, 2, 2, nc], axis=-1)
+
+    # [B,HWC]
+    score = tf.reshape(hm*mask, (B, -1))
+    score, inds = tf.math.top_k(score, k=K)
+
+    boxes = _boxesFromPixels(wh, pdelta, inds // nc)
+
+    return boxes, score, inds % nc
+
+
+# ============================
+def decodeAgnosticPredictions(ypred, head, K=50):
+    """Top-K detections from the output of CenterNetAgnosticPostprocessingLayer.
+    The classifier only runs on the K peaks. Returns boxes [B,K,4],
+    scores [B,K] and classes [B,K]"""
+
+    B = tf.shape(ypred)[0]
+
+    # [B,H,W,1], [B,H,W,2], [B,H,W,2], [B,H,W,1], [B,H,W,nemb]
+    hm, wh, pdelta, mask, emb = tf.split(ypred, [1, 2, 2, 1, head.nemb], axis=-1)
+
+    # [B,HW]
+    score = tf.reshape(hm*mask, (B, -1))
+    score, pix = tf.math.top_k(score, k=K)
+
+    boxes = _boxesFromPixels(wh, pdelta, pix)
+
+    # Classify the peaks [B,K,C]
+    emb = tf.gather(tf.reshape(emb, (B, -1, head.nemb)), pix, batch_dims=1)
+    prob = tf.math.softmax(head.classify(emb), axis=-1)
+
+    classes = tf.math.argmax(prob, axis=-1, output_type=tf.int32)
+
+    return boxes, score*tf.reduce_max(prob, axis=-1), classes
+
+
+# ============================
+def createPredictor(model, nc, K=50, head=None):
+    """tf.function running model and the top-K decoder on image batches
+    [B,ih,iw,ic] of any batch size. head is the
+    CenterNetAgnosticPostprocessingLayer for class agnostic models"""
+
+    spec = tf.TensorSpec([None] + list(model.inputs[0].shape[1:]), tf.float32)
+
+    @tf.function(input_signature=[spec])
+    def predict(img):
+        ypred = model(img, training=False)
+        if head is not None:
+            return decodeAgnosticPredictions(ypred, head, K)
+        return decodePredictions(ypred, nc, K)
+
+    return predict
@@ -0,0 +1,242 @@
+import os
+import argparse
+import numpy as np
+from datapipe import Datapipe, readJsonAnnotation
+
+
+
+# ============================
+def dctMatrix(n):
+    """Orthonormal DCT-II matrix [n,n]"""
+
+    k = np.arange(n)
+    m = np.cos(np.pi*(2*k[None, :] + 1)*k[:, None]/(2*n)) * np.sqrt(2.0/n)
+    m[0] /= np.sqrt(2.0)
+
+    return m
+
+
+def perceptualHash(gray, hashSize=8):
+    """64 bit pHash of grayscale images [B,32,32]: sign of the low frequency
+    DCT coefficients against their median. Returns uint64 [B]"""
+
+    D = dctMatrix(gray.shape[-1])
+    coeffs = np.einsum("ij,bjk,lk->bil", D, gray, D)[:, :hashSize, :hashSize].reshape(len(gray), -1)
+
+    # The DC coefficient only measures the brightness
+    bits = coeffs > np.median(coeffs[:, 1:], axis=1, keepdims=True)
+
+    return np.packbits(bits, axis=1).view(">u8")[:, 0].astype(np.uint64)
+
+
+# Set bits per byte value
+_POPCOUNT8 = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def popcount(x):
+    """Number of set bits of uint64 values (any shape)"""
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+
+def computeHashes(imgpaths, batchSize=256):
+    """Perceptual hashes of image files, decoded and downscaled by a parallel tf.data pipeline"""
+
+    import tensorflow as tf
+
+    def load(path):
+        img = tf.image.decode_jpeg(tf.io.read_file(path), channels=1)
+        img = tf.image.resize(tf.image.convert_image_dtype(img, tf.float32), (32, 32), antialias=True)
+        return img[..., 0]
+
+    dataset = tf.data.Dataset.from_tensor_slices(list(imgpaths))
+    dataset = dataset.map(load, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    dataset = dataset.batch(batchSize).prefetch(tf.data.AUTOTUNE)
+
+    hashes = [perceptualHash(batch.numpy().astype(np.float64)) for batch in dataset]
+
+    return np.concatenate(hashes) if hashes else np.zeros(0, np.uint64)
+
+
+class HashCache:
+    """Hashes stored in an npz by image path, recomputed when size or mtime changed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+
+        if os.path.isfile(path):
+            data = np.load(path)
+            for p, m, s, h in zip(data["paths"], data["mtimes"], data["sizes"], data["hashes"]):
+                self.entries[str(p)] = (float(m), int(s), np.uint64(h))
+
+    def hashes(self, imgpaths, batchSize=256):
+
+        stats = [os.stat(p) for p in imgpaths]
+        stale = [
+            k for k, (p, st) in enumerate(zip(imgpaths, stats))
+            if self.entries.get(p, (None, None))[:2] != (st.st_mtime, st.st_size)
+        ]
+
+        if stale:
+            for k, h in zip(stale, computeHashes([imgpaths[k] for k in stale], batchSize)):
+                self.entries[imgpaths[k]] = (stats[k].st_mtime, stats[k].st_size, h)
+            self.save()
+
+        return np.asarray([self.entries[p][2] for p in imgpaths], dtype=np.uint64)
+
+    def save(self):
+        paths = list(self.entries)
+        np.savez(
+            self.path + ".tmp.npz",
+            paths=np.asarray(paths),
+            mtimes=np.asarray([self.entries[p][0] for p in paths]),
+            sizes=np.asarray([self.entries[p][1] for p in paths], dtype=np.int64),
+            hashes=np.asarray([self.entries[p][2] for p in paths], dtype=np.uint64),
+        )
+        os.replace(self.path + ".tmp.npz", self.path)
+
+
+# ============================
+def _roots(parent):
+    """Root of every node of a union-find forest (pointer jumping)"""
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent = grand
+
+
+def _link(parent, a, b):
+    """parent with the components of all pairs (a[k], b[k]) merged"""
+
+    parent = _roots(parent)
+    u, v = parent[a], parent[b]
+    keep = u != v
+    u, v = u[keep], v[keep]
+
+    # Every root points to the smallest root it is linked to, until the
+    # pairs agree. Pointers only decrease, so the forest stays acyclic
+    while len(u):
+        m = np.minimum(parent[u], parent[v])
+        np.minimum.at(parent, u, m)
+        np.minimum.at(parent, v, m)
+        parent = _roots(parent)
+
+        keep = parent[u] != parent[v]
+        u, v = u[keep], v[keep]
+
+    return parent
+
+
+def cluster(hashes, maxDistance=4, maxPairs=2**20):
+    """Cluster id per hash, linking hashes within maxDistance bits (single
+    linkage). Multi-index hashing: the 64 bits are split into maxDistance+1
+    bands, two hashes within maxDistance differ in at most maxDistance bands,
+    so they share at least one band exactly. Only hashes in the same band
+    bucket are compared, large buckets (e.g. the frames of a static video
+    shot) in blocks of at most maxPairs pairs"""
+
+    uniq, inverse = np.unique(hashes, return_inverse=True)
+    parent = np.arange(len(uniq))
+
+    bounds = np.linspace(0, 64, maxDistance+2).astype(int)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        key = (uniq >> np.uint64(lo)) & np.uint64((1 << int(hi-lo)) - 1)
+
+        order = np.argsort(key, kind="stable")
+        starts = np.flatnonzero(np.r_[True, key[order][1:] != key[order][:-1]])
+        ends = np.r_[starts[1:], len(order)]
+
+        for s, e in zip(starts, ends):
+            if e - s < 2:
+                continue
+            members = order[s:e]
+
+            # parent is kept compressed, so these are the roots
+            if (parent[members] == parent[members[0]]).all():
+                continue
+
+            rows = max(1, maxPairs // len(members))
+
+            # Rows r0:r1 against the columns from r0 on, upper triangle only
+            for r0 in range(0, len(members), rows):
+                a, b = members[r0:r0+rows], members[r0:]
+                close = popcount(uniq[a][:, None] ^ uniq[b][None, :]) <= maxDistance
+                close &= np.arange(len(b))[None, :] > np.arange(len(a))[:, None]
+
+                i, j = np.nonzero(close)
+                if len(i):
+                    parent = _link(parent, a[i], b[j])
+
+    _, ids = np.unique(_roots(parent), return_inverse=True)
+
+    return ids[inverse]
+
+
+class ClusterSubsampler:
+    """Draws perCluster random members of every near-duplicate cluster per
+    epoch, for Datapipe.create_subsampled. Different members are drawn
+    every epoch, so all images are still visited over time"""
+
+    def __init__(self, clusters, perCluster=1, seed=None):
+        self.perCluster = perCluster
+        self.rng = np.random.default_rng(seed)
+
+        order = np.argsort(clusters, kind="stable")
+        starts = np.flatnonzero(np.r_[True, clusters[order][1:] != clusters[order][:-1]])
+        self.members = np.split(order, starts[1:])
+
+    @classmethod
+    def load(cls, path, filenames, perCluster=1, seed=None):
+        """Clusters written by this script for the files of a Datapipe, files
+        without a cluster are kept as singletons"""
+
+        data = np.load(path)
+        lookup = dict(zip((str(f) for f in data["files"]), data["clusters"]))
+
+        nclusters = int(data["clusters"].max()) + 1 if len(data["clusters"]) else 0
+        clusters = np.asarray([lookup.get(f, -1) for f in filenames], dtype=np.int64)
+        missing = clusters < 0
+        clusters[missing] = nclusters + np.arange(missing.sum())
+
+        return cls(clusters, perCluster, seed)
+
+    @property
+    def epochSize(self):
+        return int(sum(min(len(m), self.perCluster) for m in self.members))
+
+    def epoch(self):
+        picks = [m if len(m) <= self.perCluster else self.rng.choice(m, self.perCluster, replace=False) for m in self.members]
+        indices = np.concatenate(picks)
+        self.rng.shuffle(indices)
+        return indices
+
+    def stream(self, nrepeat=-1):
+        e = 0
+        while nrepeat < 0 or e < nrepeat:
+            for index in self.epoch():
+                yield index
+            e += 1
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Clusters near-duplicate images of a labelme dataset by perceptual hash")
+    parser.add_argument("--datapath", required=True)
+    parser.add_argument("--maxDistance", type=int, default=4, help="maximal Hamming distance of near duplicates")
+    parser.add_argument("--cache", default="phash_cache.npz")
+    parser.add_argument("--out", default="dedup.npz")
+    args = parser.parse_args()
+
+    files = Datapipe(args.datapath).filenames
+    imgpaths = [readJsonAnnotation(f, args.datapath, [])[0] for f in files]
+
+    hashes = HashCache(args.cache).hashes(imgpaths)
+    clusters = cluster(hashes, args.maxDistance)
+
+    np.savez(args.out, files=np.asarray(files), hashes=hashes, clusters=clusters)
+
+    n = int(clusters.max()) + 1 if len(clusters) else 0
+    print(f"{len(files)} images in {n} clusters, epochs with one image per cluster are {n/max(len(files),1):.1%} as long")
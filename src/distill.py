@@ -0,0 +1,162 @@
+import os
+import re
+import argparse
+import numpy as np
+import tensorflow as tf
+from model import createModel, createLoss
+from datapipe import Datapipe
+import config
+
+
+
+# ============================
+def cacheName(jsonfile):
+    """File name of the cached teacher output of one sample"""
+    return re.sub(r"[/\\:]", "_", jsonfile) + ".f16"
+
+
+class TeacherCache:
+    """Teacher heatmap and regression maps stored per sample as raw float16,
+    so the teacher runs once and not once per epoch. The cache assumes the
+    Datapipe targets are deterministic per annotation (no random augmentation)"""
+
+    def __init__(self, cachedir, shape):
+        self.cachedir = cachedir
+        self.shape = shape
+        os.makedirs(cachedir, exist_ok=True)
+
+    def fill(self, teacher, dataset, nchannels):
+        """Runs the teacher over a keyed dataset (img, y, jsonfile), skipping
+        samples that are already cached"""
+
+        ctr = 0
+        for img, _, keys in dataset:
+            keys = [k.decode("utf-8") for k in keys.numpy()]
+            paths = [os.path.join(self.cachedir, cacheName(k)) for k in keys]
+            if all(os.path.isfile(p) for p in paths):
+                continue
+
+            ypred = teacher(img, training=False)[..., :nchannels].numpy().astype(np.float16)
+            for path, y in zip(paths, ypred):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(y.tobytes())
+                os.replace(path + ".tmp", path)
+            ctr += len(keys)
+
+        print(f"Teacher outputs cached for {ctr} new samples")
+
+    def lookup(self, img, y, jsonfile):
+        """Dataset map appending the cached teacher output"""
+
+        path = tf.strings.join([self.cachedir, "/", tf.strings.regex_replace(jsonfile, r"[/\\:]", "_"), ".f16"])
+        yteacher = tf.io.decode_raw(tf.io.read_file(path), tf.float16)
+        yteacher = tf.cast(tf.reshape(yteacher, self.shape), tf.float32)
+
+        return img, y, yteacher
+
+
+class Distiller(tf.keras.Model):
+    """Trains student on the ground truth and on the outputs of a frozen teacher.
+    Batches are either (img, y), then the teacher runs inline, or
+    (img, y, yteacher) with cached teacher outputs"""
+
+    def __init__(self, student, teacher, nh, alpha=0.5, regWeight=1.0, **kwargs):
+        super(Distiller, self).__init__(**kwargs)
+
+        self.student = student
+        self.teacher = teacher
+        self.teacher.trainable = False
+
+        # Heatmap channels (nc, or 1 for the class agnostic head)
+        self.nh = nh
+        self.alpha = alpha
+        self.regWeight = regWeight
+
+    def compile(self, optimizer, gtLoss, **kwargs):
+        super(Distiller, self).compile(optimizer=optimizer, **kwargs)
+        self.gtLoss = gtLoss
+
+    def call(self, x, training=False):
+        return self.student(x, training=training)
+
+    def distillLoss(self, yteacher, ystudent):
+        """Heatmap cross entropy plus regression L1 weighted by the teacher heatmap"""
+
+        hmT, whT, pdeltaT = tf.split(yteacher[..., :self.nh+4], [self.nh, 2, 2], axis=-1)
+        hmS, whS, pdeltaS = tf.split(ystudent[..., :self.nh+4], [self.nh, 2, 2], axis=-1)
+
+        lossHm = tf.reduce_mean(tf.keras.losses.binary_crossentropy(hmT, hmS), axis=[1,2])
+
+        w = tf.reduce_max(hmT, axis=-1, keepdims=True)
+        lossReg = tf.reduce_sum(w*(tf.math.abs(whT-whS) + tf.math.abs(pdeltaT-pdeltaS)), axis=[1,2,3])
+        lossReg = lossReg / tf.maximum(tf.reduce_sum(w, axis=[1,2,3]), 1.0)
+
+        return lossHm + self.regWeight*lossReg
+
+    def train_step(self, data):
+
+        if len(data) == 3:
+            x, y, yteacher = data
+        else:
+            x, y = data
+            yteacher = self.teacher(x, training=False)
+
+        with tf.GradientTape() as tape:
+            ypred = self.student(x, training=True)
+            lossGt = tf.reduce_mean(self.gtLoss(y, ypred))
+            lossKd = tf.reduce_mean(self.distillLoss(yteacher, ypred))
+            loss = self.alpha*lossGt + (1.0-self.alpha)*lossKd
+
+        variables = self.student.trainable_variables
+        grads = tape.gradient(loss, variables)
+        self.optimizer.apply_gradients(zip(grads, variables))
+
+        return {"loss": loss, "loss_gt": lossGt, "loss_kd": lossKd}
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Distills a large hourglass teacher into a compact student")
+    config.addArguments(parser)
+    parser.add_argument("--teacherWeights", required=True)
+    parser.add_argument("--teacherNfilters", type=int, default=32)
+    parser.add_argument("--teacherNdepths", type=int, default=4)
+    parser.add_argument("--teacherNstacks", type=int, default=2)
+    parser.add_argument("--alpha", type=float, default=0.5, help="weight of the ground truth loss")
+    parser.add_argument("--cachedir", default=None, help="cache teacher outputs per sample")
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--out", default="student.h5")
+    args = parser.parse_args()
+
+    nc = len(args.classNames)
+    nh = 1 if args.classAgnostic else nc
+
+    student = createModel(**config.modelKwargs(args))
+
+    teacherKwargs = config.modelKwargs(args)
+    teacherKwargs.update(nfilters=args.teacherNfilters, ndepths=args.teacherNdepths, nstacks=args.teacherNstacks,
+                         block="residual", widthMultiplier=1.0, maxFilters=None)
+    teacher = createModel(**teacherKwargs)
+    teacher.load_weights(args.teacherWeights)
+
+    dp = Datapipe(args.datapath, args.classNames)
+
+    if args.cachedir is None:
+        g = dp.create(**config.createKwargs(args))
+    else:
+        cache = TeacherCache(args.cachedir, (args.ny, args.nx, nh+4))
+        keyed = dp.create(**config.createKwargs(args), returnKeys=True)
+        cache.fill(teacher, keyed, nh+4)
+
+        g = keyed.unbatch().map(cache.lookup, num_parallel_calls=tf.data.AUTOTUNE).batch(args.batchSize)
+        g = g.prefetch(tf.data.AUTOTUNE)
+
+    distiller = Distiller(student, teacher, nh, alpha=args.alpha)
+    distiller.compile(
+        optimizer=tf.keras.optimizers.Adam(args.learnrate),
+        gtLoss=createLoss(student, nc, args.classAgnostic),
+    )
+    distiller.fit(g, epochs=args.epochs)
+
+    student.save_weights(args.out)
@@ -0,0 +1,178 @@
+import numpy as np
+import tensorflow as tf
+from decode import createPredictor
+
+
+
+# ============================
+def boxIou(a, b):
+    """Pairwise IoU of boxes a [...,K,4] and b [...,M,4] -> [...,K,M].
+    Both in the same corner convention (X1,Y1,X2,Y2 or Y1,X1,Y2,X2)"""
+
+    a = a[..., :, None, :]
+    b = b[..., None, :, :]
+
+    lt = np.maximum(a[..., :2], b[..., :2])
+    rb = np.minimum(a[..., 2:], b[..., 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=-1)
+
+    area = lambda x: np.prod(np.clip(x[..., 2:] - x[..., :2], 0, None), axis=-1)
+
+    return inter / np.maximum(area(a) + area(b) - inter, 1e-12)
+
+
+class StreamingAP:
+    """COCO-style average precision (101 point interpolation, IoU 0.5:0.95).
+
+    Detections are matched greedily by score to the best unmatched ground
+    truth of the same class per batch, vectorized over images and IoU
+    thresholds. Only scores, classes and true positive flags are kept."""
+
+    def __init__(self, nc, iouThresholds=np.linspace(0.5, 0.95, 10), minScore=0.01):
+        self.nc = nc
+        self.thresholds = np.asarray(iouThresholds)
+        self.minScore = minScore
+        self.reset()
+
+    def reset(self):
+        self.scores, self.classes, self.tps = [], [], []
+        self.npos = np.zeros(self.nc, dtype=np.int64)
+
+    # ============================
+    def update(self, boxes, scores, classes, gtBoxes, gtLabels):
+        """boxes [B,K,4], scores [B,K], classes [B,K], gtBoxes [B,M,4] and
+        gtLabels [B,M] (-1 marks padding)"""
+
+        B, K = scores.shape
+        M = gtLabels.shape[1]
+        T = len(self.thresholds)
+
+        # Highest score first
+        order = np.argsort(-scores, axis=1)
+        boxes = np.take_along_axis(boxes, order[..., None], axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        classes = np.take_along_axis(classes, order, axis=1)
+
+        valid = gtLabels >= 0
+        self.npos += np.bincount(gtLabels[valid], minlength=self.nc)[:self.nc]
+
+        tp = np.zeros((B, K, T), dtype=bool)
+
+        if M > 0:
+            # [B,K,M], -1 where the classes differ
+            iou = boxIou(boxes, gtBoxes)
+            iou = np.where((classes[:, :, None] == gtLabels[:, None, :]) & valid[:, None, :], iou, -1.0)
+
+            matched = np.zeros((B, T, M), dtype=bool)
+            bidx = np.arange(B)[:, None]
+            tidx = np.arange(T)[None, :]
+
+            for k in range(K):
+                # [B,T,M]
+                cand = np.where(matched, -1.0, iou[:, None, k, :])
+                best = np.argmax(cand, axis=-1)
+                hit = np.take_along_axis(cand, best[..., None], axis=-1)[..., 0] >= self.thresholds[None, :]
+
+                tp[:, k, :] = hit
+                matched[bidx, tidx, best] |= hit
+
+        keep = scores > self.minScore
+        self.scores.append(scores[keep])
+        self.classes.append(classes[keep])
+        self.tps.append(tp[keep])
+
+    # ============================
+    def result(self):
+        """mAP, AP50, AP75 and the AP per class (None for classes without ground truth)"""
+
+        scores = np.concatenate(self.scores) if self.scores else np.zeros(0)
+        classes = np.concatenate(self.classes) if self.classes else np.zeros(0, dtype=np.int64)
+        tps = np.concatenate(self.tps) if self.tps else np.zeros((0, len(self.thresholds)), dtype=bool)
+
+        recallPoints = np.linspace(0, 1, 101)
+        ap = np.full((self.nc, len(self.thresholds)), np.nan)
+
+        for c in range(self.nc):
+            if self.npos[c] == 0:
+                continue
+
+            sel = classes == c
+            order = np.argsort(-scores[sel], kind="mergesort")
+            tp = tps[sel][order]
+            n = len(tp)
+
+            if n == 0:
+                ap[c] = 0.0
+                continue
+
+            ctp = np.cumsum(tp, axis=0)
+            cfp = np.cumsum(~tp, axis=0)
+            recall = ctp / self.npos[c]
+            precision = ctp / np.maximum(ctp + cfp, 1)
+
+            # Monotone precision envelope [n,T]
+            precision = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+
+            for t in range(len(self.thresholds)):
+                idx = np.searchsorted(recall[:, t], recallPoints, side="left")
+                ap[c, t] = np.where(idx < n, precision[np.minimum(idx, n-1), t], 0.0).mean()
+
+        seen = self.npos > 0
+        mean = lambda x: float(np.mean(x)) if x.size else 0.0
+
+        return {
+            "mAP": mean(ap[seen]),
+            "AP50": mean(ap[seen, 0]),
+            "AP75": mean(ap[seen, np.argmin(np.abs(self.thresholds - 0.75))]),
+            "APperClass": [float(np.mean(a)) if s else None for a, s in zip(ap, seen)],
+        }
+
+
+# ============================
+def evaluate(model, dataset, nc, K=100, head=None, predict=None):
+    """COCO-style AP of model on a Datapipe.create_eval dataset. head is the
+    CenterNetAgnosticPostprocessingLayer for class agnostic models, predict
+    replaces the default model + decode function (e.g. tta.createTTAPredictor)"""
+
+    metric = StreamingAP(nc)
+    predict = predict or createPredictor(model, nc, K, head)
+
+    for img, _, gtBoxes, gtLabels in dataset:
+        boxes, scores, classes = predict(img)
+
+        # Decoded boxes are (Y1,X1,Y2,X2), annotations (X1,Y1,X2,Y2)
+        metric.update(
+            boxes.numpy()[..., [1, 0, 3, 2]], scores.numpy(), classes.numpy(),
+            gtBoxes.numpy(), gtLabels.numpy()
+        )
+
+    return metric.result()
+
+
+class MAPCallback(tf.keras.callbacks.Callback):
+    """Adds val_mAP, val_AP50 and val_AP75 to the epoch logs. Must come before
+    ModelCheckpoint/EarlyStopping in the callback list to be monitored"""
+
+    def __init__(self, dataset, nc, K=100, head=None, every=1):
+        super(MAPCallback, self).__init__()
+        self.dataset = dataset
+        self.nc = nc
+        self.K = K
+        self.head = head
+        self.every = every
+        self.predict = None
+
+    def set_model(self, model):
+        super(MAPCallback, self).set_model(model)
+        # Traced once, not on every evaluated epoch
+        self.predict = createPredictor(model, self.nc, self.K, self.head)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None or (epoch+1) % self.every != 0:
+            return
+
+        result = evaluate(self.model, self.dataset, self.nc, self.K, self.head, predict=self.predict)
+        for key in ("mAP", "AP50", "AP75"):
+            logs[f"val_{key}"] = result[key]
+
+        print(f" - val_mAP: {result['mAP']:.4f} - val_AP50: {result['AP50']:.4f}")
@@ -0,0 +1,78 @@
+import os
+import json
+import argparse
+import tensorflow as tf
+from model import createModel, weightsIdentity
+from decode import decodePredictions, decodeAgnosticPredictions
+import config
+
+
+
+# ============================
+def bucketName(batchSize, ih, iw):
+    return f"b{batchSize}_{ih}x{iw}"
+
+
+def exportServing(path, weights, batchSizes=(1, 4, 16), shapes=None, K=50, classNames=None, **kwargs):
+    """Writes a SavedModel with one concrete signature (model + top-K decode)
+    per batch size and input shape bucket, plus serving.json describing the
+    buckets and the weights (path and sha256) they came from. kwargs are the createModel arguments, shapes defaults to (ih,iw)"""
+
+    shapes = shapes or [(kwargs["ih"], kwargs["iw"])]
+    ndepths = kwargs.get("ndepths", 4)
+    ic = kwargs.get("ic", 3)
+
+    for ih, iw in shapes:
+        if ih % 2**ndepths or iw % 2**ndepths:
+            raise ValueError(f"Input shape {ih}x{iw} is not divisible by 2**ndepths = {2**ndepths}")
+
+    # The convolutions do not depend on the input size, one model serves all shapes
+    model = createModel(**dict(kwargs, ih=None, iw=None))
+    model.load_weights(weights)
+    head = model.get_layer("agnostichead") if kwargs.get("classAgnostic", False) else None
+
+    # Traced per bucket, so the decoder sees the static map size
+    @tf.function
+    def serve(images):
+        ypred = model(images, training=False)
+        if head is not None:
+            boxes, scores, classes = decodeAgnosticPredictions(ypred, head, K)
+        else:
+            boxes, scores, classes = decodePredictions(ypred, kwargs["nc"], K)
+        return {"boxes": boxes, "scores": scores, "classes": classes}
+
+    buckets, signatures = [], {}
+    for ih, iw in shapes:
+        for b in batchSizes:
+            name = bucketName(b, ih, iw)
+            signatures[name] = serve.get_concrete_function(tf.TensorSpec([b, ih, iw, ic], tf.float32, name="images"))
+            buckets.append({"name": name, "batchSize": b, "ih": ih, "iw": iw, "ic": ic})
+
+    module = tf.Module()
+    module.model = model
+    tf.saved_model.save(module, path, signatures=signatures)
+
+    with open(os.path.join(path, "serving.json"), 'w') as f:
+        json.dump({"buckets": buckets, "K": K, "classNames": classNames, "weights": weightsIdentity(weights)}, f, indent=2)
+
+    return buckets
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Exports a SavedModel with batch and shape bucket signatures")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--out", default="serving")
+    parser.add_argument("--batchSizes", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--shapes", nargs="+", default=None, help="input shapes as HxW, default ih x iw")
+    parser.add_argument("-K", type=int, default=50)
+    args = parser.parse_args()
+
+    shapes = [tuple(int(n) for n in s.split("x")) for s in args.shapes] if args.shapes else None
+
+    buckets = exportServing(
+        args.out, args.weights, args.batchSizes, shapes, args.K, args.classNames, **config.modelKwargs(args)
+    )
+    print(f"Exported {len(buckets)} buckets to {args.out}: {', '.join(b['name'] for b in buckets)}")
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import config
+
+
+
+def _sharedArray(shm, shape, dtype):
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _worker(cfg, weights, K, threads, cores, names, shapes, conn):
+    """Replica process: pins itself to cores, loads the weights once and
+    answers batch requests through its shared memory slots"""
+
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+    # Thread pools must be configured before TensorFlow runs any op
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from model import loadPredictor
+    _, predict = loadPredictor(weights, K=K, **config.modelKwargs(cfg))
+
+    shms = [shared_memory.SharedMemory(name=n) for n in names]
+    img, boxes, scores, classes = [_sharedArray(s, *shape) for s, shape in zip(shms, shapes)]
+
+    predict(tf.zeros((1,) + img.shape[1:]))
+    conn.send("ready")
+
+    while True:
+        n = conn.recv()
+        if n is None:
+            break
+
+        b, s, c = predict(img[:n])
+        boxes[:n] = b.numpy()
+        scores[:n] = s.numpy()
+        classes[:n] = c.numpy()
+        conn.send(n)
+
+    for s in shms:
+        s.close()
+
+
+class InferencePool:
+    """N CenterNet replicas in separate processes, each with its own intra-op
+    thread count and optional CPU affinity. Images are passed through
+    per-replica shared memory instead of being pickled. run() is thread
+    safe and hands each call to the next idle replica."""
+
+    def __init__(self, cfg, weights, nreplicas=2, threads=None, affinity=None, maxBatch=16, K=50):
+
+        cfg = cfg if isinstance(cfg, dict) else vars(cfg)
+        threads = threads or max(1, len(os.sched_getaffinity(0)) // nreplicas)
+
+        if affinity == "auto":
+            affinity = partitionCores(nreplicas)
+
+        self.maxBatch = maxBatch
+        self.shapes = [
+            ((maxBatch, cfg["ih"], cfg["iw"], cfg["ic"]), np.float32),
+            ((maxBatch, K, 4), np.float32),
+            ((maxBatch, K), np.float32),
+            ((maxBatch, K), np.int32),
+        ]
+
+        ctx = mp.get_context("spawn")
+        self.replicas = []
+        self.idle = queue.Queue()
+
+        for r in range(nreplicas):
+            shms = [
+                shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*np.dtype(dtype).itemsize)
+                for shape, dtype in self.shapes
+            ]
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(
+                target=_worker, daemon=True,
+                args=(cfg, weights, K, threads, affinity[r] if affinity else None,
+                      [s.name for s in shms], self.shapes, child),
+            )
+            proc.start()
+
+            arrays = [_sharedArray(s, *shape) for s, shape in zip(shms, self.shapes)]
+            self.replicas.append({"proc": proc, "conn": parent, "shms": shms, "arrays": arrays})
+
+        for r, replica in enumerate(self.replicas):
+            assert replica["conn"].recv() == "ready"
+            self.idle.put(r)
+
+    # ============================
+    def run(self, images):
+        """images [B,ih,iw,ic] float32 with B <= maxBatch. Returns boxes, scores, classes"""
+
+        n = len(images)
+        if n > self.maxBatch:
+            raise ValueError(f"Batch of {n} exceeds maxBatch {self.maxBatch}")
+
+        r = self.idle.get()
+        try:
+            replica = self.replicas[r]
+            img, boxes, scores, classes = replica["arrays"]
+
+            img[:n] = images
+            replica["conn"].send(n)
+            replica["conn"].recv()
+
+            return boxes[:n].copy(), scores[:n].copy(), classes[:n].copy()
+        finally:
+            self.idle.put(r)
+
+    def close(self):
+        for replica in self.replicas:
+            replica["conn"].send(None)
+            replica["proc"].join()
+            for s in replica["shms"]:
+                s.close()
+                s.unlink()
+        self.replicas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ============================
+def partitionCores(nreplicas):
+    """Splits the cores available to this process into nreplicas contiguous sets"""
+
+    cores = sorted(os.sched_getaffinity(0))
+    return [[int(k) for k in c] for c in np.array_split(cores, nreplicas)]
+
+
+def throughput(pool, batchSize, duration=10.0, nclients=None):
+    """Images/s with nclients threads submitting batches for duration seconds"""
+
+    nclients = nclients or 2*len(pool.replicas)
+    images = np.random.uniform(size=(batchSize,) + pool.shapes[0][0][1:]).astype(np.float32)
+
+    counts = [0]*nclients
+    deadline = time.perf_counter() + duration
+
+    def client(k):
+        while time.perf_counter() < deadline:
+            pool.run(images)
+            counts[k] += batchSize
+
+    t0 = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(k,)) for k in range(nclients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+
+    return sum(counts) / (time.perf_counter() - t0)
+
+
+def sweep(cfg, weights, batchSize=8, duration=10.0, K=50):
+    """Measures every replicas x threads split of the available cores"""
+
+    ncores = len(os.sched_getaffinity(0))
+
+    rows = []
+    for nreplicas in [r for r in range(1, ncores+1) if ncores % r == 0]:
+        threads = ncores // nreplicas
+        with InferencePool(cfg, weights, nreplicas, threads, "auto", maxBatch=batchSize, K=K) as pool:
+            throughput(pool, batchSize, duration=1.0)
+            ips = throughput(pool, batchSize, duration=duration)
+
+        rows.append({"replicas": nreplicas, "threads": threads, "batchSize": batchSize, "images_per_second": ips})
+        print(rows[-1])
+
+    return rows
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Finds the replicas x threads split with the best throughput")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--sweepBatchSize", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--out", default="inferencepool_sweep.json")
+    args = parser.parse_args()
+
+    rows = sweep(vars(args), args.weights, args.sweepBatchSize, args.duration)
+    best = max(rows, key=lambda r: r["images_per_second"])
+    print(f"Best: {best['replicas']} replicas x {best['threads']} threads, {best['images_per_second']:.1f} images/s")
+
+    with open(args.out, 'w') as f:
+        json.dump({"best": best, "results": rows}, f, indent=2)
@@ -0,0 +1,225 @@
+import os
+import time
+import json
+import argparse
+import collections
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D, SeparableConv2D, DepthwiseConv2D, Dense, MaxPooling2D, UpSampling2D, Dropout
+from model import createModel
+from backbones import measureLatency
+import config
+
+
+
+# ============================
+def _children(layer):
+    if getattr(layer, "_is_graph_network", False):
+        return [(l.name, l) for l in layer.layers if not isinstance(l, tf.keras.layers.InputLayer)]
+    return [(k, v) for k, v in vars(layer).items() if isinstance(v, tf.keras.layers.Layer) and not k.startswith("_")]
+
+
+def leafLayers(model):
+    """(path, layer) of all layers without sublayers, named by attribute,
+    e.g. hourglass1/hg/hg/lowE/conv2"""
+
+    leaves, seen = [], set()
+
+    def walk(layer, path):
+        children = _children(layer)
+        if not children and path and id(layer) not in seen:
+            seen.add(id(layer))
+            leaves.append((path, layer))
+        for name, child in children:
+            walk(child, f"{path}/{name}" if path else name)
+
+    walk(model, "")
+    return leaves
+
+
+def level(path):
+    """Hourglass depth level of a layer path (0 outermost), None outside the hourglasses"""
+    return path.split("/").count("hg") if path.startswith("hourglass") else None
+
+
+# ============================
+def layerCost(layer, xshape, yshape, itemsize=4):
+    """Analytical forward/backward FLOPs and activation bytes of one call.
+    The backward pass costs twice the forward FLOPs for layers with weights
+    (input and weight gradients), it keeps the input (plus the output with an
+    activation) and needs a buffer for the output gradient"""
+
+    nout = int(np.prod(yshape))
+    nin = int(np.prod(xshape))
+
+    # DepthwiseConv2D derives from Conv2D in some Keras versions
+    if isinstance(layer, SeparableConv2D):
+        kh, kw = layer.kernel_size
+        cin, dm = xshape[-1], layer.depth_multiplier
+        spatial = nout // yshape[-1]
+        flops = 2*spatial*(kh*kw*cin*dm + cin*dm*yshape[-1])
+    elif isinstance(layer, DepthwiseConv2D):
+        kh, kw = layer.kernel_size
+        flops = 2*nout*kh*kw
+    elif isinstance(layer, Conv2D):
+        kh, kw = layer.kernel_size
+        flops = 2*nout*kh*kw*xshape[-1]
+    elif isinstance(layer, Dense):
+        flops = 2*nout*xshape[-1]
+    elif isinstance(layer, MaxPooling2D):
+        flops = nout*int(np.prod(layer.pool_size))
+    elif isinstance(layer, (UpSampling2D, Dropout)):
+        flops = 0
+    else:
+        # Elementwise
+        flops = nout
+
+    if getattr(layer, "use_bias", False):
+        flops += nout
+
+    hasWeights = len(layer.weights) > 0
+    hasActivation = getattr(layer, "activation", None) not in (None, tf.keras.activations.linear)
+
+    return {
+        "flops_fwd": flops,
+        "flops_bwd": 2*flops if hasWeights else flops,
+        "act_fwd_bytes": itemsize*nout,
+        "act_bwd_bytes": itemsize*(nin + nout + (nout if hasActivation else 0)),
+    }
+
+
+class LayerHooks:
+    """Context manager wrapping the call of every leaf layer to record input
+    and output shapes and the (eager) time spent in it"""
+
+    def __init__(self, model):
+        self.leaves = leafLayers(model)
+        self.reset()
+
+    def reset(self):
+        self.shapes = collections.defaultdict(list)
+        self.times = collections.defaultdict(float)
+
+    def _wrap(self, path, call):
+        def wrapped(inputs, *args, **kwargs):
+            t0 = time.perf_counter()
+            y = call(inputs, *args, **kwargs)
+            self.times[path] += time.perf_counter() - t0
+
+            x = inputs[0] if isinstance(inputs, (list, tuple)) else inputs
+            self.shapes[path].append((tuple(x.shape), tuple(y.shape)))
+            return y
+        return wrapped
+
+    def __enter__(self):
+        for path, layer in self.leaves:
+            object.__setattr__(layer, "call", self._wrap(path, layer.call))
+        return self
+
+    def __exit__(self, *exc):
+        for _, layer in self.leaves:
+            object.__delattr__(layer, "call")
+
+
+# ============================
+def profileModel(model, batchSize=1, nruns=10):
+    """One row per leaf layer with the analytical cost and the median measured
+    eager latency over nruns forward passes"""
+
+    x = tf.random.uniform([batchSize] + model.inputs[0].shape[1:])
+    hooks = LayerHooks(model)
+
+    with hooks:
+        model(x, training=False)
+
+        runs = []
+        for _ in range(nruns):
+            hooks.reset()
+            model(x, training=False)
+            runs.append(dict(hooks.times))
+
+    rows = []
+    for path, layer in hooks.leaves:
+        calls = hooks.shapes.get(path, [])
+        if not calls:
+            continue
+
+        cost = collections.Counter()
+        for xshape, yshape in calls:
+            cost.update(layerCost(layer, xshape, yshape))
+
+        rows.append({
+            "layer": path,
+            "type": type(layer).__name__,
+            "level": level(path),
+            "calls": len(calls),
+            "output": list(calls[0][1]),
+            "params": int(layer.count_params()),
+            **{k: int(v) for k, v in cost.items()},
+            "latency_ms": float(1e3*np.median([r.get(path, 0.0) for r in runs])),
+        })
+
+    return rows
+
+
+def summarize(rows, key):
+    """Sums of the numeric columns grouped by key (e.g. level)"""
+
+    groups = collections.OrderedDict()
+    for r in rows:
+        g = groups.setdefault(r[key], collections.Counter())
+        g.update({k: v for k, v in r.items() if k in ("params", "flops_fwd", "flops_bwd", "act_fwd_bytes", "act_bwd_bytes", "latency_ms")})
+
+    return [{key: k, **dict(v)} for k, v in groups.items()]
+
+
+def toMarkdown(rows, sortBy="flops_fwd"):
+    lines = [
+        "| layer | type | level | params | MFLOPs fwd | MFLOPs bwd | act fwd [MB] | act bwd [MB] | latency [ms] |",
+        "|---|---|---:|---:|---:|---:|---:|---:|---:|",
+    ]
+    for r in sorted(rows, key=lambda r: -r[sortBy]):
+        lines.append(
+            f"| {r['layer']} | {r['type']} | {'' if r['level'] is None else r['level']} | {r['params']:,} "
+            f"| {r['flops_fwd']/1e6:.1f} | {r['flops_bwd']/1e6:.1f} | {r['act_fwd_bytes']/2**20:.2f} "
+            f"| {r['act_bwd_bytes']/2**20:.2f} | {r['latency_ms']:.2f} |"
+        )
+    return "\n".join(lines)
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Per-layer FLOPs, parameters, activation memory and CPU latency")
+    config.addArguments(parser)
+    parser.add_argument("--threads", type=int, default=4, help="intra-op threads")
+    parser.add_argument("--nruns", type=int, default=10)
+    parser.add_argument("--sort", default="flops_fwd",
+                        choices=["flops_fwd", "flops_bwd", "params", "act_fwd_bytes", "act_bwd_bytes", "latency_ms"])
+    parser.add_argument("--out", default="layerprofile")
+    args = parser.parse_args()
+
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    model = createModel(**config.modelKwargs(args))
+    rows = profileModel(model, args.batchSize, args.nruns)
+    levels = [s for s in summarize(rows, "level") if s["level"] is not None]
+
+    total = summarize([dict(r, all="total") for r in rows], "all")[0]
+    p50, _ = measureLatency(model, batchSize=args.batchSize)
+
+    print(toMarkdown(rows, args.sort))
+    print()
+    for s in sorted(levels, key=lambda s: s["level"]):
+        print(f"level {s['level']}: {s['flops_fwd']/1e9:.2f} GFLOPs fwd, {s['act_bwd_bytes']/2**20:.1f} MB kept for backward, {s['latency_ms']:.1f} ms")
+    print(f"total: {total['flops_fwd']/1e9:.2f} GFLOPs fwd, {total['act_bwd_bytes']/2**20:.1f} MB kept for backward, "
+          f"{total['latency_ms']:.1f} ms eager per layer, {p50:.1f} ms graph forward, batch {args.batchSize}")
+
+    with open(args.out + ".md", "w") as f:
+        f.write(f"Batch size {args.batchSize}, {args.threads} intra-op threads, host {os.uname().nodename}\n\n")
+        f.write(toMarkdown(rows, args.sort) + "\n")
+
+    with open(args.out + ".json", "w") as f:
+        json.dump({"config": config.modelKwargs(args), "batchSize": args.batchSize,
+                   "layers": rows, "levels": levels, "total": total, "graph_latency_ms": p50}, f, indent=2)
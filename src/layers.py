@@ -1,5 +1,5 @@
 import tensorflow as tf
-from tensorflow.keras.layers import Dropout, BatchNormalization, Conv2D, MaxPooling2D, UpSampling2D, Concatenate, Add, Lambda, MaxPool2D
+from tensorflow.keras.layers import Dropout, BatchNormalization, Conv2D, MaxPooling2D, UpSampling2D, Concatenate, Add, Lambda, MaxPool2D, Dense, DepthwiseConv2D, SeparableConv2D
 
 
 
@@ -30,6 +30,41 @@ class CenterNetPostprocessingLayer(tf.keras.Model):
         return y
 
 
+class CenterNetAgnosticPostprocessingLayer(tf.keras.Model):
+    """Single objectness heatmap plus a class embedding per cell. The class
+    logits are only computed for gathered peaks through classify()"""
+    def __init__(self, nc, nemb=32, **kwargs):
+        super(CenterNetAgnosticPostprocessingLayer, self).__init__(**kwargs)
+        self.nc = nc
+        self.nemb = nemb
+        self.classifier = Dense(nc, name="classifier")
+
+    def build(self, input_shape):
+        self.classifier.build((None, self.nemb))
+
+    def call(self, x, training=False):
+
+        x = Lambda( lambda x: tf.split(x, [1, 2, 2, self.nemb], axis=-1), name="splitter")(x)
+
+        # Objectness branch
+        y1 = Lambda( lambda x: tf.math.sigmoid(x), name="heatmap")(x[0])
+        hmax = MaxPool2D(pool_size=3, strides=1, padding="same", name="heatmapNMS1")(y1)
+        y4 = Lambda( lambda x: tf.cast(tf.equal(x[0], x[1]), tf.float32), name="mask")([y1,hmax])
+
+        # Regression branch
+        y2 = Lambda( lambda x: tf.math.sigmoid(x), "boxdimensions")(x[1])
+        y3 = Lambda( lambda x: tf.math.tanh(x), "boxcorrection")(x[2])
+
+        # Final output [B,H,W,1+2+2+1+nemb]
+        y = tf.concat((y1,y2,y3,y4,x[3]), axis=-1)
+
+        return y
+
+    def classify(self, emb):
+        """Class logits [...,nc] for gathered embeddings [...,nemb]"""
+        return self.classifier(emb)
+
+
 class ImmediateSupvervision(tf.keras.Model):
     def __init__(self, nheatmaps, **kwargs):
         super(ImmediateSupvervision, self).__init__(**kwargs)
@@ -71,20 +106,32 @@ class ImmediateSupvervision(tf.keras.Model):
 
 
 class HourglassModule(tf.keras.Model):
-    def __init__(self, nfilters, ndepths, **kwargs):
+    """Hourglass doubling the filters at every depth. block selects the
+    residual block (see BLOCKS), widthMultiplier scales and maxFilters caps
+    the width of every level"""
+    def __init__(self, nfilters, ndepths, block="residual", widthMultiplier=1.0, maxFilters=None, **kwargs):
         super(HourglassModule, self).__init__(**kwargs)
 
-        self.lowE = Residual(2*nfilters)
-        self.lowD = Residual(nfilters)
-        self.up = Residual(2*nfilters)
+        Block = BLOCKS[block] if isinstance(block, str) else block
+
+        def width(n):
+            n = max(8, int(widthMultiplier*n))
+            return n if maxFilters is None else min(n, maxFilters)
+
+        self.lowE = Block(width(2*nfilters))
+        self.lowD = Block(width(nfilters))
+        self.up = Block(width(2*nfilters))
 
         self.p = Downsample(2)
         self.u = Upsample(2)
 
         if ndepths>1:
-            self.hg = HourglassModule(nfilters=2*nfilters, ndepths=ndepths-1)
+            self.hg = HourglassModule(
+                nfilters=2*nfilters, ndepths=ndepths-1, block=block,
+                widthMultiplier=widthMultiplier, maxFilters=maxFilters
+            )
         else:
-            self.hg = Residual(nfilters*2)
+            self.hg = Block(width(nfilters*2))
 
 
     def call(self, x, training=False):
@@ -118,18 +165,19 @@ class Residual(tf.keras.Model):
         nf0 = input_shape[3]
 
         self.conv1 = Conv2D(int(0.5*self.nf), (1, 1), activation='relu', padding='same', dilation_rate=self.dilation)
-        self.conv2 = Conv2D(int(0.5*self.nf), (3, 3), activation='relu', padding='same', dilation_rate=self.dilation)
+        self.conv2 = self._conv3x3(int(0.5*self.nf))
         self.conv3 = Conv2D(self.nf, (1, 1), activation='relu', padding='same', dilation_rate=self.dilation)
         self.drop = Dropout(0.3)
 
         if nf0 == self.nf:
             self.need_skip = False
             self.skipConv = None
-            print("None...")
         else:
             self.need_skip = True
             self.skipConv = Conv2D(self.nf, (1, 1), activation='relu', padding='same', dilation_rate=self.dilation)
-            print(f"Inputshape {nf0} Outputshape {self.nf} ({input_shape})")
+
+    def _conv3x3(self, nf):
+        return Conv2D(nf, (3, 3), activation='relu', padding='same', dilation_rate=self.dilation)
         
 
     def call(self, input_tensor, training=False):
@@ -146,6 +194,59 @@ class Residual(tf.keras.Model):
         return x
 
 
+class ResidualDW(Residual):
+    """Residual with a depthwise separable 3x3 convolution"""
+
+    def _conv3x3(self, nf):
+        return SeparableConv2D(nf, (3, 3), activation='relu', padding='same', dilation_rate=self.dilation)
+
+
+class InvertedResidual(tf.keras.Model):
+    """Inverted bottleneck: 1x1 expansion, 3x3 depthwise, linear 1x1 projection"""
+    def __init__(self, nf, expansion=4, dilation=(1,1), **kwargs):
+        super(InvertedResidual, self).__init__(**kwargs)
+
+        self.nf = nf
+        self.expansion = expansion
+        self.dilation = dilation
+
+    def build(self, input_shape):
+
+        nf0 = input_shape[3]
+
+        self.conv1 = Conv2D(self.expansion*nf0, (1, 1), activation='relu', padding='same')
+        self.conv2 = DepthwiseConv2D((3, 3), activation='relu', padding='same', dilation_rate=self.dilation)
+        self.conv3 = Conv2D(self.nf, (1, 1), padding='same')
+        self.drop = Dropout(0.3)
+
+        if nf0 == self.nf:
+            self.need_skip = False
+            self.skipConv = None
+        else:
+            self.need_skip = True
+            self.skipConv = Conv2D(self.nf, (1, 1), padding='same')
+
+    def call(self, input_tensor, training=False):
+
+        xred = input_tensor if not self.need_skip else self.skipConv(input_tensor)
+
+        x = self.conv1(input_tensor, training=training)
+        x = self.conv2(x, training=training)
+        x = self.drop(x)
+        x = self.conv3(x, training=training)
+        x += xred
+
+        return x
+
+
+# Residual blocks selectable by name
+BLOCKS = {
+    "residual": Residual,
+    "dwresidual": ResidualDW,
+    "inverted": InvertedResidual,
+}
+
+
 class Upsample(tf.keras.Model):
     def __init__(self, kernelsize):
         super(Upsample, self).__init__(name="")
@@ -0,0 +1,140 @@
+import os
+import glob
+import hashlib
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D
+from layers import BLOCKS, HourglassModule, CenterNetPostprocessingLayer, CenterNetAgnosticPostprocessingLayer
+from decode import createPredictor
+
+
+
+# ============================
+def createModel(nc, ih=256, iw=256, ic=3, nfeat=32, nfilters=32, ndepths=4,
+                classAgnostic=False, nemb=32, block="residual", widthMultiplier=1.0, maxFilters=None,
+                nstacks=1):
+    """Builds the CenterNet model. With classAgnostic the head predicts one
+    objectness heatmap and a class embedding instead of nc heatmaps. block,
+    widthMultiplier and maxFilters select a lighter backbone (see layers.BLOCKS),
+    nstacks the number of stacked hourglasses"""
+
+    i = tf.keras.layers.Input((ih,iw,ic), name="rgb")
+
+    # ========= Entry Layers =================
+    x0 = Conv2D(nfeat, (7,7), name="entry01", padding="same", activation="relu")(i)
+    x0 = BLOCKS[block](nfeat, name="entry02")(x0)
+
+    # ========= Hourglasses =================
+    x1 = x0
+    for n in range(nstacks):
+        x1 = HourglassModule(
+            nfilters=nfilters, ndepths=ndepths, block=block,
+            widthMultiplier=widthMultiplier, maxFilters=maxFilters, name=f"hourglass{n+1}"
+        )(x1)
+
+    # ========= Final prediction =================
+    x = Conv2D(nfeat, (3,3), strides=2, name="strider", padding="same", activation="relu")(x1)
+
+    if classAgnostic:
+        x = Conv2D(1+4+nemb, (1,1), name="postprocess", padding="same")(x)
+        y = CenterNetAgnosticPostprocessingLayer(nc=nc, nemb=nemb, name="agnostichead")(x)
+    else:
+        x = Conv2D(nc+4, (1,1), name="postprocess", padding="same", activation="relu")(x)
+        y = CenterNetPostprocessingLayer(nc=nc)(x)
+
+    # ========= The model =================
+    return tf.keras.Model(inputs=[i], outputs=[y])
+
+
+# ============================
+def centerNetLoss(nc):
+    """Returns the CenterNet loss for nc heatmap channels"""
+
+    def loss(ytrue, ypred):
+
+        C = nc
+
+        hmTrue, whTrue, pdeltaTrue, indsTrue = tf.split(ytrue, [C, 2, 2, 1], axis=-1)
+        hmPred, whPred, pdeltaPred, indsPred = tf.split(ypred, [C, 2, 2, C], axis=-1)
+
+        lossHm = tf.keras.losses.binary_focal_crossentropy(hmTrue, hmPred, from_logits=False, gamma=2)
+
+        lossPdelta = tf.reduce_sum(indsTrue*(tf.math.abs(pdeltaTrue-pdeltaPred)), axis=[1,2,3])
+        lossWh = tf.reduce_sum(indsTrue*(tf.math.abs(whTrue-whPred)), axis=[1,2,3])
+
+        return lossHm  #+ 0.5*(lossPdelta+ lossWh)
+
+    return loss
+
+
+# ============================
+def centerNetAgnosticLoss(head, maxObjects=64, clsWeight=1.0):
+    """Returns the loss for the class agnostic head. The class embeddings are
+    gathered at the (at most maxObjects) ground truth centers only, so the cost
+    of the classification term does not depend on H and W"""
+
+    nemb = head.nemb
+
+    def loss(ytrue, ypred):
+
+        B = tf.shape(ytrue)[0]
+
+        hmTrue, whTrue, pdeltaTrue, indsTrue, clsTrue = tf.split(ytrue, [1, 2, 2, 1, 1], axis=-1)
+        hmPred, whPred, pdeltaPred, maskPred, embPred = tf.split(ypred, [1, 2, 2, 1, nemb], axis=-1)
+
+        # [B]
+        lossHm = tf.keras.losses.binary_focal_crossentropy(hmTrue, hmPred, from_logits=False, gamma=2)
+        lossHm = tf.reduce_mean(lossHm, axis=[1,2])
+
+        # Center cells of the ground truth [B,M]
+        valid, pix = tf.math.top_k(tf.reshape(indsTrue, (B, -1)), k=maxObjects)
+        valid = tf.minimum(valid, 1.0)
+
+        # [B,M,nemb], [B,M]
+        emb = tf.gather(tf.reshape(embPred, (B, -1, nemb)), pix, batch_dims=1)
+        cls = tf.gather(tf.reshape(clsTrue, (B, -1)), pix, batch_dims=1)
+
+        lossCls = tf.keras.losses.sparse_categorical_crossentropy(
+            tf.cast(cls, tf.int32), head.classify(emb), from_logits=True
+        )
+        lossCls = tf.reduce_sum(valid*lossCls, axis=1) / tf.maximum(tf.reduce_sum(valid, axis=1), 1.0)
+
+        return lossHm + clsWeight*lossCls
+
+    return loss
+
+
+# ============================
+def createLoss(model, nc, classAgnostic=False):
+    """Returns the loss matching the head of model"""
+
+    if classAgnostic:
+        return centerNetAgnosticLoss(model.get_layer("agnostichead"))
+    return centerNetLoss(nc)
+
+
+# ============================
+def loadPredictor(weights, K=50, **kwargs):
+    """Builds the model with createModel(**kwargs), loads weights and returns
+    the model and its batched model + top-K decode function"""
+
+    model = createModel(**kwargs)
+    model.load_weights(weights)
+
+    head = model.get_layer("agnostichead") if kwargs.get("classAgnostic", False) else None
+
+    return model, createPredictor(model, kwargs["nc"], K, head)
+
+
+def weightsIdentity(weights):
+    """Absolute path and sha256 of a weights file (of all files of a
+    checkpoint prefix), to tell results of different checkpoints apart"""
+
+    files = [weights] if os.path.isfile(weights) else sorted(glob.glob(weights + ".*"))
+
+    digest = hashlib.sha256()
+    for name in files:
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                digest.update(chunk)
+
+    return {"path": os.path.abspath(weights), "sha256": digest.hexdigest()}
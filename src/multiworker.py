@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import socket
+import argparse
+import subprocess
+
+
+
+# ============================
+def freePorts(n):
+    """n free TCP ports on localhost"""
+
+    socks = [socket.socket() for _ in range(n)]
+    for s in socks:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+
+    return ports
+
+
+def tfConfig(workers, index):
+    """TF_CONFIG of worker index in a cluster of host:port workers"""
+    return json.dumps({"cluster": {"worker": workers}, "task": {"type": "worker", "index": index}})
+
+
+def launchLocal(nworkers, command, threads=None):
+    """Starts command nworkers times on this host with a TF_CONFIG each, so
+    MultiWorkerMirroredStrategy can be tried without a cluster. Returns the
+    exit code of the first failing worker (0 if all succeed)"""
+
+    workers = [f"localhost:{p}" for p in freePorts(nworkers)]
+
+    procs = []
+    for k in range(nworkers):
+        env = dict(os.environ, TF_CONFIG=tfConfig(workers, k))
+        if threads:
+            env["TF_NUM_INTRAOP_THREADS"] = str(threads)
+        procs.append(subprocess.Popen(command, env=env))
+
+    codes = [p.wait() for p in procs]
+    return next((c for c in codes if c != 0), 0)
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Multi-worker training. Prints the TF_CONFIG of a worker for a host list, "
+                    "or with --local starts all workers on this host",
+        epilog="e.g. python multiworker.py --local 2 -- python centernet.py",
+    )
+    parser.add_argument("--workers", nargs="+", default=None, help="host:port of all workers")
+    parser.add_argument("--index", type=int, default=0, help="index of this host in --workers")
+    parser.add_argument("--local", type=int, default=0, help="number of local worker processes")
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads per local worker")
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+
+    if args.local:
+        sys.exit(launchLocal(args.local, command, args.threads))
+
+    if not args.workers:
+        parser.error("either --local or --workers is required")
+
+    config = tfConfig(args.workers, args.index)
+    if command:
+        sys.exit(subprocess.call(command, env=dict(os.environ, TF_CONFIG=config)))
+    print(f"export TF_CONFIG='{config}'")
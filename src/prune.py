@@ -0,0 +1,281 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D, Dropout, MaxPooling2D, UpSampling2D, Add
+from layers import Residual, HourglassModule, CenterNetAgnosticPostprocessingLayer
+from model import createModel, createLoss
+from datapipe import Datapipe
+import config
+
+
+
+# ============================
+def sliceConv(conv, keepIn=None, keepOut=None):
+    """New Conv2D holding only the kept input and output channels of conv"""
+
+    kernel, bias = conv.get_weights()
+
+    if keepIn is not None:
+        kernel = kernel[:, :, keepIn, :]
+    if keepOut is not None:
+        kernel = kernel[..., keepOut]
+        bias = bias[keepOut]
+
+    cfg = conv.get_config()
+    cfg["filters"] = kernel.shape[-1]
+
+    newConv = Conv2D.from_config(cfg)
+    newConv.build((None, None, None, kernel.shape[2]))
+    newConv.set_weights([kernel, bias])
+
+    return newConv
+
+
+class ChannelGraph:
+    """Channel spaces of a model built by createModel (Residual blocks only).
+
+    Every conv reads from one space and writes into one. Identity skips, the
+    add inside Residual and the xresd + xfeat merge of HourglassModule tie
+    spaces together, so all convs of a tied group are pruned with the same
+    channel selection. The image input and the head output are fixed."""
+
+    def __init__(self, model):
+        self.model = model
+        self.parent = []
+        self.fixed = []
+        self.convs = []
+
+        x = self._newSpace(fixed=True)
+        x = self._conv(None, "entry01", model.get_layer("entry01"), x)
+        x = self._residual(model.get_layer("entry02"), x)
+        for hg in self._stacks():
+            x = self._hourglass(hg, x)
+        x = self._conv(None, "strider", model.get_layer("strider"), x)
+        x = self._conv(None, "postprocess", model.get_layer("postprocess"), x)
+        self.fixed.append(x)
+
+    def _stacks(self):
+        return [l for l in self.model.layers if isinstance(l, HourglassModule)]
+
+    # ============================
+    def _newSpace(self, fixed=False):
+        self.parent.append(len(self.parent))
+        if fixed:
+            self.fixed.append(self.parent[-1])
+        return self.parent[-1]
+
+    def find(self, s):
+        while self.parent[s] != s:
+            self.parent[s] = self.parent[self.parent[s]]
+            s = self.parent[s]
+        return s
+
+    def union(self, a, b):
+        self.parent[self.find(a)] = self.find(b)
+        return self.find(b)
+
+    # ============================
+    def _conv(self, owner, attr, conv, inSpace, outSpace=None):
+
+        if type(conv) is not Conv2D:
+            raise ValueError(f"Only Conv2D can be pruned, got {type(conv).__name__} ({attr})")
+
+        outSpace = self._newSpace() if outSpace is None else outSpace
+        self.convs.append({"owner": owner, "attr": attr, "conv": conv, "inSpace": inSpace, "outSpace": outSpace})
+
+        return outSpace
+
+    def _residual(self, res, x):
+
+        if type(res) is not Residual:
+            raise ValueError(f"Only Residual blocks can be pruned, got {type(res).__name__}")
+
+        m1 = self._conv(res, "conv1", res.conv1, x)
+        m2 = self._conv(res, "conv2", res.conv2, m1)
+
+        # x += xred: conv3 writes into the skip space
+        out = self._conv(res, "skipConv", res.skipConv, x) if res.need_skip else x
+        self._conv(res, "conv3", res.conv3, m2, out)
+
+        return out
+
+    def _hourglass(self, hg, x):
+
+        x = self._residual(hg.lowE, x)
+
+        if isinstance(hg.hg, HourglassModule):
+            xfeat = self._hourglass(hg.hg, x)
+        else:
+            xfeat = self._residual(hg.hg, x)
+
+        xresd = self._residual(hg.up, x)
+
+        # x = xresd + xfeat
+        x = self.union(xresd, xfeat)
+
+        return self._residual(hg.lowD, x)
+
+    # ============================
+    def groups(self):
+        """Prunable groups {root: {"producers": [...], "consumers": [...]}}"""
+
+        fixed = set(self.find(s) for s in self.fixed)
+
+        groups = {}
+        for c in self.convs:
+            for key, space in (("producers", c["outSpace"]), ("consumers", c["inSpace"])):
+                root = self.find(space)
+                if root in fixed:
+                    continue
+                groups.setdefault(root, {"producers": [], "consumers": []})[key].append(c)
+
+        return groups
+
+    # ============================
+    def scores(self, method="magnitude", dataset=None, lossFn=None, nbatches=10):
+        """Filter importance per group. magnitude uses the L1 norm of the
+        producing kernels, taylor the first order loss change |w*dL/dw|
+        accumulated over nbatches of dataset"""
+
+        contrib = {}
+        if method == "taylor":
+            kernels = [c["conv"].kernel for c in self.convs]
+
+            for x, y in dataset.take(nbatches):
+                with tf.GradientTape() as tape:
+                    loss = tf.reduce_mean(lossFn(y, self.model(x, training=True)))
+                grads = tape.gradient(loss, kernels)
+
+                for k, g in zip(kernels, grads):
+                    s = np.abs(tf.reduce_sum(k*g, axis=[0,1,2]).numpy())
+                    contrib[id(k)] = contrib.get(id(k), 0.0) + s
+
+        elif method != "magnitude":
+            raise ValueError(f"Unknown scoring method {method}")
+
+        scores = {}
+        for root, group in self.groups().items():
+            score = 0.0
+            for c in group["producers"]:
+                kernel = c["conv"].kernel
+                if method == "taylor":
+                    s = contrib[id(kernel)]
+                else:
+                    s = np.abs(kernel.numpy()).sum(axis=(0,1,2))
+                # Normalize so every producer weighs the same
+                score = score + s / (s.mean() + 1e-12)
+            scores[root] = score
+
+        return scores
+
+    # ============================
+    def prune(self, ratio, scores, minChannels=4):
+        """Removes ratio of the channels of every group and returns a new model.
+        The pruned convs are copies, the input model is left unchanged"""
+
+        keep = {}
+        for root, score in scores.items():
+            n = max(minChannels, int(round((1.0-ratio)*len(score))))
+            keep[root] = np.sort(np.argsort(-score)[:n])
+
+        pruned = {}
+        for c in self.convs:
+            pruned[id(c["conv"])] = sliceConv(
+                c["conv"],
+                keepIn=keep.get(self.find(c["inSpace"])),
+                keepOut=keep.get(self.find(c["outSpace"])),
+            )
+
+        # Rewire the blocks functionally around the pruned convs
+        model = self.model
+        i = tf.keras.layers.Input(model.inputs[0].shape[1:], name="rgb")
+        x = pruned[id(model.get_layer("entry01"))](i)
+        x = self._wireResidual(model.get_layer("entry02"), x, pruned)
+        for hg in self._stacks():
+            x = self._wireHourglass(hg, x, pruned)
+        x = pruned[id(model.get_layer("strider"))](x)
+        x = pruned[id(model.get_layer("postprocess"))](x)
+        y = self._copyHead(model.layers[-1])(x)
+
+        return tf.keras.Model(inputs=[i], outputs=[y])
+
+    def _wireResidual(self, res, x, pruned):
+        """Residual.call with the pruned convs"""
+
+        xred = pruned[id(res.skipConv)](x) if res.need_skip else x
+
+        y = pruned[id(res.conv1)](x)
+        y = Dropout(res.drop.rate)(y)
+        y = pruned[id(res.conv2)](y)
+        y = Dropout(res.drop.rate)(y)
+        y = pruned[id(res.conv3)](y)
+
+        return Add()([y, xred])
+
+    def _wireHourglass(self, hg, x, pruned):
+        """HourglassModule.call with the pruned blocks"""
+
+        x = self._wireResidual(hg.lowE, x, pruned)
+
+        xfeat = MaxPooling2D(2, padding="same")(x)
+        if isinstance(hg.hg, HourglassModule):
+            xfeat = self._wireHourglass(hg.hg, xfeat, pruned)
+        else:
+            xfeat = self._wireResidual(hg.hg, xfeat, pruned)
+        xfeat = UpSampling2D(2)(xfeat)
+
+        xresd = self._wireResidual(hg.up, x, pruned)
+
+        x = Add()([xresd, xfeat])
+
+        return self._wireResidual(hg.lowD, x, pruned)
+
+    def _copyHead(self, head):
+        """Fresh head with the weights of head (only the agnostic head has any)"""
+
+        if not isinstance(head, CenterNetAgnosticPostprocessingLayer):
+            return type(head)(nc=head.nc, name=head.name)
+
+        newHead = CenterNetAgnosticPostprocessingLayer(nc=head.nc, nemb=head.nemb, name=head.name)
+        newHead.build(None)
+        newHead.classifier.set_weights(head.classifier.get_weights())
+
+        return newHead
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Structured channel pruning of a trained CenterNet")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--ratio", type=float, default=0.5, help="fraction of channels removed per group")
+    parser.add_argument("--method", default="magnitude", choices=["magnitude", "taylor"])
+    parser.add_argument("--nbatches", type=int, default=10, help="batches scored with taylor")
+    parser.add_argument("--epochs", type=int, default=10, help="fine-tuning epochs")
+    parser.add_argument("--out", default="pruned")
+    args = parser.parse_args()
+
+    nc = len(args.classNames)
+
+    model = createModel(**config.modelKwargs(args))
+    model.load_weights(args.weights)
+    lossFn = createLoss(model, nc, args.classAgnostic)
+
+    dp = Datapipe(args.datapath, args.classNames)
+    g = dp.create(**config.createKwargs(args))
+
+    nparams = model.count_params()
+
+    graph = ChannelGraph(model)
+    scores = graph.scores(args.method, dataset=g, lossFn=lossFn, nbatches=args.nbatches)
+    model = graph.prune(args.ratio, scores)
+
+    print(f"Parameters {nparams} -> {model.count_params()}")
+
+    # ========= Fine tuning =================
+    model.compile(loss=createLoss(model, nc, args.classAgnostic), optimizer=tf.keras.optimizers.Adam(args.learnrate))
+    model.fit(g, epochs=args.epochs)
+
+    # The pruned widths differ from createModel, so keep the full SavedModel
+    model.save(args.out)
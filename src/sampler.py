@@ -0,0 +1,146 @@
+import argparse
+import threading
+import numpy as np
+import tensorflow as tf
+from model import createModel, createLoss
+from datapipe import Datapipe
+import config
+
+
+
+class PrioritySampler:
+    """Draws the epochs of Datapipe.create with probability
+
+        p_i = (1-uniformMix) * l_i^alpha / sum_j l_j^alpha + uniformMix / n
+
+    where l_i is a running estimate of the loss of image i, reported back by
+    the training step. Images without a reported loss get the largest known
+    one, so every image is seen early on. Samples carry the importance
+    weight (1/(n p_i))^beta, normalized to a maximum of 1, so the weighted
+    gradient stays an unbiased estimate of the uniform one for beta=1"""
+
+    def __init__(self, n, alpha=1.0, uniformMix=0.2, beta=1.0, momentum=0.9, seed=None):
+        self.n = n
+        self.alpha = alpha
+        self.uniformMix = uniformMix
+        self.beta = beta
+        self.momentum = momentum
+
+        self.losses = np.ones(n)
+        self.seen = np.zeros(n, dtype=bool)
+        self.lock = threading.Lock()
+        self.rng = np.random.default_rng(seed)
+
+    # ============================
+    def update(self, indices, losses):
+        """Running per-image loss estimate, indices [B] and losses [B]"""
+
+        indices = np.asarray(indices).astype(np.int64)
+        losses = np.asarray(losses, dtype=np.float64)
+
+        valid = indices >= 0
+        indices, losses = indices[valid], losses[valid]
+
+        with self.lock:
+            old = self.losses[indices]
+            self.losses[indices] = np.where(self.seen[indices], self.momentum*old + (1.0-self.momentum)*losses, losses)
+            self.seen[indices] = True
+
+    def probabilities(self):
+        with self.lock:
+            losses = self.losses.copy()
+            if self.seen.any():
+                losses[~self.seen] = losses[self.seen].max()
+
+        priority = np.maximum(losses, 1e-12)**self.alpha
+
+        return (1.0-self.uniformMix)*priority/priority.sum() + self.uniformMix/self.n
+
+    def epoch(self):
+        """Indices of the next epoch (n draws with replacement) and their
+        importance weights under the distribution they were drawn from"""
+
+        p = self.probabilities()
+        indices = self.rng.choice(self.n, size=self.n, p=p)
+
+        w = (1.0/(self.n*p))**self.beta
+        w = (w/w.max()).astype(np.float32)
+
+        return indices, w[indices]
+
+    def stream(self, nrepeat=-1):
+        """Yields (index, weight) pairs. The weight travels with its sample,
+        so samples still in the pipeline when the next epoch is drawn keep
+        the weight of their own epoch"""
+
+        e = 0
+        while nrepeat < 0 or e < nrepeat:
+            yield from zip(*self.epoch())
+            e += 1
+
+
+class PrioritizedTrainer(tf.keras.Model):
+    """Trains model on (img, y, index, weight) batches of a Datapipe created
+    with a PrioritySampler. The loss is importance weighted per image and the
+    unweighted per-image losses are reported to the sampler"""
+
+    def __init__(self, model, sampler, **kwargs):
+        super(PrioritizedTrainer, self).__init__(**kwargs)
+        self.detector = model
+        self.sampler = sampler
+
+    def compile(self, optimizer, lossFn, **kwargs):
+        super(PrioritizedTrainer, self).compile(optimizer=optimizer, **kwargs)
+        self.lossFn = lossFn
+
+    def call(self, x, training=False):
+        return self.detector(x, training=training)
+
+    def train_step(self, data):
+
+        x, y, index, weight = data
+        B = tf.shape(x)[0]
+
+        with tf.GradientTape() as tape:
+            ypred = self.detector(x, training=True)
+
+            # [B]
+            loss = tf.reduce_mean(tf.reshape(self.lossFn(y, ypred), (B, -1)), axis=1)
+            weighted = tf.reduce_mean(weight*loss)
+
+        variables = self.detector.trainable_variables
+        grads = tape.gradient(weighted, variables)
+        self.optimizer.apply_gradients(zip(grads, variables))
+
+        tf.py_function(self.sampler.update, [index, loss], [])
+
+        return {"loss": weighted, "loss_unweighted": tf.reduce_mean(loss)}
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Trains with loss-prioritized sampling of the images")
+    config.addArguments(parser)
+    parser.add_argument("--alpha", type=float, default=1.0)
+    parser.add_argument("--uniformMix", type=float, default=0.2)
+    parser.add_argument("--beta", type=float, default=1.0)
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--out", default="weights.h5")
+    args = parser.parse_args()
+
+    dp = Datapipe(args.datapath, args.classNames)
+    sampler = PrioritySampler(dp.nd, args.alpha, args.uniformMix, args.beta, seed=args.seed)
+    g = dp.create_sampled(**config.createKwargs(args), nrepeat=-1, sampler=sampler)
+
+    model = createModel(**config.modelKwargs(args))
+
+    trainer = PrioritizedTrainer(model, sampler)
+    trainer.compile(
+        optimizer=tf.keras.optimizers.Adam(args.learnrate),
+        lossFn=createLoss(model, len(args.classNames), args.classAgnostic),
+    )
+    trainer.fit(g, epochs=args.epochs, steps_per_epoch=dp.nd // args.batchSize)
+
+    model.save_weights(args.out)
@@ -0,0 +1,161 @@
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import tensorflow as tf
+from datapipe import decodeImage
+from model import loadPredictor
+from telemetry import RingBuffer
+import config
+
+
+
+class MicroBatcher:
+    """Collects single images into batches of up to maxBatch, waiting at most
+    maxWait seconds for the batch to fill, and runs predict once per batch"""
+
+    def __init__(self, predict, maxBatch=16, maxWait=0.005, nlatencies=4096):
+        self.predict = predict
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+
+        self.queue = queue.Queue()
+        self.latency = RingBuffer(nlatencies)
+        self.batchSizes = np.zeros(maxBatch+1, dtype=np.int64)
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, img):
+        """Queues one image [ih,iw,ic], returns a Future of (boxes, scores, classes)"""
+        future = Future()
+        self.queue.put((img, future, time.perf_counter()))
+        return future
+
+    # ============================
+    def _collect(self):
+
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.maxWait
+
+        while len(batch) < self.maxBatch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+
+            try:
+                boxes, scores, classes = [t.numpy() for t in self.predict(tf.stack([b[0] for b in batch]))]
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            t1 = time.perf_counter()
+            for k, (_, future, t0) in enumerate(batch):
+                future.set_result((boxes[k], scores[k], classes[k]))
+                self.latency.append(t1 - t0)
+
+            self.batchSizes[len(batch)] += 1
+
+    # ============================
+    def metrics(self):
+        latency = self.latency.values()
+        pct = lambda q: float(1e3*np.percentile(latency, q)) if len(latency) else None
+
+        return {
+            "requests": int(self.latency.n),
+            "latency_ms": {"p50": pct(50), "p90": pct(90), "p99": pct(99)},
+            "batch_size_histogram": {str(k): int(n) for k, n in enumerate(self.batchSizes) if n},
+            "queue_depth": self.queue.qsize(),
+        }
+
+
+# ============================
+def detections(boxes, scores, classes, size, classNames, minScore=0.1):
+    """JSON detections in pixels of the original image. boxes are (Y1,X1,Y2,X2) in [0,1]"""
+
+    h, w = size
+    keep = scores >= minScore
+    boxes = np.clip(boxes[keep], 0, 1) * np.asarray([h, w, h, w])
+
+    return [
+        {"box": [float(b[1]), float(b[0]), float(b[3]), float(b[2])], "score": float(s), "class": classNames[c]}
+        for b, s, c in zip(boxes, scores[keep], classes[keep])
+    ]
+
+
+def createHandler(batcher, classNames, ih, iw, ic, minScore=0.1):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != "/detect":
+                return self._reply(404, {"error": "unknown path"})
+
+            content = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                size = tf.image.extract_jpeg_shape(content)[:2].numpy()
+                img = decodeImage(content, ih, iw, ic)
+            except Exception as e:
+                return self._reply(400, {"error": str(e)})
+
+            boxes, scores, classes = batcher.submit(img).result()
+            self._reply(200, {"detections": detections(boxes, scores, classes, size, classNames, minScore)})
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                return self._reply(404, {"error": "unknown path"})
+            self._reply(200, batcher.metrics())
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Local micro-batching CenterNet inference server")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--maxBatch", type=int, default=16)
+    parser.add_argument("--maxWaitMs", type=float, default=5.0)
+    parser.add_argument("-K", type=int, default=50)
+    parser.add_argument("--minScore", type=float, default=0.1)
+    args = parser.parse_args()
+
+    model, predict = loadPredictor(args.weights, K=args.K, **config.modelKwargs(args))
+
+    # Trace once before accepting requests
+    predict(tf.zeros((1, args.ih, args.iw, args.ic)))
+
+    batcher = MicroBatcher(predict, args.maxBatch, 1e-3*args.maxWaitMs)
+    handler = createHandler(batcher, args.classNames, args.ih, args.iw, args.ic, args.minScore)
+
+    print(f"Serving on http://{args.host}:{args.port}/detect (metrics on /metrics)")
+    ThreadingHTTPServer((args.host, args.port), handler).serve_forever()
@@ -0,0 +1,109 @@
+import time
+_T0 = time.perf_counter()
+
+import os
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+
+
+
+class ServingModel:
+    """Loads a SavedModel written by export.py. Only TensorFlow is needed,
+    the model code is not imported. All bucket signatures run once when
+    loaded so no request pays for graph initialization.
+
+    predict() pads a batch to the smallest fitting batch bucket of its input
+    shape and splits batches larger than the largest bucket."""
+
+    def __init__(self, path, warmup=True):
+
+        with open(os.path.join(path, "serving.json"), 'r') as f:
+            self.meta = json.load(f)
+
+        loaded = tf.saved_model.load(path)
+
+        self.signatures = {}
+        for b in self.meta["buckets"]:
+            self.signatures[(b["batchSize"], b["ih"], b["iw"], b["ic"])] = loaded.signatures[b["name"]]
+        self.loaded = loaded
+
+        if warmup:
+            self.warmup()
+
+    @property
+    def classNames(self):
+        return self.meta["classNames"]
+
+    @property
+    def shapes(self):
+        return sorted({k[1:] for k in self.signatures})
+
+    def warmup(self):
+        for (b, ih, iw, ic), fn in self.signatures.items():
+            fn(images=tf.zeros((b, ih, iw, ic)))
+
+    # ============================
+    def _bucket(self, n, shape):
+
+        sizes = sorted(k[0] for k in self.signatures if k[1:] == shape)
+        if not sizes:
+            raise ValueError(f"No bucket for input shape {shape}, exported shapes are {self.shapes}")
+
+        return next((b for b in sizes if b >= n), sizes[-1])
+
+    def predict(self, images):
+        """images [n,ih,iw,ic] float32 in [0,1] of an exported shape. Returns
+        boxes [n,K,4] (Y1,X1,Y2,X2 in [0,1]), scores [n,K] and classes [n,K]"""
+
+        images = np.asarray(images, dtype=np.float32)
+        n, shape = len(images), tuple(images.shape[1:])
+
+        outputs, start = [], 0
+        while start < n:
+            b = self._bucket(n - start, shape)
+            chunk = images[start:start+b]
+            m = len(chunk)
+            if m < b:
+                chunk = np.concatenate([chunk, np.zeros((b-m,) + shape, np.float32)])
+
+            y = self.signatures[(b,) + shape](images=tf.constant(chunk))
+            outputs.append([y[k].numpy()[:m] for k in ("boxes", "scores", "classes")])
+            start += m
+
+        return [np.concatenate(o) for o in zip(*outputs)]
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Loads a serving export and reports the time to the first detection")
+    parser.add_argument("path")
+    parser.add_argument("--image", default=None, help="jpeg for the first detection, zeros if not given")
+    args = parser.parse_args()
+
+    t1 = time.perf_counter()
+    model = ServingModel(args.path, warmup=False)
+    t2 = time.perf_counter()
+    model.warmup()
+    t3 = time.perf_counter()
+
+    ih, iw, ic = model.shapes[0]
+    if args.image:
+        img = tf.image.decode_jpeg(tf.io.read_file(args.image), channels=ic)
+        img = tf.image.resize(tf.image.convert_image_dtype(img, tf.float32), (ih, iw)).numpy()
+    else:
+        img = np.zeros((ih, iw, ic), np.float32)
+
+    boxes, scores, classes = model.predict(img[None])
+    t4 = time.perf_counter()
+
+    print(json.dumps({
+        "import_s": t1 - _T0,
+        "load_s": t2 - t1,
+        "warmup_s": t3 - t2,
+        "first_detection_s": t4 - t3,
+        "startup_to_first_detection_s": t4 - _T0,
+        "buckets": len(model.signatures),
+    }, indent=2))
@@ -0,0 +1,338 @@
+import os
+import time
+import hmac
+import queue
+import hashlib
+import datetime
+import posixpath
+import threading
+import collections
+import http.client
+import xml.etree.ElementTree as ET
+from urllib.parse import quote, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import tensorflow as tf
+
+
+
+class LocalStorage:
+    """Files on a POSIX path. Keys are file paths"""
+
+    prefetchDepth = 0
+
+    def list(self, root, extensions):
+        from datapipe import findFiles
+        return findFiles(root, extensions)
+
+    def read(self, key):
+        with open(key, 'rb') as f:
+            return f.read()
+
+    def join(self, root, name):
+        return os.path.join(root, name)
+
+    def readOp(self, key):
+        """Graph op reading key, for tf.data maps"""
+        return tf.io.read_file(key)
+
+    def prefetch(self, key, then=None):
+        pass
+
+
+# ============================
+def signV4(method, path, canonicalQuery, host, accessKey, secretKey, region, now, payloadHash="UNSIGNED-PAYLOAD"):
+    """Headers of an S3 request signed with AWS signature version 4. path
+    and canonicalQuery are URI-encoded, now is a UTC datetime"""
+
+    amzDate = now.strftime("%Y%m%dT%H%M%SZ")
+    dateStamp = now.strftime("%Y%m%d")
+
+    headers = {"host": host, "x-amz-content-sha256": payloadHash, "x-amz-date": amzDate}
+    signedHeaders = ";".join(sorted(headers))
+    canonicalHeaders = "".join(f"{k}:{headers[k]}\n" for k in sorted(headers))
+
+    canonicalRequest = "\n".join([method, path, canonicalQuery, canonicalHeaders, signedHeaders, payloadHash])
+    scope = f"{dateStamp}/{region}/s3/aws4_request"
+    stringToSign = "\n".join([
+        "AWS4-HMAC-SHA256", amzDate, scope, hashlib.sha256(canonicalRequest.encode("utf-8")).hexdigest()
+    ])
+
+    key = ("AWS4" + secretKey).encode("utf-8")
+    for part in (dateStamp, region, "s3", "aws4_request"):
+        key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+    signature = hmac.new(key, stringToSign.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    headers["Authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={accessKey}/{scope}, "
+        f"SignedHeaders={signedHeaders}, Signature={signature}"
+    )
+    return headers
+
+
+class _ConnectionPool:
+    """Keep-alive HTTP(S) connections shared by the fetch threads"""
+
+    def __init__(self, host, port, https, size):
+        self.host, self.port, self.https = host, port, https
+        self.idle = queue.LifoQueue(size)
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=60)
+
+    def request(self, method, path, headers, retries=2):
+        for attempt in range(retries+1):
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt == retries:
+                    raise
+                continue
+
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+            return response.status, response.reason, body
+
+
+class _DiskCache:
+    """Least recently used files in a directory, at most maxBytes in total"""
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        entries = [(e.stat().st_atime, e.name, e.stat().st_size) for e in os.scandir(directory) if e.is_file()]
+        self.sizes = collections.OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.total = sum(self.sizes.values())
+
+    def _name(self, key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        name = self._name(key)
+        with self.lock:
+            if name not in self.sizes:
+                return None
+            self.sizes.move_to_end(name)
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, content):
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+        with self.lock:
+            self.total += len(content) - self.sizes.pop(name, 0)
+            self.sizes[name] = len(content)
+
+            while self.total > self.maxBytes and len(self.sizes) > 1:
+                old, size = self.sizes.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except FileNotFoundError:
+                    pass
+
+
+class S3Storage:
+    """Objects in an S3-compatible store (AWS, MinIO, ...), addressed path
+    style. Keys are URLs s3://bucket/key. Requests are signed with AWS
+    signature V4 when credentials are given and share a pool of keep-alive
+    connections. prefetch() fetches upcoming keys on poolSize threads, at
+    most prefetchDepth at a time (further prefetches are ignored until a
+    fetch finishes). Of the finished, not yet read objects the prefetchDepth
+    most recent are kept. With cacheDir objects are kept in a local LRU
+    cache of at most cacheBytes"""
+
+    def __init__(self, endpoint, accessKey=None, secretKey=None, region="us-east-1", poolSize=16,
+                 prefetchDepth=64, cacheDir=None, cacheBytes=10*2**30):
+
+        url = urlsplit(endpoint)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.https else 80)
+        self.hostHeader = url.netloc
+
+        self.accessKey = accessKey
+        self.secretKey = secretKey
+        self.region = region
+
+        self.pool = _ConnectionPool(self.host, self.port, self.https, poolSize)
+        self.executor = ThreadPoolExecutor(max_workers=poolSize)
+        self.prefetchDepth = prefetchDepth
+        self.slots = threading.BoundedSemaphore(prefetchDepth)
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.cache = _DiskCache(cacheDir, cacheBytes) if cacheDir else None
+
+    @classmethod
+    def fromEnvironment(cls, **kwargs):
+        """Endpoint and credentials from S3_ENDPOINT_URL, AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY and AWS_DEFAULT_REGION, the cache directory
+        from S3_CACHE_DIR"""
+
+        kwargs.setdefault("cacheDir", os.environ.get("S3_CACHE_DIR"))
+        return cls(
+            os.environ.get("S3_ENDPOINT_URL", "https://s3.amazonaws.com"),
+            os.environ.get("AWS_ACCESS_KEY_ID"), os.environ.get("AWS_SECRET_ACCESS_KEY"),
+            os.environ.get("AWS_DEFAULT_REGION", "us-east-1"), **kwargs
+        )
+
+    # ============================
+    def _headers(self, method, path, query):
+
+        canonicalQuery = "&".join(
+            f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(query.items())
+        )
+        if self.accessKey is None:
+            return {"Host": self.hostHeader}, canonicalQuery
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        headers = signV4(method, path, canonicalQuery, self.hostHeader, self.accessKey, self.secretKey, self.region, now)
+
+        return headers, canonicalQuery
+
+    def _get(self, bucket, key, query={}):
+
+        path = quote(f"/{bucket}/{key}" if key else f"/{bucket}", safe="/-_.~")
+        headers, canonicalQuery = self._headers("GET", path, query)
+
+        status, reason, body = self.pool.request("GET", f"{path}?{canonicalQuery}" if canonicalQuery else path, headers)
+        if status != 200:
+            raise IOError(f"GET {bucket}/{key}: {status} {reason} {body[:200]!r}")
+
+        return body
+
+    @staticmethod
+    def split(url):
+        """s3://bucket/key -> (bucket, key)"""
+        url = urlsplit(url)
+        return url.netloc, url.path.lstrip("/")
+
+    # ============================
+    def list(self, root, extensions):
+        bucket, prefix = self.split(root)
+        ns = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+        keys, token = [], None
+        while True:
+            query = {"list-type": "2", "prefix": prefix}
+            if token:
+                query["continuation-token"] = token
+
+            result = ET.fromstring(self._get(bucket, "", query))
+            keys += [
+                f"s3://{bucket}/{c.findtext(ns + 'Key')}" for c in result.iter(ns + "Contents")
+                if c.findtext(ns + "Key").endswith(extensions)
+            ]
+
+            if result.findtext(ns + "IsTruncated") != "true":
+                return keys
+            token = result.findtext(ns + "NextContinuationToken")
+
+    def _fetch(self, key):
+        if self.cache is not None:
+            content = self.cache.get(key)
+            if content is not None:
+                return content
+
+        content = self._get(*self.split(key))
+
+        if self.cache is not None:
+            self.cache.put(key, content)
+        return content
+
+    def read(self, key):
+        with self.lock:
+            future = self.pending.pop(key, None)
+        if future is not None:
+            return future.result()
+        return self._fetch(key)
+
+    def prefetch(self, key, then=None):
+        """Starts fetching key in the background. then(content) may return
+        further keys to prefetch (e.g. the image of an annotation)"""
+
+        def task():
+            try:
+                content = self._fetch(key)
+            finally:
+                self.slots.release()
+
+            if then is not None:
+                for k in then(content):
+                    self.prefetch(k)
+            return content
+
+        with self.lock:
+            # When busy, the keys already in flight are the ones read next
+            if key in self.pending or not self.slots.acquire(blocking=False):
+                return
+            self.pending[key] = self.executor.submit(task)
+
+            # Finished objects that are never read (e.g. at a pipeline
+            # teardown) must not pile up, the oldest are dropped
+            finished = [k for k, f in self.pending.items() if f.done()]
+            for k in finished[:max(0, len(finished) - self.prefetchDepth)]:
+                del self.pending[k]
+
+    def join(self, root, name):
+        return posixpath.join(root, name)
+
+    def readOp(self, key):
+        content = tf.numpy_function(lambda k: self.read(k.decode("utf-8")), [key], tf.string)
+        return tf.ensure_shape(content, [])
+
+
+# ============================
+def openStorage(datapath, **kwargs):
+    """S3Storage for s3:// URLs (configured from the environment), LocalStorage otherwise"""
+
+    if str(datapath).startswith("s3://"):
+        return S3Storage.fromEnvironment(**kwargs)
+    return LocalStorage()
+
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Lists a dataset and measures the read throughput of its storage")
+    parser.add_argument("datapath", help="local path or s3://bucket/prefix")
+    parser.add_argument("-n", type=int, default=200)
+    parser.add_argument("--cacheDir", default=None)
+    args = parser.parse_args()
+
+    storage = S3Storage.fromEnvironment(cacheDir=args.cacheDir) if args.datapath.startswith("s3://") else LocalStorage()
+    keys = storage.list(args.datapath, (".json",))[:args.n]
+
+    t0 = time.perf_counter()
+    for k in keys:
+        storage.prefetch(k)
+    nbytes = sum(len(storage.read(k)) for k in keys)
+    dt = time.perf_counter() - t0
+
+    print(f"{len(keys)} objects, {nbytes/2**20:.1f} MB in {dt:.2f} s ({len(keys)/max(dt,1e-9):.0f} objects/s)")
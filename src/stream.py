@@ -0,0 +1,230 @@
+import time
+import argparse
+import threading
+import collections
+import numpy as np
+import tensorflow as tf
+from datapipe import decodeImage, normalizeImage
+from decode import decodePredictions, decodeAgnosticPredictions
+from model import createModel
+import config
+
+
+
+# End of stream marker passed through all stages
+_END = object()
+
+
+class _Failure:
+    """Exception of a stage, passed through the later stages to run()"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _isMarker(item):
+    return item is _END or isinstance(item, _Failure)
+
+
+class DropQueue:
+    """Bounded queue. When full, put() blocks or, with dropOldest, discards
+    the oldest queued item so the newest frames keep flowing"""
+
+    def __init__(self, maxsize, dropOldest=False):
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.maxsize = maxsize
+        self.dropOldest = dropOldest
+        self.dropped = 0
+
+    def put(self, item, force=False):
+        with self.cond:
+            while len(self.items) >= self.maxsize and not force:
+                if self.dropOldest and not _isMarker(self.items[0]):
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    self.cond.wait()
+            self.items.append(item)
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def getAvailable(self, n):
+        """Up to n items that are already queued, without waiting"""
+        with self.cond:
+            items = []
+            while self.items and len(items) < n and not _isMarker(self.items[0]):
+                items.append(self.items.popleft())
+            self.cond.notify_all()
+            return items
+
+
+class StreamPipeline:
+    """Overlaps frame decode/resize, model forward and top-K decoding in
+    threads connected by bounded queues. Resizing and normalization are the
+    ones of Datapipe, so detections match training.
+
+    Frames are encoded JPEG bytes or decoded uint8 arrays [H,W,C]. With
+    dropPolicy "oldest" frames waiting in front of a busy stage are dropped
+    when inference falls behind, "block" applies back pressure instead."""
+
+    def __init__(self, model, nc, K=50, head=None, queueSize=2, dropPolicy="oldest", maxBatch=4):
+
+        self.model = model
+        self.ih, self.iw, self.ic = model.inputs[0].shape[1:]
+        self.queueSize = queueSize
+        self.dropOldest = dropPolicy == "oldest"
+        self.maxBatch = maxBatch
+
+        spec = tf.TensorSpec([None, self.ih, self.iw, self.ic], tf.float32)
+        self.forward = tf.function(lambda x: model(x, training=False), input_signature=[spec])
+
+        if head is not None:
+            self.decode = tf.function(lambda y: decodeAgnosticPredictions(y, head, K))
+        else:
+            self.decode = tf.function(lambda y: decodePredictions(y, nc, K))
+
+    # ============================
+    def _preprocess(self, frame):
+        if isinstance(frame, (bytes, np.bytes_)):
+            return decodeImage(frame, self.ih, self.iw, self.ic)
+        return normalizeImage(tf.convert_to_tensor(frame), self.ih, self.iw)
+
+    def _stage(self, inq, outq, fn):
+        while True:
+            item = inq.get()
+            if item is _END:
+                outq.put(_END, force=True)
+                return
+            if isinstance(item, _Failure):
+                outq.put(item, force=True)
+                continue
+
+            try:
+                outq.put(fn(item))
+            except Exception as e:
+                outq.put(_Failure(e), force=True)
+
+    def _read(self, frames, outq):
+        for index, frame in enumerate(frames):
+            timestamp, frame = frame if isinstance(frame, tuple) else (time.time(), frame)
+            outq.put({"index": index, "timestamp": timestamp, "frame": frame, "t": [time.perf_counter()]})
+        outq.put(_END, force=True)
+
+    def _prepare(self, item):
+        item["img"] = self._preprocess(item.pop("frame"))
+        item["t"].append(time.perf_counter())
+        return item
+
+    def _infer(self, inq, outq):
+        while True:
+            item = inq.get()
+            if item is _END:
+                outq.put(_END, force=True)
+                return
+            if isinstance(item, _Failure):
+                outq.put(item, force=True)
+                continue
+
+            batch = [item] + inq.getAvailable(self.maxBatch-1)
+            t0 = time.perf_counter()
+            try:
+                ypred = self.forward(tf.stack([b.pop("img") for b in batch]))
+            except Exception as e:
+                outq.put(_Failure(e), force=True)
+                continue
+            t1 = time.perf_counter()
+
+            outq.put((batch, ypred, t0, t1))
+
+    def _postprocess(self, item):
+        batch, ypred, t0, t1 = item
+        boxes, scores, classes = [t.numpy() for t in self.decode(ypred)]
+        t2 = time.perf_counter()
+
+        results = []
+        for k, b in enumerate(batch):
+            results.append({
+                "index": b["index"],
+                "timestamp": b["timestamp"],
+                "boxes": boxes[k],
+                "scores": scores[k],
+                "classes": classes[k],
+                "latency": {
+                    "preprocess": b["t"][1] - b["t"][0],
+                    "queue": t0 - b["t"][1],
+                    "forward": t1 - t0,
+                    "postprocess": t2 - t1,
+                    "total": t2 - b["t"][0],
+                },
+            })
+        return results
+
+    # ============================
+    def run(self, frames):
+        """Yields a detection dict per processed frame: index, timestamp,
+        boxes (Y1,X1,Y2,X2 in [0,1]), scores, classes, per-stage latency [s]
+        and the number of frames dropped so far. An exception in any stage
+        (e.g. a frame that does not decode) is raised here"""
+
+        qread = DropQueue(self.queueSize, self.dropOldest)
+        qprep = DropQueue(self.queueSize, self.dropOldest)
+        qinfer = DropQueue(self.queueSize)
+        qout = DropQueue(self.queueSize)
+
+        threads = [
+            threading.Thread(target=self._read, args=(frames, qread), daemon=True),
+            threading.Thread(target=self._stage, args=(qread, qprep, self._prepare), daemon=True),
+            threading.Thread(target=self._infer, args=(qprep, qinfer), daemon=True),
+            threading.Thread(target=self._stage, args=(qinfer, qout, self._postprocess), daemon=True),
+        ]
+        for t in threads:
+            t.start()
+
+        while True:
+            results = qout.get()
+            if results is _END:
+                break
+            if isinstance(results, _Failure):
+                raise results.error
+            for r in results:
+                r["dropped"] = qread.dropped + qprep.dropped
+                yield r
+
+
+
+if __name__ == "__main__":
+
+    import cv2
+
+    parser = argparse.ArgumentParser(description="Runs CenterNet on a video file or camera")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--source", default="0", help="video file or camera index")
+    parser.add_argument("--dropPolicy", default="oldest", choices=["oldest", "block"])
+    parser.add_argument("-K", type=int, default=50)
+    args = parser.parse_args()
+
+    model = createModel(**config.modelKwargs(args))
+    model.load_weights(args.weights)
+    head = model.get_layer("agnostichead") if args.classAgnostic else None
+
+    def frames():
+        cap = cv2.VideoCapture(int(args.source) if args.source.isdigit() else args.source)
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield time.time(), cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    pipeline = StreamPipeline(model, len(args.classNames), args.K, head, dropPolicy=args.dropPolicy)
+    for det in pipeline.run(frames()):
+        n = int((det["scores"] > 0.3).sum())
+        print(f"frame {det['index']}: {n} objects, {1e3*det['latency']['total']:.1f} ms, dropped {det['dropped']}")
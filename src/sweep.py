@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+import config
+
+
+
+ARRAYS = ("images", "boxes", "labels")
+
+
+# ============================
+def decodeOnce(cfg, bufferDir, maxBoxes=100, batchSize=64):
+    """Decodes and resizes the dataset of cfg into uint8 .npy memory maps in
+    bufferDir (on /dev/shm they live in shared memory). Skipped if the
+    buffer exists for the same input size"""
+
+    from datapipe import Datapipe
+
+    metaPath = os.path.join(bufferDir, "meta.json")
+    meta = {"datapath": cfg["datapath"], "classNames": cfg["classNames"], "shape": [cfg["ih"], cfg["iw"], cfg["ic"]],
+            "minBoxSize": cfg["minBoxSize"], "maxBoxes": maxBoxes}
+
+    if os.path.isfile(metaPath):
+        with open(metaPath, 'r') as f:
+            if json.load(f) == meta:
+                return
+    os.makedirs(bufferDir, exist_ok=True)
+
+    dp = Datapipe(cfg["datapath"], cfg["classNames"])
+    N = dp.nd
+
+    out = {
+        "images": np.lib.format.open_memmap(os.path.join(bufferDir, "images.npy"), "w+", np.uint8, (N, cfg["ih"], cfg["iw"], cfg["ic"])),
+        "boxes": np.lib.format.open_memmap(os.path.join(bufferDir, "boxes.npy"), "w+", np.float32, (N, maxBoxes, 4)),
+        "labels": np.lib.format.open_memmap(os.path.join(bufferDir, "labels.npy"), "w+", np.int32, (N, maxBoxes)),
+    }
+
+    k = 0
+    for batch in dp.create_raw(cfg["iw"], cfg["ih"], cfg["ic"], batchSize, cfg["minBoxSize"], maxBoxes):
+        n = len(batch[0])
+        for name, x in zip(ARRAYS, batch):
+            out[name][k:k+n] = x.numpy()
+        k += n
+
+    for x in out.values():
+        x.flush()
+
+    with open(metaPath, 'w') as f:
+        json.dump(meta, f)
+
+    print(f"Decoded {N} images into {bufferDir}")
+
+
+def openBuffer(bufferDir):
+    return [np.load(os.path.join(bufferDir, f"{name}.npy"), mmap_mode="r") for name in ARRAYS]
+
+
+# ============================
+def _runTrial(cfg, bufferDir, steps, checkpointIn, checkpointOut, valFraction, threads):
+    """One rung of one trial in a fresh process: continues from checkpointIn
+    (model and optimizer state), trains steps batches, saves checkpointOut
+    and evaluates on the held out rows"""
+
+    cfg = dict(cfg, intraOpThreads=threads, interOpThreads=1)
+    config.applyThreads(cfg)
+
+    import tensorflow as tf
+    from model import createModel, createLoss
+    from datapipe import Datapipe
+    from evaluation import evaluate
+
+    images, boxes, labels = openBuffer(bufferDir)
+    nval = int(valFraction*len(images))
+    ntrain = len(images) - nval
+
+    # The Datapipe only provides the labelling, no files are read
+    dp = Datapipe(None, cfg["classNames"])
+
+    kwargs = dict(nx=cfg["nx"], ny=cfg["ny"], sigma=cfg["sigma"], minBoxSize=cfg["minBoxSize"], classAgnostic=cfg["classAgnostic"])
+    train = dp.create_from_arrays(images[:ntrain], boxes[:ntrain], labels[:ntrain], batchSize=cfg["batchSize"], **kwargs)
+    val = dp.create_from_arrays(images[ntrain:], boxes[ntrain:], labels[ntrain:], batchSize=cfg["batchSize"], evaluation=True, **kwargs)
+
+    nc = len(cfg["classNames"])
+    model = createModel(**config.modelKwargs(cfg))
+    model.compile(
+        loss=createLoss(model, nc, cfg["classAgnostic"]),
+        optimizer=tf.keras.optimizers.Adam(cfg["learnrate"]),
+    )
+
+    # Adam moments and the step count continue across rungs, restored once
+    # the first step creates the slots
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+    if checkpointIn is not None:
+        checkpoint.read(checkpointIn)
+
+    t0 = time.perf_counter()
+    history = model.fit(train, epochs=1, steps_per_epoch=steps, verbose=0)
+    seconds = time.perf_counter() - t0
+
+    checkpoint.write(checkpointOut)
+
+    head = model.get_layer("agnostichead") if cfg["classAgnostic"] else None
+    result = evaluate(model, val, nc, head=head) if nval else {"mAP": float("nan"), "AP50": float("nan")}
+
+    return {"loss": float(history.history["loss"][-1]), "mAP": result["mAP"], "AP50": result["AP50"], "seconds": seconds}
+
+
+def _run(args):
+    return _runTrial(*args)
+
+
+# ============================
+def grid(spec):
+    """Configs of a grid like {"learnrate": [1e-4, 1e-5], "sigma": [0.01, 0.02]}"""
+    keys = list(spec)
+    return [dict(zip(keys, values)) for values in itertools.product(*(spec[k] for k in keys))]
+
+
+def successiveHalving(cfg, trials, bufferDir, workdir, nparallel=4, minSteps=200, eta=3, valFraction=0.1):
+    """Trains all trials for minSteps, keeps the best 1/eta by validation mAP
+    and continues them for eta times as many steps, until one is left.
+    nparallel trials run at once, each with its share of the cores.
+    Returns one row per trial and rung"""
+
+    threads = max(1, len(os.sched_getaffinity(0)) // nparallel)
+    ctx = mp.get_context("spawn")
+    os.makedirs(workdir, exist_ok=True)
+
+    alive = list(range(len(trials)))
+    checkpoints = {t: None for t in alive}
+    rows, rung, steps, total = [], 0, minSteps, 0
+
+    while alive:
+        total += steps
+        jobs = [
+            (dict(cfg, **trials[t]), bufferDir, steps, checkpoints[t],
+             os.path.join(workdir, f"trial{t:03d}_rung{rung}"), valFraction, threads)
+            for t in alive
+        ]
+
+        with ctx.Pool(nparallel, maxtasksperchild=1) as pool:
+            results = pool.map(_run, jobs)
+
+        for t, r in zip(alive, results):
+            checkpoints[t] = os.path.join(workdir, f"trial{t:03d}_rung{rung}")
+            rows.append({"trial": t, "rung": rung, "steps": total, **trials[t], **r})
+            print(rows[-1])
+
+        if len(alive) == 1:
+            break
+
+        ranked = sorted(zip(alive, results), key=lambda x: -np.nan_to_num(x[1]["mAP"], nan=-1.0))
+        alive = [t for t, _ in ranked[:max(1, len(alive)//eta)]]
+        rung, steps = rung+1, steps*eta
+
+    return rows
+
+
+def parseValue(key, value):
+    """Grid value of the type of the default of key (int if there is none)"""
+
+    default = config.DEFAULTS.get(key)
+    if isinstance(default, bool):
+        if value.lower() not in ("true", "false", "1", "0"):
+            raise ValueError(f"{key} expects true or false, got {value}")
+        return value.lower() in ("true", "1")
+
+    return (type(default) if default is not None else int)(value)
+
+
+def toMarkdown(rows, keys):
+    lines = [
+        "| trial | rung | steps | " + " | ".join(keys) + " | loss | mAP | AP50 | time [s] |",
+        "|---:|---:|---:|" + "---|"*len(keys) + "---:|---:|---:|---:|",
+    ]
+    for r in sorted(rows, key=lambda r: (-r["rung"], -np.nan_to_num(r["mAP"], nan=-1.0))):
+        lines.append(
+            f"| {r['trial']} | {r['rung']} | {r['steps']} | " + " | ".join(str(r[k]) for k in keys)
+            + f" | {r['loss']:.4f} | {r['mAP']:.4f} | {r['AP50']:.4f} | {r['seconds']:.0f} |"
+        )
+    return "\n".join(lines)
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Hyperparameter sweep with successive halving on a dataset decoded once into shared memory",
+        epilog="e.g. python sweep.py --grid learnrate=1e-4,1e-5 sigma=0.01,0.02 nfeat=32,64",
+    )
+    config.addArguments(parser)
+    parser.add_argument("--grid", nargs="+", required=True, help="key=value,value,... per hyperparameter")
+    parser.add_argument("--bufferDir", default="/dev/shm/centernet_sweep")
+    parser.add_argument("--workdir", default="sweep")
+    parser.add_argument("--parallel", type=int, default=4, help="concurrent trials")
+    parser.add_argument("--minSteps", type=int, default=200)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--valFraction", type=float, default=0.1)
+    args = parser.parse_args()
+
+    cfg = vars(args)
+
+    spec = {}
+    for item in args.grid:
+        key, values = item.split("=")
+        spec[key] = [parseValue(key, v) for v in values.split(",")]
+
+    decodeOnce(cfg, args.bufferDir)
+
+    rows = successiveHalving(cfg, grid(spec), args.bufferDir, args.workdir,
+                             args.parallel, args.minSteps, args.eta, args.valFraction)
+
+    table = toMarkdown(rows, list(spec))
+    print(table)
+
+    with open(os.path.join(args.workdir, "sweep.md"), 'w') as f:
+        f.write(table + "\n")
+    with open(os.path.join(args.workdir, "sweep.json"), 'w') as f:
+        json.dump(rows, f, indent=2)
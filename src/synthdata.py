@@ -0,0 +1,78 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+
+
+
+# ============================
+def writeSample(outdir, name, seed, iw, ih, nobjects, boxSize, classNames):
+    """Writes one labelme JSON + JPEG pair with nobjects random rectangles.
+    nobjects is a (min, max) range, boxSize a (min, max) fraction of the image"""
+
+    rng = np.random.default_rng(seed)
+
+    img = rng.integers(0, 60, size=(ih, iw, 3), dtype=np.uint8)
+    shapes = []
+
+    for _ in range(rng.integers(nobjects[0], nobjects[1]+1)):
+        w = rng.uniform(*boxSize) * iw
+        h = rng.uniform(*boxSize) * ih
+        x1 = rng.uniform(0, iw-w)
+        y1 = rng.uniform(0, ih-h)
+
+        img[int(y1):int(y1+h), int(x1):int(x1+w)] = rng.integers(80, 256, size=3)
+
+        shapes.append({
+            "label": classNames[rng.integers(len(classNames))],
+            "points": [[x1, y1], [x1+w, y1+h]],
+            "group_id": None,
+            "shape_type": "rectangle",
+            "flags": {},
+        })
+
+    tf.io.write_file(os.path.join(outdir, name + ".jpg"), tf.io.encode_jpeg(img, quality=90))
+
+    with open(os.path.join(outdir, name + ".json"), 'w') as f:
+        json.dump({
+            "version": "4.5.6",
+            "flags": {},
+            "shapes": shapes,
+            "imagePath": name + ".jpg",
+            "imageData": None,
+            "imageHeight": ih,
+            "imageWidth": iw,
+        }, f)
+
+
+# ============================
+def generate(outdir, n, iw=640, ih=480, nobjects=(1, 5), boxSize=(0.05, 0.3),
+             classNames=["face", "mask", "dummy"], seed=0, nworkers=8):
+    """Writes n synthetic labelme samples to outdir"""
+
+    os.makedirs(outdir, exist_ok=True)
+
+    with ThreadPoolExecutor(nworkers) as pool:
+        list(pool.map(
+            lambda k: writeSample(outdir, f"synth_{k:07d}", seed+k, iw, ih, nobjects, boxSize, classNames),
+            range(n)
+        ))
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Writes a synthetic labelme dataset")
+    parser.add_argument("outdir")
+    parser.add_argument("-n", type=int, default=1000)
+    parser.add_argument("--iw", type=int, default=640)
+    parser.add_argument("--ih", type=int, default=480)
+    parser.add_argument("--nobjects", type=int, nargs=2, default=[1, 5], metavar=("MIN", "MAX"))
+    parser.add_argument("--boxSize", type=float, nargs=2, default=[0.05, 0.3], metavar=("MIN", "MAX"))
+    parser.add_argument("--classNames", nargs="+", default=["face", "mask", "dummy"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate(args.outdir, args.n, args.iw, args.ih, args.nobjects, args.boxSize, args.classNames, args.seed)
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import signal
+import resource
+import threading
+import numpy as np
+import tensorflow as tf
+
+
+
+class RingBuffer:
+    """Fixed size float buffer keeping the last n values"""
+
+    def __init__(self, n):
+        self.data = np.zeros(n)
+        self.n = 0
+
+    def append(self, value):
+        self.data[self.n % len(self.data)] = value
+        self.n += 1
+
+    def values(self):
+        return self.data[:min(self.n, len(self.data))]
+
+
+class PipelineProbe:
+    """Marks every batch leaving the Datapipe (before prefetching). Together
+    with the batches consumed by training this gives the prefetch queue depth
+    and the time a training step waited for its input"""
+
+    def __init__(self, n=4096):
+        self.lock = threading.Lock()
+        self.produced = 0
+        self.times = np.zeros(n)
+
+    def _mark(self):
+        with self.lock:
+            self.times[self.produced % len(self.times)] = time.perf_counter()
+            self.produced += 1
+        return 0.0
+
+    def mark(self, img, *rest):
+        t = tf.py_function(self._mark, [], tf.float64)
+        with tf.control_dependencies([t]):
+            img = tf.identity(img)
+        return (img, *rest)
+
+    def producedAt(self, k):
+        """Time batch k was produced, None if not yet (or no longer) known"""
+        with self.lock:
+            if k >= self.produced or k < self.produced - len(self.times):
+                return None
+            return self.times[k % len(self.times)]
+
+
+class Telemetry(tf.keras.callbacks.Callback):
+    """Always-on training metrics: step time split into input wait and compute,
+    images/s, Datapipe queue depth, peak RSS and the loss components.
+
+    Values are kept in ring buffers and summarized every flushSeconds to a
+    JSON-lines file (.jsonl) or a Prometheus textfile (.prom). A profiler
+    trace of profileSteps batches is captured when SIGUSR1 is received or
+    triggerFile appears."""
+
+    def __init__(self, path, batchSize, probe=None, flushSeconds=30, size=1024,
+                 profileDir="./tblogs", profileSteps=20, triggerFile="PROFILE"):
+        super(Telemetry, self).__init__()
+
+        self.path = path
+        self.batchSize = batchSize
+        self.probe = probe
+        self.flushSeconds = flushSeconds
+        self.size = size
+
+        self.profileDir = profileDir
+        self.profileSteps = profileSteps
+        self.triggerFile = triggerFile
+        self.profileUntil = None
+        self.triggered = False
+
+        self.buffers = {k: RingBuffer(size) for k in ("step", "wait", "compute", "depth")}
+        self.consumed = 0
+        self.lastFlush = time.time()
+
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self._onSignal)
+
+    def _onSignal(self, signum, frame):
+        self.triggered = True
+
+    # ============================
+    def on_train_batch_begin(self, batch, logs=None):
+        self.t0 = time.perf_counter()
+
+        if self.probe is not None:
+            self.buffers["depth"].append(self.probe.produced - self.consumed)
+
+    def on_train_batch_end(self, batch, logs=None):
+        t1 = time.perf_counter()
+        step = t1 - self.t0
+
+        wait = 0.0
+        if self.probe is not None:
+            produced = self.probe.producedAt(self.consumed)
+            wait = 0.0 if produced is None else min(step, max(0.0, produced - self.t0))
+        self.consumed += 1
+
+        self.buffers["step"].append(step)
+        self.buffers["wait"].append(wait)
+        self.buffers["compute"].append(step - wait)
+
+        for key, value in (logs or {}).items():
+            if key not in self.buffers:
+                self.buffers[key] = RingBuffer(self.size)
+            self.buffers[key].append(float(value))
+
+        if self.profileUntil is not None and self.consumed >= self.profileUntil:
+            tf.profiler.experimental.stop()
+            self.profileUntil = None
+
+        if time.time() - self.lastFlush > self.flushSeconds:
+            self.flush()
+            self._checkTrigger()
+
+    def on_train_end(self, logs=None):
+        if self.profileUntil is not None:
+            tf.profiler.experimental.stop()
+            self.profileUntil = None
+        self.flush()
+
+    # ============================
+    def _checkTrigger(self):
+
+        if os.path.isfile(self.triggerFile):
+            os.remove(self.triggerFile)
+            self.triggered = True
+
+        if self.triggered and self.profileUntil is None:
+            self.triggered = False
+            self.profileUntil = self.consumed + self.profileSteps
+            tf.profiler.experimental.start(self.profileDir)
+
+    def summary(self):
+        """Current metrics as a flat dict"""
+
+        step = self.buffers["step"].values()
+
+        metrics = {
+            "time": time.time(),
+            "steps": self.consumed,
+            "images_per_second": self.batchSize*len(step)/max(step.sum(), 1e-9),
+            "peak_rss_bytes": 1024*resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        for key, buf in self.buffers.items():
+            values = buf.values()
+            if len(values) == 0:
+                continue
+            metrics[f"{key}_mean"] = float(values.mean())
+            if key in ("step", "wait", "compute"):
+                metrics[f"{key}_p50"] = float(np.percentile(values, 50))
+                metrics[f"{key}_p90"] = float(np.percentile(values, 90))
+
+        return metrics
+
+    def flush(self):
+        self.lastFlush = time.time()
+        metrics = self.summary()
+
+        if self.path.endswith(".prom"):
+            lines = [f"centernet_{k} {v}" for k, v in metrics.items() if k != "time"]
+            with open(self.path + ".tmp", "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
@@ -0,0 +1,165 @@
+import argparse
+import numpy as np
+import tensorflow as tf
+from datapipe import normalizeImage
+from decode import createPredictor, decodePredictions, decodeAgnosticPredictions
+from model import createModel
+import config
+
+
+
+class TemporalROIDetector:
+    """Runs the full frame pass every keyframeInterval frames and, in between,
+    the model only on crops around the objects found in the previous frame.
+
+    A crop covers cropSize/ih of the frame height (cropSize/iw of the width)
+    and is resized to cropSize pixels, so objects appear at the same scale as
+    in the full pass. All crops of a frame run as one batch, their
+    detections are mapped back to frame coordinates and merged by NMS. Frames
+    without tracked objects, or with more than maxCrops, fall back to the
+    full pass.
+
+    model runs the full frames at ih x iw, cropModel (see createCropModel)
+    the crops. cropSize must be divisible by 2**ndepths."""
+
+    def __init__(self, model, cropModel, nc, ih, iw, K=50, head=None, keyframeInterval=10, cropSize=96,
+                 minScore=0.3, maxCrops=8, margin=0.5, cropK=5, iouThreshold=0.5, ndepths=4):
+
+        if cropSize % 2**ndepths:
+            raise ValueError(f"cropSize {cropSize} is not divisible by 2**ndepths = {2**ndepths}")
+
+        self.ih, self.iw = ih, iw
+        self.ic = model.inputs[0].shape[-1]
+        self.keyframeInterval = keyframeInterval
+        self.cropSize = cropSize
+        self.minScore = minScore
+        self.maxCrops = maxCrops
+        self.margin = margin
+        self.K = K
+        self.iouThreshold = iouThreshold
+
+        self.fullPredict = createPredictor(model, nc, K, head)
+
+        cropHead = cropModel.get_layer("agnostichead") if head is not None else None
+        decode = (lambda y: decodeAgnosticPredictions(y, cropHead, cropK)) if head is not None \
+            else (lambda y: decodePredictions(y, nc, cropK))
+
+        @tf.function(input_signature=[
+            tf.TensorSpec([None, None, self.ic], tf.float32),
+            tf.TensorSpec([None, 4], tf.float32),
+        ])
+        def cropPredict(frame, regions):
+            n = tf.shape(regions)[0]
+
+            crops = tf.image.crop_and_resize(
+                frame[None], regions, tf.zeros((n,), tf.int32), (cropSize, cropSize)
+            )
+            boxes, scores, classes = decode(cropModel(crops, training=False))
+
+            # Crop to frame coordinates
+            offset = tf.tile(regions[:, None, :2], [1, 1, 2])
+            scale = tf.tile(regions[:, None, 2:] - regions[:, None, :2], [1, 1, 2])
+            boxes = offset + scale*boxes
+
+            return tf.reshape(boxes, (-1, 4)), tf.reshape(scores, (-1,)), tf.reshape(classes, (-1,))
+
+        self.cropPredict = cropPredict
+        self.reset()
+
+    def reset(self):
+        self.frameIndex = 0
+        self.tracks = np.zeros((0, 4), dtype=np.float32)
+
+    # ============================
+    def _regions(self):
+        """Crop regions (Y1,X1,Y2,X2 in [0,1]) around the tracked boxes, None if
+        the full pass is needed"""
+
+        if len(self.tracks) == 0 or len(self.tracks) > self.maxCrops:
+            return None
+
+        center = 0.5*(self.tracks[:, :2] + self.tracks[:, 2:])
+        size = (1.0 + self.margin)*(self.tracks[:, 2:] - self.tracks[:, :2])
+        extent = np.maximum(size, np.asarray([self.cropSize/self.ih, self.cropSize/self.iw]))
+
+        if (extent > 1.0).any():
+            return None
+
+        lo = np.clip(center - 0.5*extent, 0.0, 1.0 - extent)
+        return np.concatenate([lo, lo + extent], axis=-1).astype(np.float32)
+
+    def detect(self, frame):
+        """Detections of one uint8 frame [H,W,C]: boxes (Y1,X1,Y2,X2 in [0,1]),
+        scores, classes and the number of crops (0 for the full pass)"""
+
+        frame = tf.image.convert_image_dtype(tf.convert_to_tensor(frame), tf.float32)
+
+        regions = None if self.frameIndex % self.keyframeInterval == 0 else self._regions()
+        self.frameIndex += 1
+
+        if regions is None:
+            img = normalizeImage(frame, self.ih, self.iw)
+            boxes, scores, classes = [t.numpy()[0] for t in self.fullPredict(img[None])]
+        else:
+            boxes, scores, classes = self.cropPredict(frame, regions)
+
+            keep = tf.image.non_max_suppression(
+                boxes, scores, self.K, iou_threshold=self.iouThreshold, score_threshold=self.minScore
+            )
+            boxes, scores, classes = [tf.gather(t, keep).numpy() for t in (boxes, scores, classes)]
+
+        self.tracks = boxes[scores >= self.minScore]
+
+        return boxes, scores, classes, 0 if regions is None else len(regions)
+
+    def run(self, frames):
+        """Yields (boxes, scores, classes, ncrops) per frame"""
+        for frame in frames:
+            yield self.detect(frame)
+
+
+# ============================
+def createCropModel(model, **kwargs):
+    """createModel(**kwargs) for any input size, with the weights of model"""
+
+    cropModel = createModel(**dict(kwargs, ih=None, iw=None))
+    cropModel.set_weights(model.get_weights())
+
+    return cropModel
+
+
+
+if __name__ == "__main__":
+
+    import cv2
+
+    parser = argparse.ArgumentParser(description="Temporal ROI inference on a video")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--source", required=True)
+    parser.add_argument("--keyframeInterval", type=int, default=10)
+    parser.add_argument("--cropSize", type=int, default=96)
+    args = parser.parse_args()
+
+    kwargs = config.modelKwargs(args)
+    model = createModel(**kwargs)
+    model.load_weights(args.weights)
+    head = model.get_layer("agnostichead") if args.classAgnostic else None
+
+    detector = TemporalROIDetector(
+        model, createCropModel(model, **kwargs), len(args.classNames), args.ih, args.iw, head=head,
+        keyframeInterval=args.keyframeInterval, cropSize=args.cropSize, ndepths=args.ndepths
+    )
+
+    cap = cv2.VideoCapture(args.source)
+    nframes, npixels = 0, 0
+    while True:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        boxes, scores, classes, ncrops = detector.detect(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+        nframes += 1
+        npixels += ncrops*args.cropSize**2 if ncrops else args.ih*args.iw
+
+    print(f"{nframes} frames, {npixels/max(nframes,1)/(args.ih*args.iw):.2f} of the full-frame pixels per frame")
@@ -0,0 +1,107 @@
+import argparse
+import tensorflow as tf
+from decode import decodePredictions, decodeAgnosticPredictions
+from evaluation import evaluate
+from datapipe import Datapipe
+from model import createModel
+import config
+
+
+
+# ============================
+def unflipMaps(y, nh):
+    """Output maps [B,H,W,...] of a horizontally flipped image in the frame of
+    the original. The x offset changes sign, the box size does not (compare
+    the box flip of Datapipe._processAugmentFlip).
+
+    Centers are assigned to the floor cell (Datapipe._encodeCenters), so
+    flipped back an object sits one column right of its cell in the original
+    view. The maps are shifted one column left (repeating the edge column)
+    and the x offset is taken relative to that cell"""
+
+    y = tf.image.flip_left_right(y)
+    y = tf.concat([y[:, :, 1:], y[:, :, -1:]], axis=2)
+    hm, wh, pdelta, rest = tf.split(y, [nh, 2, 2, -1], axis=-1)
+
+    step = 1.0 / tf.cast(tf.shape(y)[2] - 1, tf.float32)
+    pdelta = pdelta*tf.constant([1.0, -1.0]) + tf.stack([0.0, step])
+
+    return tf.concat([hm, wh, pdelta, rest], axis=-1)
+
+
+def untransposeMaps(y, nh):
+    """Output maps of a transposed image in the frame of the original. Height
+    and width as well as the y and x offsets swap (compare Datapipe._processRotate)"""
+
+    y = tf.transpose(y, [0, 2, 1, 3])
+    hm, wh, pdelta, rest = tf.split(y, [nh, 2, 2, -1], axis=-1)
+
+    return tf.concat([hm, wh[..., ::-1], pdelta[..., ::-1], rest], axis=-1)
+
+
+def createTTAPredictor(model, nc, K=50, head=None, transpose=False):
+    """Like decode.createPredictor, but runs the original, the horizontally
+    flipped and (for square inputs, with transpose) the transposed images as
+    one batch, maps the outputs back, averages them and decodes once"""
+
+    ih, iw = model.inputs[0].shape[1:3]
+    if transpose and ih != iw:
+        raise ValueError(f"Transposed views need a square input, got {ih}x{iw}")
+
+    nh = 1 if head is not None else nc
+    spec = tf.TensorSpec([None] + list(model.inputs[0].shape[1:]), tf.float32)
+
+    @tf.function(input_signature=[spec])
+    def predict(img):
+
+        views = [img, tf.image.flip_left_right(img)]
+        if transpose:
+            views.append(tf.transpose(img, [0, 2, 1, 3]))
+
+        ys = tf.split(model(tf.concat(views, axis=0), training=False), len(views), axis=0)
+
+        maps = [ys[0], unflipMaps(ys[1], nh)]
+        if transpose:
+            maps.append(untransposeMaps(ys[2], nh))
+
+        y = tf.add_n(maps) / len(maps)
+
+        # Peak mask of the merged heatmap
+        hm, wh, pdelta, _, rest = tf.split(y, [nh, 2, 2, nh, -1], axis=-1)
+        hmax = tf.nn.max_pool2d(hm, ksize=3, strides=1, padding="SAME")
+        mask = tf.cast(tf.equal(hm, hmax), tf.float32)
+        y = tf.concat([hm, wh, pdelta, mask, rest], axis=-1)
+
+        if head is not None:
+            return decodeAgnosticPredictions(y, head, K)
+        return decodePredictions(y, nc, K)
+
+    return predict
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compares plain and test-time augmented AP")
+    config.addArguments(parser)
+    parser.add_argument("--weights", default="weights.h5")
+    parser.add_argument("--valpath", required=True)
+    parser.add_argument("--transpose", action="store_true")
+    parser.add_argument("-K", type=int, default=100)
+    args = parser.parse_args()
+
+    nc = len(args.classNames)
+
+    model = createModel(**config.modelKwargs(args))
+    model.load_weights(args.weights)
+    head = model.get_layer("agnostichead") if args.classAgnostic else None
+
+    ds = Datapipe(args.valpath, args.classNames).create_eval(
+        args.nx, args.ny, args.iw, args.ih, args.ic, args.batchSize,
+        sigma=args.sigma, minBoxSize=args.minBoxSize, classAgnostic=args.classAgnostic
+    )
+
+    plain = evaluate(model, ds, nc, args.K, head)
+    tta = evaluate(model, ds, nc, args.K, head, predict=createTTAPredictor(model, nc, args.K, head, args.transpose))
+
+    print(f"mAP {plain['mAP']:.4f} -> {tta['mAP']:.4f} with TTA, AP50 {plain['AP50']:.4f} -> {tta['AP50']:.4f}")
@@ -0,0 +1,58 @@
+import os
+import json
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from bulkinfer import BulkInference
+from synthdata import generate
+
+
+K = 5
+
+
+def predict(img):
+    B = tf.shape(img)[0]
+    return tf.zeros((B, K, 4)), tf.ones((B, K)), tf.zeros((B, K), tf.int32)
+
+
+@pytest.fixture
+def images(tmp_path):
+    path = str(tmp_path / "images")
+    generate(path, 25, iw=64, ih=48, nworkers=2)
+    return path
+
+
+def test_run_and_resume(images, tmp_path):
+    out = str(tmp_path / "out")
+
+    job = BulkInference(images, out, shardSize=10)
+    assert job.nshards == 3
+    assert job.run(predict, 32, 32, 3, K, batchSize=4) == 25
+    assert job.pending() == []
+
+    with open(os.path.join(out, "progress.jsonl"), 'r') as f:
+        progress = [json.loads(line) for line in f]
+    assert sorted(p["shard"] for p in progress) == [0, 1, 2]
+
+    ids = np.concatenate([np.load(job.shardPath(s))["ids"] for s in range(3)])
+    assert sorted(ids.tolist()) == list(range(25))
+
+    # A lost shard is redone on restart, the others are skipped
+    os.remove(job.shardPath(1))
+    job = BulkInference(images, out, shardSize=10)
+    assert job.pending() == [1]
+    assert job.run(predict, 32, 32, 3, K, batchSize=4) == 10
+    assert np.load(job.shardPath(1))["ids"].tolist() == list(range(10, 20))
+
+
+def test_other_images_rejected(images, tmp_path):
+    out = str(tmp_path / "out")
+    BulkInference(images, out, shardSize=10).run(predict, 32, 32, 3, K, batchSize=4)
+
+    other = str(tmp_path / "other")
+    generate(other, 3, iw=64, ih=48, nworkers=1)
+
+    with pytest.raises(ValueError):
+        BulkInference(other, out, shardSize=10).run(predict, 32, 32, 3, K, batchSize=4)
@@ -0,0 +1,67 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from dedup import cluster, popcount
+
+
+def bruteForce(hashes, maxDistance):
+    """Cluster ids by comparing all pairs"""
+
+    n = len(hashes)
+    parent = list(range(n))
+    def find(a):
+        while parent[a] != a:
+            a = parent[a]
+        return a
+
+    dist = popcount(hashes[:, None] ^ hashes[None, :])
+    for i in range(n):
+        for j in range(i+1, n):
+            if dist[i, j] <= maxDistance:
+                parent[find(i)] = find(j)
+
+    return np.asarray([find(a) for a in range(n)])
+
+
+def samePartition(a, b):
+    return len(set(zip(a.tolist(), b.tolist()))) == len(set(a.tolist())) == len(set(b.tolist()))
+
+
+def nearDuplicates(rng, nbase, ncopies, maxFlips):
+    base = rng.integers(0, 2**63, size=nbase, dtype=np.uint64)
+    hashes = [base]
+    for _ in range(ncopies):
+        flips = np.zeros(nbase, dtype=np.uint64)
+        for _ in range(maxFlips):
+            flips |= np.uint64(1) << rng.integers(0, 64, size=nbase).astype(np.uint64)
+        hashes.append(base ^ flips)
+    return np.concatenate(hashes)
+
+
+def test_popcount():
+    x = np.asarray([0, 1, 3, 2**64-1], dtype=np.uint64)
+    assert popcount(x).tolist() == [0, 1, 2, 64]
+
+
+@pytest.mark.parametrize("maxDistance", [2, 4])
+def test_matches_brute_force(maxDistance):
+    hashes = nearDuplicates(np.random.default_rng(0), 40, 5, 3)
+    assert samePartition(cluster(hashes, maxDistance), bruteForce(hashes, maxDistance))
+
+
+def test_large_bucket_in_blocks():
+    # Chains of small changes within one band bucket, compared in small blocks
+    rng = np.random.default_rng(1)
+    base = np.uint64(0xF0F0F0F0F0F0F0F0)
+    hashes = base ^ (rng.integers(0, 2**16, size=300).astype(np.uint64) << np.uint64(48))
+
+    expected = bruteForce(hashes, 4)
+    assert samePartition(cluster(hashes, 4, maxPairs=64), expected)
+    assert samePartition(cluster(hashes, 4), expected)
+
+
+def test_duplicates_share_a_cluster():
+    hashes = np.asarray([5, 5, 2**40-1], dtype=np.uint64)
+    ids = cluster(hashes, 4)
+    assert ids[0] == ids[1] != ids[2]
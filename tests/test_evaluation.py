@@ -0,0 +1,55 @@
+import json
+import warnings
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("tensorflow")
+
+from evaluation import StreamingAP, boxIou
+
+
+GT = np.asarray([[[0.1, 0.1, 0.4, 0.4], [0.5, 0.5, 0.9, 0.8]]], dtype=np.float32)
+LABELS = np.asarray([[0, 1]])
+
+
+def test_boxIou():
+    a = np.asarray([[0, 0, 2, 2]], dtype=np.float32)
+    b = np.asarray([[0, 0, 2, 2], [1, 1, 3, 3], [5, 5, 6, 6]], dtype=np.float32)
+
+    np.testing.assert_allclose(boxIou(a, b), [[1.0, 1/7, 0.0]], rtol=1e-6)
+
+
+def test_perfect_detections():
+    metric = StreamingAP(3)
+    metric.update(GT, np.asarray([[0.9, 0.8]]), np.asarray([[0, 1]]), GT, LABELS)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        result = metric.result()
+
+    assert result["mAP"] == pytest.approx(1.0)
+    assert result["AP50"] == pytest.approx(1.0)
+
+    # Class 2 has no ground truth
+    assert result["APperClass"] == [pytest.approx(1.0), pytest.approx(1.0), None]
+    json.dumps(result)
+
+
+def test_false_positive_ranked_first():
+    boxes = np.asarray([[[0.6, 0.6, 0.7, 0.7], [0.1, 0.1, 0.4, 0.4]]], dtype=np.float32)
+
+    metric = StreamingAP(1)
+    metric.update(boxes, np.asarray([[0.9, 0.8]]), np.asarray([[0, 0]]), GT[:, :1], LABELS[:, :1])
+
+    assert metric.result()["mAP"] == pytest.approx(0.5)
+
+
+def test_padding_and_missed_objects():
+    metric = StreamingAP(2)
+    gtLabels = np.asarray([[0, -1]])
+
+    # Nothing detected
+    metric.update(GT, np.zeros((1, 2)), np.zeros((1, 2), dtype=np.int64), GT, gtLabels)
+
+    assert metric.result()["mAP"] == 0.0
+    assert metric.npos.tolist() == [1, 0]
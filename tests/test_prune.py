@@ -0,0 +1,31 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from model import createModel
+from prune import ChannelGraph
+
+
+@pytest.mark.parametrize("classAgnostic", [False, True])
+def test_prune_leaves_the_input_model_intact(classAgnostic):
+    model = createModel(3, ih=64, iw=64, nfeat=8, nfilters=8, ndepths=2, classAgnostic=classAgnostic)
+    x = np.random.default_rng(0).random((2, 64, 64, 3), dtype=np.float32)
+    y = model(x).numpy()
+
+    graph = ChannelGraph(model)
+    pruned = graph.prune(0.5, graph.scores())
+
+    assert pruned.count_params() < model.count_params()
+    assert pruned(x).shape == y.shape
+    np.testing.assert_array_equal(model(x).numpy(), y)
+
+
+def test_prune_without_removing_channels_keeps_the_outputs():
+    model = createModel(3, ih=64, iw=64, nfeat=8, nfilters=8, ndepths=2)
+    x = np.random.default_rng(1).random((2, 64, 64, 3), dtype=np.float32)
+
+    graph = ChannelGraph(model)
+    pruned = graph.prune(0.0, graph.scores())
+
+    np.testing.assert_allclose(pruned(x).numpy(), model(x).numpy(), atol=1e-6)
@@ -0,0 +1,66 @@
+import itertools
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from sampler import PrioritySampler
+
+
+def test_probabilities():
+    sampler = PrioritySampler(4, alpha=1.0, uniformMix=0.2)
+
+    # Uniform before any loss is known
+    np.testing.assert_allclose(sampler.probabilities(), 0.25)
+
+    sampler.update([0, 1], [1.0, 3.0])
+
+    # Unseen images get the largest known loss
+    np.testing.assert_allclose(sampler.probabilities(), 0.8*np.asarray([1, 3, 3, 3])/10 + 0.2/4)
+
+    # Padding indices are ignored, seen losses are averaged with momentum
+    sampler.update([0, -1], [2.0, 100.0])
+    assert sampler.losses[0] == pytest.approx(0.9*1.0 + 0.1*2.0)
+    assert not sampler.seen[2:].any()
+
+
+def test_weights_travel_with_their_draws():
+    sampler = PrioritySampler(5, alpha=1.0, uniformMix=0.0, beta=1.0, seed=0)
+    sampler.update(np.arange(5), [1.0, 2.0, 4.0, 8.0, 16.0])
+
+    p = sampler.probabilities()
+    expected = (1.0/(5*p)) / (1.0/(5*p)).max()
+
+    pairs = list(itertools.islice(sampler.stream(), 12))
+    for index, weight in pairs:
+        assert weight == pytest.approx(expected[index])
+
+    # Later losses change the next epoch, not the weights already drawn
+    indices, weights = sampler.epoch()
+    sampler.update(np.arange(5), [16.0, 8.0, 4.0, 2.0, 1.0])
+    np.testing.assert_allclose(weights, expected[indices], rtol=1e-6)
+    assert weights.max() <= 1.0
+
+
+def test_stream_epochs():
+    sampler = PrioritySampler(3, seed=0)
+    assert len(list(sampler.stream(nrepeat=2))) == 6
+
+
+def test_datapipe_samples(tmp_path):
+    from datapipe import Datapipe
+    from synthdata import generate
+
+    generate(str(tmp_path), 6, iw=64, ih=48, nworkers=2)
+    dp = Datapipe(str(tmp_path), ["face", "mask", "dummy"])
+
+    sampler = PrioritySampler(dp.nd, seed=0)
+    sampler.update(np.arange(dp.nd), np.arange(1.0, dp.nd+1))
+
+    g = dp.create_sampled(8, 8, 32, 32, 3, 4, sampler, nrepeat=1)
+    img, y, index, weight = next(iter(g))
+
+    assert img.shape == (4, 32, 32, 3)
+    assert y.shape == (4, 8, 8, 3+5)
+    assert index.dtype == tf.int64 and weight.shape == (4,)
+    assert (weight.numpy() > 0).all() and (weight.numpy() <= 1).all()
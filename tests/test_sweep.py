@@ -0,0 +1,23 @@
+import pytest
+
+from sweep import parseValue
+
+
+@pytest.mark.parametrize("value, expected", [("true", True), ("False", False), ("1", True), ("0", False)])
+def test_parse_bool(value, expected):
+    assert parseValue("classAgnostic", value) is expected
+
+
+def test_parse_bool_rejects_other_values():
+    with pytest.raises(ValueError):
+        parseValue("classAgnostic", "yes")
+
+
+def test_parse_casts_to_the_type_of_the_default():
+    assert parseValue("nfeat", "64") == 64 and isinstance(parseValue("nfeat", "64"), int)
+    assert parseValue("learnrate", "1e-4") == pytest.approx(1e-4)
+    assert parseValue("block", "inverted") == "inverted"
+
+
+def test_parse_int_without_default():
+    assert parseValue("maxFilters", "128") == 128 and isinstance(parseValue("maxFilters", "128"), int)
@@ -0,0 +1,40 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from model import createModel
+from tracking import TemporalROIDetector, createCropModel
+
+
+KWARGS = dict(nc=3, ih=64, iw=64, nfeat=8, nfilters=8, ndepths=2)
+
+
+@pytest.fixture(scope="module")
+def models():
+    model = createModel(**KWARGS)
+    return model, createCropModel(model, **KWARGS)
+
+
+def test_crop_frames(models):
+    model, cropModel = models
+    detector = TemporalROIDetector(model, cropModel, 3, 64, 64, K=5, keyframeInterval=4, cropSize=16, ndepths=2)
+
+    frame = np.random.default_rng(0).integers(0, 256, size=(48, 80, 3), dtype=np.uint8)
+
+    boxes, scores, classes, ncrops = detector.detect(frame)
+    assert ncrops == 0
+    assert boxes.shape == (5, 4)
+
+    # Track two small objects into the next (non-key) frame
+    detector.tracks = np.asarray([[0.1, 0.1, 0.2, 0.2], [0.5, 0.6, 0.7, 0.8]], dtype=np.float32)
+    boxes, scores, classes, ncrops = detector.detect(frame)
+
+    assert ncrops == 2
+    assert boxes.shape[1] == 4 and len(boxes) == len(scores) == len(classes)
+
+
+def test_crop_size_checked(models):
+    model, cropModel = models
+    with pytest.raises(ValueError):
+        TemporalROIDetector(model, cropModel, 3, 64, 64, cropSize=18, ndepths=2)
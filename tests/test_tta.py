@@ -0,0 +1,52 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+from datapipe import Datapipe
+from model import createModel
+from tta import createTTAPredictor, unflipMaps, untransposeMaps
+
+
+# Boxes (X1,Y1,X2,Y2) in [0,1]
+BOXES = tf.constant([[0.13, 0.21, 0.37, 0.52], [0.55, 0.6, 0.71, 0.93]])
+LABELS = tf.constant([0, 1])
+
+
+def label(boxes, nx=16, ny=16):
+    dp = Datapipe(None, ["a", "b"])
+    dp.nx, dp.ny, dp.sigma = nx, ny, 0.05
+    _, y = dp._gaussianLabel(None, boxes, LABELS, None)
+    return y[None]
+
+
+def test_unflip_matches_the_original_cells():
+    y = label(BOXES)
+    flipped = label(tf.stack([1.0-BOXES[:, 2], BOXES[:, 1], 1.0-BOXES[:, 0], BOXES[:, 3]], axis=1))
+
+    # All but the repeated edge column
+    unflipped = unflipMaps(flipped, 2).numpy()[0, :, :-1]
+    y = y.numpy()[0, :, :-1]
+
+    # Heatmaps, sizes and centers
+    np.testing.assert_allclose(unflipped[..., [0, 1, 2, 3, 6]], y[..., [0, 1, 2, 3, 6]], atol=1e-5)
+
+    # Offsets, which are only read at the centers
+    centers = y[..., 6] > 0
+    assert centers.sum() == 2
+    np.testing.assert_allclose(unflipped[centers][:, 4:6], y[centers][:, 4:6], atol=1e-5)
+
+
+def test_untranspose():
+    y = label(BOXES)
+    transposed = label(tf.gather(BOXES, [1, 0, 3, 2], axis=1))
+
+    np.testing.assert_allclose(untransposeMaps(transposed, 2), y, atol=1e-5)
+
+
+def test_transpose_needs_square_input():
+    model = createModel(2, ih=64, iw=32, nfeat=8, nfilters=8, ndepths=2)
+
+    createTTAPredictor(model, 2)
+    with pytest.raises(ValueError):
+        createTTAPredictor(model, 2, transpose=True)